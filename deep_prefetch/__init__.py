@@ -1,3 +1,8 @@
 # coding=utf-8
 
 __version__ = '0.0.2'
+
+
+def model_label(model):
+    """``'app_label.ModelName'`` of `model`."""
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name)
@@ -0,0 +1,80 @@
+# coding=utf-8
+"""
+Hooks on access to relations of model instances.
+
+``__get__`` of Django's relation descriptors is wrapped (see
+:func:`install`), wrapper calls functions of `ACCESS_HOOKS` before relation
+of an instance is accessed - only if the instance has one of `MARKERS`
+attributes, so instances that are not marked are not affected.
+
+Hooks are not called while :func:`quiet` is active in the thread - when
+prefetching itself accesses relations, for example.
+"""
+from contextlib import contextmanager
+from threading import local
+
+from django.contrib.contenttypes import generic
+from django.db.models.fields import related
+
+
+#Descriptor classes and functions that return name of relation attribute.
+DESCRIPTOR_ATTRS = (
+    (related.SingleRelatedObjectDescriptor,
+     lambda d: d.related.get_accessor_name()),
+    (related.ReverseSingleRelatedObjectDescriptor, lambda d: d.field.name),
+    (related.ForeignRelatedObjectsDescriptor,
+     lambda d: d.related.get_accessor_name()),
+    (related.ManyRelatedObjectsDescriptor,
+     lambda d: d.related.get_accessor_name()),
+    (related.ReverseManyRelatedObjectsDescriptor, lambda d: d.field.name),
+    (generic.GenericForeignKey, lambda d: d.name),
+    (generic.ReverseGenericRelatedObjectsDescriptor, lambda d: d.field.name),
+)
+
+#Functions called with ``(instance, attr)`` before relation `attr` of marked
+#instance is accessed.
+ACCESS_HOOKS = []
+
+#Names of attributes of instances which turn hooks on.
+MARKERS = []
+
+_state = local()
+
+
+@contextmanager
+def quiet():
+    """Turns hooks off in the current thread."""
+    previous = getattr(_state, 'quiet', False)
+    _state.quiet = True
+    try:
+        yield
+    finally:
+        _state.quiet = previous
+
+
+def on_access(instance, attr):
+    if getattr(_state, 'quiet', False):
+        return
+    with quiet():
+        for hook in ACCESS_HOOKS:
+            hook(instance, attr)
+
+
+def wrap_get(get, attr_fn):
+    def __get__(self, instance, instance_type=None):
+        if instance is not None:
+            for marker in MARKERS:
+                if marker in instance.__dict__:
+                    on_access(instance, attr_fn(self))
+                    break
+        return get(self, instance, instance_type)
+    __get__.wrapped = get
+    return __get__
+
+
+def install():
+    """Wraps ``__get__`` of relation descriptors, can be called repeatedly."""
+    for descriptor_class, attr_fn in DESCRIPTOR_ATTRS:
+        if not hasattr(descriptor_class.__get__, 'wrapped'):
+            descriptor_class.__get__ = wrap_get(descriptor_class.__get__.im_func,
+                                                attr_fn)
@@ -1,11 +1,23 @@
 # coding=utf-8
-from collections import defaultdict
-from django.db.models import Model
-from django.db.models.base import ModelBase
+from collections import defaultdict, namedtuple, deque
+from django.db import connections, router
+from django.db.models import Count, Manager, Model, Q
+from django.db.models.query import QuerySet, ValuesQuerySet
+from django.db.models.base import ModelBase, ModelState
 from django.db.models.query import get_prefetcher
+from django.db.models.fields import FieldDoesNotExist
 from django.db.models.sql.constants import LOOKUP_SEP
+from deep_prefetch import metrics, model_label, routing
+from deep_prefetch.access import quiet
+from deep_prefetch.cache import get_default_cache
+from deep_prefetch.nplusone import track
+from deep_prefetch.parallel import (get_default_pool, get_query_pool,
+                                    run_detached)
+from array import array
+from threading import Lock
+from time import time
 from itertools import chain, imap, islice, ifilter
-from operator import itemgetter
+from operator import attrgetter, itemgetter, or_
 from collections import OrderedDict
 import re
 from types import NoneType
@@ -16,27 +28,72 @@ __author__ = 'Andrew Pashkin <andrew.pashkin@gmx.co.uk>'
 DESCRIPTORS = {
     'GenericForeignKey': {
         'single': True,
-        'cache_attr': lambda p, d: p.cache_attr
+        'cache_attr': lambda p, d: p.cache_attr,
+        'parent_key': lambda p, d: attrgetter(
+            p.model._meta.get_field(p.ct_field).get_attname(), p.fk_field),
+        'parts': lambda p, d, objs: gfk_parts(p, objs),
+        'target': lambda p, d: gfk_target(p),
+        'key_fields': lambda p, d: []
     },
     'GenericRelatedObjectManager': {
         'single': False,
-        'cache_attr': lambda p, d: p.prefetch_cache_name
+        'cache_attr': lambda p, d: p.prefetch_cache_name,
+        'parent_key': lambda p, d: attrgetter('pk'),
+        'parts': lambda p, d, objs: generic_relation_parts(p, objs),
+        'key_fields': lambda p, d: [p.content_type_field_name,
+                                    p.object_id_field_name],
+        'partition': lambda p, d: generic_partition(
+            p.model, p.content_type_field_name, p.object_id_field_name)
     },
     'SingleRelatedObjectDescriptor': {
         'single': True,
-        'cache_attr': lambda p, d: p.cache_name
+        'cache_attr': lambda p, d: p.cache_name,
+        'parent_key': lambda p, d: attrgetter('pk'),
+        'key_fields': lambda p, d: [p.related.field.name],
+        'subquery': lambda p, d, source: Q(**{
+            '%s__pk__in' % p.related.field.name: source.values('pk')})
     },
     'ReverseSingleRelatedObjectDescriptor': {
         'single': True,
-        'cache_attr': lambda p, d: p.cache_name
+        'cache_attr': lambda p, d: p.cache_name,
+        'parent_key': lambda p, d: attrgetter(p.field.attname),
+        'parts': lambda p, d, objs: fk_parts(p, objs),
+        'target': lambda p, d: fk_target(p),
+        'key_fields': lambda p, d: [p.field.rel.field_name],
+        'subquery': lambda p, d, source: Q(**{
+            '%s__in' % p.field.rel.field_name: source.values(p.field.name)}),
+        # ancestors
+        'tree': lambda p, d: (p.field, False)
     },
     'RelatedManager': {
         'single': False,
-        'cache_attr': lambda p, d: d.related.field.related_query_name()
+        'cache_attr': lambda p, d: d.related.field.related_query_name(),
+        'parent_key': lambda p, d: attrgetter(
+            d.related.field.rel.get_related_field().attname),
+        'key_fields': lambda p, d: [d.related.field.name],
+        'subquery': lambda p, d, source: Q(**{
+            '%s__in' % d.related.field.name: source.values(
+                d.related.field.rel.get_related_field().name)}),
+        'partition': lambda p, d: (column(d.related.model, 'pk'),
+                                   [column(d.related.model,
+                                           d.related.field.name)]),
+        # descendants
+        'tree': lambda p, d: (d.related.field, True)
     },
     'ManyRelatedManager': {
         'single': False,
-        'cache_attr': lambda p, d: p.prefetch_cache_name
+        'cache_attr': lambda p, d: p.prefetch_cache_name,
+        'parent_key': lambda p, d: attrgetter(
+            p.through._meta.get_field(p.source_field_name)
+            .rel.get_related_field().get_attname()),
+        # key is selected as extra column
+        'key_fields': lambda p, d: [],
+        'value_key': lambda p, d: ['_prefetch_related_val'],
+        'subquery': lambda p, d, source: Q(**{
+            '%s__pk__in' % p.query_field_name: source.values('pk')}),
+        # rows are ranked by rows of the intermediate table
+        'partition': lambda p, d: (column(p.through, 'pk'),
+                                   [column(p.through, p.source_field_name)])
     }
 
 }
@@ -84,15 +141,6 @@ def find(func, iterable):
     return head(ifilter(func, iterable))
 
 
-def update_buffer(buffer, objects, lookups):
-    objects = [(id(o), o) for o in objects]
-    try:
-        model = objects[0][1].__class__
-    except IndexError:
-        raise ValueError('"objects" are empty!')
-    for lookup in lookups:
-        buffer[lookup][model].update(objects)
-
 def get_info(prefetcher, descriptor):
     info = DESCRIPTORS[prefetcher.__class__.__name__]
     single = info['single']
@@ -104,79 +152,1642 @@ def get_cache(obj, single, cache_name, attr):
         if single:
             return [getattr(obj, cache_name)]
         else:
-            return getattr(obj, '_prefetched_objects_cache')[cache_name]
+            # packed relation is iterated without making QuerySet of it
+            return dict.__getitem__(
+                getattr(obj, '_prefetched_objects_cache'), cache_name)
     except AttributeError:
         raise ValueError('Cache is unset!')
     except KeyError:
         raise ValueError
 
-def set_cache(obj, single, cache, cache_name, attr):
+def set_cache(obj, single, cache, cache_name, attr, instances=None):
+    """
+    :param instances: instances of identity map of the run if multi-valued
+                      relation is stored packed (see :class:`PackedRelation`).
+    """
     if single and cache:
         obj.__dict__.update({cache_name: cache[0]})
     elif not single:
-        cache_qs = getattr(obj, attr).all()
-        cache_qs._result_cache = cache
-        cache_qs._prefetch_done = True
+        if instances is not None:
+            cache = pack(cache, instances)
+        if isinstance(cache, PackedRelation):
+            relations = obj.__dict__.get('_prefetched_objects_cache')
+            if not isinstance(relations, CompactRelations):
+                relations = CompactRelations(obj, relations or ())
+                obj.__dict__['_prefetched_objects_cache'] = relations
+            relations.set_packed(cache_name, attr, cache)
+            return
         setdefaultattr(obj, '_prefetched_objects_cache', {}).update(
-            {cache_name: cache_qs})
+            {cache_name: PrefetchedQuerySet(obj, attr, cache_name, cache)})
 
-def tree():
-    return defaultdict(tree)
+def set_relation(obj, step, cache, to_attr=None, instances=None):
+    """
+    Sets up `cache` as relation `step` of `obj` or, if `to_attr` is given,
+    stores it to `to_attr` as plain list (single object or ``None`` for
+    single-valued relation).
+    """
+    if to_attr is None:
+        set_cache(obj, step.single, cache, step.cache_name, step.attr,
+                  instances)
+    elif step.single:
+        obj.__dict__[to_attr] = cache[0] if cache else None
+    else:
+        obj.__dict__[to_attr] = list(cache)
 
 
+class PrefetchedQuerySet(QuerySet):
+    """
+    Prefetched objects of multi-valued relation `attr` of `instance`.
 
+    Unlike QuerySet made by related manager it is cheap to create - query is
+    not built until it is needed: iteration, ``len()``, ``count()``,
+    ``exists()`` and indexing use prefetched objects, other methods (like
+    ``filter()``) turn it into QuerySet of the related manager first.
+    """
 
-class DefaultOrderedDict(OrderedDict):
-    # taken form http://stackoverflow.com/a/6190500/1818608
-    def __init__(self, default_factory=None, *a, **kw):
-        if default_factory is not None and not callable(default_factory):
-            raise TypeError('first argument must be callable')
-        OrderedDict.__init__(self, *a, **kw)
-        self.default_factory = default_factory
+    def __init__(self, instance=None, attr=None, cache_name=None,
+                 result=None):
+        self._instance = instance
+        self._attr = attr
+        self._cache_name = cache_name
+        self._result_cache = result
+        self._iter = None
+        self._prefetch_related_lookups = []
+        self._prefetch_done = True
 
-    def __getitem__(self, key):
+    def _materialize(self):
+        """
+        Becomes QuerySet of the related manager with the same results,
+        returns ``False`` if there is nothing to become.
+        """
+        instance = self.__dict__.pop('_instance', None)
+        if instance is None:
+            return False
+        prefetched = instance._prefetched_objects_cache
+        # manager returns prefetched QuerySet itself, if it is set up
+        stored = prefetched.pop(self._cache_name, None)
         try:
-            return OrderedDict.__getitem__(self, key)
-        except KeyError:
-            return self.__missing__(key)
-
-    def __missing__(self, key):
-        if self.default_factory is None:
-            raise KeyError(key)
-        self[key] = value = self.default_factory()
+            with quiet():
+                qs = getattr(instance, self._attr).all()
+        finally:
+            if stored is not None:
+                prefetched[self._cache_name] = stored
+        del self._attr, self._cache_name
+        for name, value in qs.__dict__.iteritems():
+            self.__dict__.setdefault(name, value)
+        self.__class__ = qs.__class__
+        return True
+
+    def _materialized(self):
+        if not self._materialize():
+            raise ValueError('QuerySet is not bound to an instance.')
+        return self
+
+    def __getattr__(self, name):
+        if name.startswith('__') or not self._materialize():
+            raise AttributeError(name)
+        return getattr(self, name)
+
+    # methods which use class of QuerySet before its query
+
+    def _clone(self, *args, **kwargs):
+        return self._materialized()._clone(*args, **kwargs)
+
+    def __deepcopy__(self, memo):
+        return self._materialized().__deepcopy__(memo)
+
+    def __reduce_ex__(self, protocol):
+        return self._materialized().__reduce_ex__(protocol)
+
+
+class PackedRelation(object):
+    """
+    Objects related to a parent, stored as primary keys - instances are taken
+    from identity map of the run (`instances`) when they are iterated.
+    """
+
+    __slots__ = ('instances', 'model', 'db', 'pks')
+
+    def __init__(self, instances, model, db, pks):
+        self.instances = instances
+        self.model = model
+        self.db = db
+        self.pks = pks
+
+    def __iter__(self):
+        instances, model, db = self.instances, self.model, self.db
+        for pk in self.pks:
+            yield instances[model, db, pk]
+
+    def __len__(self):
+        return len(self.pks)
+
+
+EMPTY_RELATION = PackedRelation(None, None, None, ())
+
+
+def pack(objects, instances):
+    """
+    :class:`PackedRelation` of `objects`, `objects` themselves if they are
+    not canonical instances of one model from one database.
+    """
+    if isinstance(objects, PackedRelation):
+        return objects
+    if not objects:
+        return EMPTY_RELATION
+    model, db = objects[0].__class__, objects[0]._state.db
+    pks = []
+    for obj in objects:
+        pk = obj.pk
+        if (obj.__class__ is not model or
+            instances.get((model, db, pk)) is not obj):
+            return objects
+        pks.append(pk)
+    try:
+        pks = array('l', pks)
+    except (TypeError, OverflowError):
+        pks = tuple(pks)
+    return PackedRelation(instances, model, db, pks)
+
+
+class CompactRelations(dict):
+    """
+    ``_prefetched_objects_cache`` of an instance with packed relations,
+    relation becomes :class:`PrefetchedQuerySet` when it is accessed.
+    """
+
+    __slots__ = ('instance', 'attrs')
+
+    def __init__(self, instance, relations=()):
+        dict.__init__(self, relations)
+        self.instance = instance
+        self.attrs = {} # cache name -> attribute of packed relation
+
+    def set_packed(self, cache_name, attr, packed):
+        dict.__setitem__(self, cache_name, packed)
+        self.attrs[cache_name] = attr
+
+    def __getitem__(self, cache_name):
+        value = dict.__getitem__(self, cache_name)
+        if isinstance(value, PackedRelation):
+            value = PrefetchedQuerySet(self.instance,
+                                       self.attrs.pop(cache_name),
+                                       cache_name, list(value))
+            dict.__setitem__(self, cache_name, value)
         return value
 
+    def get(self, cache_name, default=None):
+        return self[cache_name] if cache_name in self else default
+
     def __reduce__(self):
-        if self.default_factory is None:
-            args = tuple()
+        # pickled without identity map
+        return dict, (dict((name, self[name]) for name in self),)
+
+def tree():
+    return defaultdict(tree)
+
+
+#Descriptors of relations that are accessed through related managers.
+RELATED_MANAGER_DESCRIPTORS = (
+    'ForeignRelatedObjectsDescriptor',
+    'ManyRelatedObjectsDescriptor',
+    'ReverseManyRelatedObjectsDescriptor',
+    'ReverseGenericRelatedObjectsDescriptor',
+)
+
+def get_relation_prefetcher(obj, attr):
+    """
+    Like :func:`get_prefetcher` but never evaluates attribute of `obj`,
+    if `attr` is not a known relation - ``(None, None)`` is returned.
+
+    :returns: ``(prefetcher, descriptor)``
+    """
+    descriptor = getattr(obj.__class__, attr, None)
+    if hasattr(descriptor, 'get_prefetch_query_set'):
+        prefetcher = descriptor
+    elif descriptor.__class__.__name__ in RELATED_MANAGER_DESCRIPTORS:
+        prefetcher = getattr(obj, attr)
+    else:
+        return None, None
+    if prefetcher.__class__.__name__ not in DESCRIPTORS:
+        return None, None
+    return prefetcher, descriptor
+
+
+class LRUCache(object):
+    """Thread-safe mapping that keeps `maxsize` recently used items."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                return default
+            self.items[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            if len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+#Maximum number of compiled steps and lookups kept by the process.
+PLAN_CACHE_SIZE = 1024
+
+#Separator of attribute and depth of recursive lookup part.
+RECURSION_SEP = '*'
+
+MISSING = object()
+
+
+class Step(object):
+    """
+    Relation of a model compiled for traversal.
+
+    Everything that depends only on model class is resolved once and
+    reused by all prefetch runs (see :func:`get_step`).
+    """
+
+    __slots__ = ('attr', 'prefetcher', 'descriptor', 'single', 'cache_name',
+                 'is_cached', 'target', 'parts')
+
+    def __init__(self, attr, prefetcher, descriptor, bound=False):
+        """
+        :param bound: whether `prefetcher` is a related manager bound to
+                      an instance, such prefetcher is not kept - it is taken
+                      from the objects being traversed.
+        """
+        self.attr = attr
+        self.prefetcher = None if bound else prefetcher
+        self.descriptor = descriptor
+        self.single, self.cache_name = get_info(prefetcher, descriptor)
+        self.is_cached = getattr(descriptor, 'is_cached', None)
+        self.target = get_target(prefetcher, descriptor)
+        self.parts = DESCRIPTORS[prefetcher.__class__.__name__].get('parts')
+
+    def get_prefetcher(self, obj):
+        if self.prefetcher is None:
+            return getattr(obj, self.attr)
+        return self.prefetcher
+
+
+steps = LRUCache(PLAN_CACHE_SIZE)  # (model, attr) -> Step or None
+
+
+def get_step(obj, attr):
+    """
+    Compiled :class:`Step` for relation `attr` of model of `obj`,
+    ``None`` if `attr` is not a known relation.
+    """
+    key = obj.__class__, attr
+    step = steps.get(key, MISSING)
+    if step is MISSING:
+        prefetcher, descriptor = get_relation_prefetcher(obj, attr)
+        if prefetcher is not None:
+            step = Step(attr, prefetcher, descriptor,
+                        bound=prefetcher is not descriptor)
         else:
-            args = self.default_factory,
-        return type(self), args, None, None, self.items()
+            step = None
+        steps.set(key, step)
+    return step
 
-    def copy(self):
-        return self.__copy__()
 
-    def __copy__(self):
-        return type(self)(self.default_factory, self)
 
-    def __deepcopy__(self, memo):
-        import copy
-        return type(self)(self.default_factory,
-                          copy.deepcopy(self.items()))
-    def __repr__(self, *args, **kwargs):
-        return 'OrderedDefaultDict(%s, %s)' % (self.default_factory,
-                                        OrderedDict.__repr__(self))
-
-def update_seen(seen, model, attr, single, cache_name, obj, cache):
-    seen[model][attr]['single'] = single
-    seen[model][attr]['cache_name'] = cache_name
-    seen[model][attr]['cache'][obj] = cache
+
+class WorkItem(object):
+    """Objects of one model for which one lookup must be traversed."""
+
+    __slots__ = ('lookup', 'model', 'objects', 'ids', 'order')
+
+    def __init__(self, lookup, model, order):
+        self.lookup = lookup
+        self.model = model
+        self.objects = [] # without repetitions, in order of addition
+        self.ids = set() # ids of `objects`
+        self.order = order
+
+    def add(self, objects, ids):
+        """Adds distinct `objects`, `ids` - set of their ids."""
+        if not self.ids:
+            self.objects.extend(objects)
+            self.ids.update(ids)
+            return
+        for obj in objects:
+            if id(obj) not in self.ids:
+                self.ids.add(id(obj))
+                self.objects.append(obj)
+
+
+class Scheduler(object):
+    """
+    Level-synchronous scheduler of prefetch work.
+
+    Work is processed level by level: all work for one traversal depth is
+    taken at once, so work for the same relation and target model is
+    fetched together. Work discovered while processing a level goes to
+    the next one.
+
+    `order` of work is position of the lookup it originates from.
+    Traversal of attributes that are not relations (properties, for example)
+    may depend on caches set up by preceding lookups, so it is deferred
+    until all work of lower order is done
+    (see ``LookupOrderingTest.test_order`` of Django test suite).
+    """
+
+    def __init__(self):
+        self.levels = deque()
+        self.deferred = []
+        self.orders = defaultdict(int) # order -> number of unfinished work
+
+    def add(self, objects, lookups, order):
+        """Schedules traversal of `lookups` for `objects` on the next level."""
+        if not self.levels:
+            self.levels.append(OrderedDict())
+        level = self.levels[-1]
+        # objects are grouped by model once for all lookups
+        by_model = OrderedDict() # model -> (distinct objects, their ids)
+        for obj in objects:
+            model = obj.__class__
+            group = by_model.get(model)
+            if group is None:
+                group = by_model[model] = [], set()
+            if id(obj) not in group[1]:
+                group[1].add(id(obj))
+                group[0].append(obj)
+        for lookup in lookups:
+            for model, (model_objects, ids) in by_model.iteritems():
+                key = lookup, model
+                item = level.get(key)
+                if item is None:
+                    item = level[key] = WorkItem(lookup, model, order)
+                    self.orders[order] += 1
+                elif order < item.order:
+                    self._forget(item.order)
+                    self.orders[order] += 1
+                    item.order = order
+                item.add(model_objects, ids)
+
+    def pop_level(self):
+        """
+        Takes all work of the next level sorted by order,
+        ``None`` if nothing is left.
+        """
+        self._release()
+        if not self.levels:
+            if self.deferred:
+                raise RuntimeError('Deferred work of orders %s is never '
+                                   'released.' % sorted(
+                                       set(i.order for i in self.deferred)))
+            return None
+        return sorted(self.levels.popleft().itervalues(),
+                      key=attrgetter('order'))
+
+    def done(self, item):
+        self._forget(item.order)
+
+    def is_ready(self, item):
+        """Whether all work of lower order than `item` is done."""
+        return min(self.orders) >= item.order
+
+    def defer(self, item):
+        self.deferred.append(item)
+
+    def _release(self):
+        deferred, self.deferred = self.deferred, []
+        for item in deferred:
+            if self.is_ready(item):
+                self._forget(item.order)
+                self.add(item.objects, [item.lookup], item.order)
+            else:
+                self.deferred.append(item)
+
+    def _forget(self, order):
+        self.orders[order] -= 1
+        if not self.orders[order]:
+            del self.orders[order]
+
+
+class IdentityMap(object):
+    """
+    Instances loaded during one prefetch run, one per ``(model, database,
+    pk)`` - rows with equal keys in different databases are different rows.
+
+    The first instance of a row becomes canonical one - later occurrences
+    of the row are replaced by it, so shared rows are neither duplicated
+    in memory nor traversed more than once.
+    """
+
+    def __init__(self):
+        self.instances = {}
+
+    def get(self, model, pk, db):
+        return self.instances.get((model, db, pk))
+
+    def related(self, target, obj):
+        """
+        Loaded object which single-valued relation of `obj` refers to,
+        `target` - function returned by :func:`get_target`. Related row is
+        looked for in the database of `obj`.
+        """
+        model, pk = target(obj)
+        return self.instances.get((model, obj._state.db, pk))
+
+    def canonical(self, obj):
+        """Registers `obj` if its row is not known yet, returns canonical."""
+        if obj.pk is None:
+            return obj
+        return self.instances.setdefault(row_key(obj), obj)
+
+
+def row_key(obj):
+    """``(model, database, pk)`` of the row of `obj`."""
+    return obj.__class__, obj._state.db, obj.pk
+
+
+class PrefetchRun(object):
+    """
+    State of one :func:`deep_prefetch_related_objects` call.
+
+    :param chunk_size: see :func:`deep_prefetch_related_objects`.
+    :param parallel: see :func:`deep_prefetch_related_objects`.
+    :param compact: see :func:`deep_prefetch_related_objects`.
+    :param cache: :class:`deep_prefetch.cache.PrefetchCache` or ``None``.
+    :param routing: see :func:`deep_prefetch_related_objects`.
+    :param source: :class:`SourceQuery` of objects of the first level or
+                   ``None``.
+    :param subquery_threshold: see :func:`deep_prefetch_related_objects`.
+    """
+
+    def __init__(self, chunk_size=None, parallel=None, cache=None,
+                 compact=False, routing=None, source=None,
+                 subquery_threshold=None):
+        self.scheduler = Scheduler()
+        self.seen = tree() # model -> attr ->
+                           #              single     -> bool
+                           #              cache_name -> str
+                           #              cache      ->
+                           #                  db -> obj -> [cache]
+        self.identity = IdentityMap()
+        #Instances that packed relations refer to, in compact mode.
+        self.instances = self.identity.instances if compact else None
+        self.chunk_size = chunk_size
+        self.parallel = parallel
+        self.cache = cache
+        self.routing = routing
+        self.source = source
+        self.subquery_threshold = subquery_threshold
+        self.roots = frozenset() # ids of objects of the first level
+        #id of recursive lookup -> ``row_key()`` of objects it reached (equal
+        #lookups continuing different paths are different recursions)
+        self.visited = defaultdict(set)
+        #Whether events of `deep_prefetch.metrics` are reported.
+        self.instrumented = metrics.enabled()
+        self.fetches = self.rows = self.seen_hits = self.cache_hits = 0
+
+    def key_source(self, objects, chunk_size):
+        """
+        Chooses how rows related to `objects` are selected: returns
+        :class:`SourceQuery` if they are all objects of the first level,
+        their number reaches subquery threshold and their database is the
+        database of the source, otherwise `chunk_size` - rows are selected
+        by lists of keys.
+        """
+        source, threshold = self.source, self.subquery_threshold
+        if (source is None or threshold is None or
+            len(objects) < max(threshold, 1) or
+            len(objects) != len(self.roots) or
+            head(objects)._state.db != source.queryset.db or
+            not all(id(obj) in self.roots for obj in objects)):
+            return chunk_size
+        return source
+
+    def schedule_rest(self, item, parents, objects):
+        """
+        Schedules traversal of the rest of lookup of `item` for `objects`
+        related to its `parents`. Objects already reached by the same
+        recursive lookup are skipped - they were reached by a path that is
+        not longer, so their relations are traversed anyway.
+        """
+        clipped = item.lookup.clip()
+        if not clipped or not objects:
+            return
+        if clipped.recursion is not None:
+            visited = self.visited[id(clipped.recursion)]
+            visited.update(imap(row_key, parents))
+            objects = [obj for obj in objects if row_key(obj) not in visited]
+            visited.update(imap(row_key, objects))
+            if not objects:
+                return
+        self.scheduler.add(objects, [clipped], item.order)
+
+    def route(self, group, part_items):
+        """
+        ``(replica, db)`` if `group` of parts is fetched from database
+        `replica` instead of `db` by routing policy, otherwise ``None``.
+        """
+        if self.routing is None:
+            return None
+        part = head(group)
+        model = related_model(part)
+        db = part.key[3]
+        if db is None:
+            db = router.db_for_read(model, instance=head(part.objects))
+        paths = set(part_items[id(p)].lookup.relation_path for p in group)
+        replica = self.routing.db_for_prefetch(model, paths, db)
+        return (replica, db) if replica != db else None
+
+    def map_groups(self, groups, routes):
+        """
+        Fetches groups of parts (in worker threads in parallel mode) by
+        their `routes`, returns list of results in the same order, if run
+        is instrumented - results of :func:`timed_fetch_group`.
+        """
+        fetch = timed_fetch_group if self.instrumented else fetch_group
+        if self.parallel > 1 and len(groups) > 1:
+            return get_query_pool(self.parallel).map(fetch,
+                                                     zip(groups, routes))
+        return map(fetch, groups, routes)
+
+
+def get_seen_cache(seen, model, step):
+    """
+    Dictionary ``db -> obj -> cache`` of relation `step` of `model` (objects
+    of different databases with equal keys are equal).
+    """
+    seen[model][step.attr]['single'] = step.single
+    seen[model][step.attr]['cache_name'] = step.cache_name
+    return seen[model][step.attr]['cache']
+
+def parse_part(part):
+    """
+    ``(attr, depth)`` of lookup part, depth of recursive part
+    ``'attr*depth'`` - maximum number of times it is followed, of plain
+    part - ``None``.
+    """
+    attr, star, depth = part.partition(RECURSION_SEP)
+    if not star:
+        return attr, None
+    if not depth.isdigit() or int(depth) < 1:
+        raise ValueError('Invalid depth of recursive lookup part %r.' % part)
+    return attr, int(depth)
+
 
 def clip_lookup(lookup):
-    return LOOKUP_SEP.join(lookup.split(LOOKUP_SEP)[1:]) or None
+    first, _, rest = lookup.partition(LOOKUP_SEP)
+    attr, depth = parse_part(first)
+    if depth is not None and depth > 1:
+        return '%s%s%d' % (attr, RECURSION_SEP, depth - 1)
+    return rest or None
+
+
+def expand_lookup(lookup):
+    """Attributes of `lookup`, recursive part is repeated by its depth."""
+    attrs = []
+    for part in lookup.split(LOOKUP_SEP):
+        attr, depth = parse_part(part)
+        attrs.extend([attr] * (depth or 1))
+    return attrs
+
+
+class DeepPrefetch(object):
+    """
+    Lookup with options attached to it.
+
+    Can be passed to ``prefetch_related`` and
+    :func:`deep_prefetch_related_objects` in place of a plain string lookup.
+    Options travel with the lookup while it is being traversed, two lookups
+    are merged in processing only if their options are equal.
+
+    :param lookup: lookup string like ``'content_object__comments'``.
+    :param chunk_size: maximum number of parent objects per query made
+                       while following the lookup (overrides ``chunk_size``
+                       of the call).
+    :param only: names of fields that are loaded for objects fetched by the
+                 last relation of the lookup, like in ``QuerySet.only()``.
+                 Either list of names or dictionary which maps model
+                 (class or ``'app_label.ModelName'``) to list of names -
+                 for relations that lead to different models (GFK).
+    :param defer: names of fields that are not loaded, like in
+                  ``QuerySet.defer()``, in the same form as `only`.
+    :param values: names of fields (in the same form as `only`) - objects
+                   fetched by the last relation of the lookup are not
+                   instantiated, instead plain list of dictionaries
+                   with values of that fields is stored to `to_attr`
+                   of parents (like ``QuerySet.values()``).
+    :param tuples: in values mode - tuples are stored instead of
+                   dictionaries (like ``QuerySet.values_list()``).
+    :param to_attr: attribute (key for dictionary parents) to store objects
+                    fetched by the last relation of the lookup to, as plain
+                    list (object or ``None`` for single-valued relation).
+                    Relation itself is not set up, which is cheaper.
+                    In values mode - attribute to store rows to, by default
+                    - ``'<relation>_values'``.
+    :param limit: maximum number of objects fetched by the last relation of
+                  the lookup for each parent (for multi-valued relations),
+                  rows are ranked by ``ROW_NUMBER()`` window function in the
+                  prefetch query. Limited relation is not reused by other
+                  lookups and is not stored to cross-request cache.
+    :param order_by: ordering of objects fetched by the last relation of
+                     the lookup (names of fields of fetched model, ``'-'``
+                     prefix - descending), with `limit` - first objects by
+                     this ordering are fetched (only fields of the model
+                     itself, not ones across relations or ``'?'``). By
+                     default - ordering of the model.
+    :param aggregate: ``'count'`` or ``'exists'`` - objects of the last
+                      relation of the lookup are not fetched, instead number
+                      of them (whether there are any) is stored to
+                      `to_attr` of parents, by default -
+                      ``'<relation>_count'`` (``'<relation>_exists'``).
+                      Numbers are counted by one grouped query per model
+                      of fetched objects.
+    :param join: whether single-valued forward relations of the lookup that
+                 follow a prefetch query are fetched by ``select_related``
+                 of that query (see :func:`get_joins`), otherwise they are
+                 fetched by queries of their own, coalesced with the same
+                 relations of other lookups.
+    :param tree: whether recursive part of the lookup, which must follow
+                 foreign key of a model to itself (``'children*10'`` -
+                 subtree, ``'parent*10'`` - ancestors), is fetched by one
+                 ``WITH RECURSIVE`` query for all levels instead of a query
+                 per level (see :func:`fetch_tree`). Can't be combined with
+                 `values`, `aggregate` and `limit`.
+
+    The last part of the lookup can be recursive - ``'related_posts*3'``
+    follows relation up to 3 times (like
+    ``'related_posts__related_posts__related_posts'``), but objects which
+    were already reached by it are not followed again, so each object is
+    queried once and cycles are cut. Options of the last relation apply to
+    each step of recursion.
+
+    Fields that are needed to match fetched objects with their parents are
+    always loaded.
+    """
+
+    def __init__(self, lookup, chunk_size=None, only=None, defer=None,
+                 values=None, tuples=False, to_attr=None, limit=None,
+                 order_by=None, aggregate=None, join=True, tree=False):
+        self.lookup = lookup
+        self.chunk_size = chunk_size
+        self.only = only
+        self.defer = defer
+        self.values = values
+        self.tuples = tuples
+        self.limit = limit
+        self.order_by = order_by
+        if aggregate not in AGGREGATES and aggregate is not None:
+            raise ValueError('Unknown aggregate %r.' % aggregate)
+        self.aggregate = aggregate
+        self.join = join
+        self.tree = tree
+        self._to_attr = to_attr
+        parts = lookup.split(LOOKUP_SEP)
+        if any(parse_part(part)[1] for part in parts[:-1]):
+            raise ValueError('Only the last part of lookup %r can be '
+                             'recursive.' % lookup)
+        #First part of the lookup and maximum number of its repetitions if
+        #it is recursive.
+        self.attr, self.depth = parse_part(parts[0])
+        if tree and (parse_part(parts[-1])[1] is None or values is not None or
+                     aggregate is not None or limit is not None):
+            raise ValueError('Tree prefetch needs recursive lookup without '
+                             'values, aggregate and limit, got %r.' % lookup)
+        #Recursive lookup which this one continues, see `PrefetchRun.visited`.
+        self.recursion = self if self.depth else None
+        #Parts of the original lookup that were clipped off.
+        self.prefix = ''
+        self.to_attr = to_attr or '%s_%s' % (self.attr, aggregate or 'values')
+        #Whether the first relation is the last one to be fetched (options
+        #of the last relation are applied to each step of recursion).
+        last = len(parts) == 1
+        #Attribute to store objects to instead of relation cache.
+        if to_attr and values is None and aggregate is None and last:
+            self.store_attr = to_attr
+        else:
+            self.store_attr = None
+        if only is None and defer is None:
+            self.fields = None
+        else:
+            self.fields = normalize_fields(only), normalize_fields(defer)
+        order_by = tuple(order_by) if order_by is not None else None
+        if aggregate is not None and last:
+            # aggregates are rows of values mode without fields
+            self.query_options = QueryOptions(None, (), False, limit,
+                                              order_by, aggregate)
+        elif values is not None and last:
+            self.query_options = QueryOptions(
+                self.fields, normalize_fields(values), tuples, limit,
+                order_by, None)
+        elif (self.fields, limit, order_by) != (None, None, None) and last:
+            self.query_options = QueryOptions(self.fields, None, False, limit,
+                                              order_by, None)
+        else:
+            self.query_options = None
+
+    @property
+    def options(self):
+        return {'chunk_size': self.chunk_size, 'only': self.only,
+                'defer': self.defer, 'values': self.values,
+                'tuples': self.tuples, 'to_attr': self._to_attr,
+                'limit': self.limit, 'order_by': self.order_by,
+                'aggregate': self.aggregate, 'join': self.join,
+                'tree': self.tree}
+
+    @property
+    def relation_path(self):
+        """Path of the first relation from objects of the original lookup."""
+        if self.prefix:
+            return self.prefix + LOOKUP_SEP + self.attr
+        return self.attr
+
+    @property
+    def values_mode(self):
+        """Whether relation is fetched as plain rows."""
+        return (self.query_options is not None and
+                self.query_options.values is not None)
+
+    @property
+    def fetches_tree(self):
+        """Whether the first relation is fetched by tree query."""
+        return self.tree and self.depth is not None
 
+    @property
+    def limited(self):
+        """Whether only a part of related objects is fetched."""
+        return is_limited(self.query_options)
 
-def deep_prefetch_related_objects(objects, lookups):
+    def clip(self):
+        """Same lookup without first part or ``None`` if nothing is left."""
+        try:
+            return self._clipped
+        except AttributeError:
+            clipped = clip_lookup(self.lookup)
+            if clipped:
+                self._clipped = self.__class__(clipped, **self.options)
+                self._clipped.prefix = self.relation_path
+                if self.depth > 1:
+                    self._clipped.recursion = self.recursion
+            else:
+                self._clipped = None
+            return self._clipped
+
+    def _key(self):
+        # lookup doesn't change after it is made, key is computed once
+        try:
+            return self._cached_key
+        except AttributeError:
+            # options of the last relation are known to the clipped lookup
+            clipped = self.clip()
+            self._cached_key = (
+                self.lookup, self.chunk_size,
+                self.query_options or self.fields,
+                self.to_attr if self.values_mode else self.store_attr,
+                self.join, self.tree, clipped._key() if clipped else None)
+            self._hash = hash(self._cached_key)
+            return self._cached_key
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        return (isinstance(other, DeepPrefetch) and
+                self._key() == other._key())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        try:
+            return self._hash
+        except AttributeError:
+            self._key()
+            return self._hash
+
+    def __repr__(self):
+        return '<%s: %s>' % (self.__class__.__name__, self.lookup)
+
+
+def normalize_fields(fields):
+    """
+    Converts `only` or `defer` argument of :class:`DeepPrefetch` to
+    hashable form - tuple of ``(model label or None, field names)``.
+    """
+    if fields is None:
+        return None
+    if not isinstance(fields, dict):
+        return ((None, tuple(fields)),)
+    normalized = []
+    for model, names in fields.iteritems():
+        if not isinstance(model, basestring):
+            model = model_label(model)
+        normalized.append((model.lower(), tuple(names)))
+    return tuple(sorted(normalized))
+
+
+def fields_for(fields, model):
+    """Field names of normalized `fields` which are related to `model`."""
+    label = model_label(model).lower()
+    for fields_label, names in fields or ():
+        if fields_label is None or fields_label == label:
+            return names
+    return None
+
+
+#How objects of the last relation of lookup are queried: field restriction
+#(``(only, defer)`` in normalized form), values (normalized), whether
+#rows of values mode are tuples, limit of objects per parent, ordering and
+#aggregate (see `AGGREGATES`).
+QueryOptions = namedtuple('QueryOptions',
+                          'fields values tuples limit order_by aggregate')
+
+#Aggregates of :class:`DeepPrefetch` - functions which make value stored
+#to parent from numbers of related objects counted for it.
+AGGREGATES = {
+    'count': sum,
+    'exists': any,
+}
+
+
+def is_values_mode(options):
+    return options is not None and options.values is not None
+
+
+def is_limited(options):
+    return options is not None and options.limit is not None
+
+
+def column(model, name):
+    """``(table, column)`` of field `name` (``'pk'`` too) of `model`."""
+    if name == 'pk':
+        field, owner = model._meta.pk, None
+    else:
+        field, owner, _, _ = model._meta.get_field_by_name(name)
+    return (owner or model)._meta.db_table, field.column
+
+
+def has_field(model, name):
+    """Whether `name` (``'pk'`` too) is a field of `model`."""
+    if name == 'pk':
+        return True
+    try:
+        model._meta.get_field_by_name(name)
+    except FieldDoesNotExist:
+        return False
+    return True
+
+
+def generic_partition(model, ct_field, fk_field):
+    return column(model, 'pk'), [column(model, ct_field),
+                                 column(model, fk_field)]
+
+
+def limit_rows(qs, options, partition):
+    """
+    Applies ordering and limit of :class:`QueryOptions` to prefetch query
+    `qs`. Only first ``options.limit`` rows of each parent are fetched -
+    rows are numbered by ``ROW_NUMBER() OVER (PARTITION BY ...)`` in
+    a subquery.
+
+    :param partition: ``(row column, parent key columns)`` (as returned by
+                      :func:`column`) - row column identifies row of the
+                      query, rows with equal values of key columns belong
+                      to one parent. ``None`` - relation is single-valued,
+                      limit is not applied.
+    """
+    if options is None or options.order_by is None and options.limit is None:
+        return qs
+    model = qs.model
+    if options.order_by is not None:
+        qs = qs.order_by(*options.order_by)
+    if options.limit is None or partition is None:
+        return qs
+    ordering = (options.order_by or qs.query.order_by or
+                model._meta.ordering)
+    for name in ordering:
+        if name == '?' or not has_field(model, name.lstrip('-')):
+            # rows are ranked by columns of the fetched table only
+            raise ValueError('Only local fields of %s can order limited '
+                             'prefetch, got %r.' % (model.__name__, name))
+    qn = connections[qs.db].ops.quote_name
+    sql_column = lambda table_column: '%s.%s' % tuple(map(qn, table_column))
+    order = ['%s %s' % (sql_column(column(model, name.lstrip('-'))),
+                        'DESC' if name.startswith('-') else 'ASC')
+             for name in ordering]
+    order.append('%s ASC' % sql_column(column(model, 'pk')))
+    row, keys = partition
+    rank = 'ROW_NUMBER() OVER (PARTITION BY %s ORDER BY %s)' % (
+        ', '.join(map(sql_column, keys)), ', '.join(order))
+    ranked = qs.order_by().extra(
+        select={'_prefetch_row': sql_column(row), '_prefetch_rank': rank}
+    ).values_list('_prefetch_row', '_prefetch_rank')
+    sql, params = ranked.query.get_compiler(qs.db).as_sql()
+    where = ('%s IN (SELECT _prefetch_row FROM (%s) ranked '
+             'WHERE _prefetch_rank <= %%s)' % (sql_column(row), sql))
+    return qs.extra(where=[where], params=list(params) + [options.limit])
+
+
+def evaluate(qs, options, key_names):
+    """
+    Evaluates prefetch query with :class:`QueryOptions`.
+
+    :param key_names: names of fields that are needed to match fetched
+                      objects with parents.
+    :returns: list of objects, in values mode - list of ``(key, row)``,
+              for aggregates - list of ``(key, number of objects)``.
+    """
+    if options is None:
+        return list(qs)
+    if options.values is None:
+        return list(restrict_fields(qs, options.fields, key_names))
+    key = itemgetter(*key_names)
+    if options.aggregate is not None:
+        counts = qs.order_by().values(*key_names).annotate(
+            _prefetch_count=Count('pk'))
+        return [(key(raw), raw['_prefetch_count']) for raw in counts]
+    names = list(fields_for(options.values, qs.model) or
+                 [f.name for f in qs.model._meta.fields])
+    extra = [n for n in key_names if n not in names]
+    rows = []
+    for raw in qs.values(*(names + extra)):
+        if options.tuples:
+            row = tuple(raw[n] for n in names)
+        elif extra:
+            row = dict((n, raw[n]) for n in names)
+        else:
+            row = raw
+        rows.append((key(raw), row))
+    return rows
+
+
+def restrict_fields(qs, fields, required):
+    """
+    Applies field restriction of :class:`DeepPrefetch` to `qs`.
+
+    :param fields: ``(only, defer)`` in normalized form or ``None``.
+    :param required: names of fields that must be loaded.
+    """
+    if fields is None:
+        return qs
+    only, defer = (fields_for(f, qs.model) for f in fields)
+    if only is not None:
+        qs = qs.only(*(list(only) + [f for f in required if f not in only]))
+    if defer is not None:
+        qs = qs.defer(*[f for f in defer if f not in required])
+    return qs
+
+
+lookups = LRUCache(PLAN_CACHE_SIZE)  # lookup string -> DeepPrefetch
+
+
+def normalize_lookup(lookup):
+    """
+    :class:`DeepPrefetch` for `lookup`, for string lookups - shared one,
+    so the lookup is parsed once for all prefetch runs.
+    """
+    if isinstance(lookup, DeepPrefetch):
+        return lookup
+    compiled = lookups.get(lookup)
+    if compiled is None:
+        compiled = DeepPrefetch(lookup)
+        lookups.set(lookup, compiled)
+    return compiled
+
+
+def chunks(iterable, size):
+    """Splits `iterable` into lists of at most `size` elements."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def unique_by_id(objects):
+    """Drops repeated occurrences of the same objects, keeps order."""
+    return OrderedDict((id(o), o) for o in objects).values()
+
+
+def get_parent_key(prefetcher, descriptor):
+    """
+    Function which returns value of object that is used as a key
+    in prefetch query made by `prefetcher`.
+    """
+    info = DESCRIPTORS[prefetcher.__class__.__name__]
+    return info['parent_key'](prefetcher, descriptor)
+
+
+def execute_prefetch(prefetcher, descriptor, instances, chunk_size=None,
+                     options=None, using=None, joins=None, select=None):
+    """
+    Runs prefetch query of `prefetcher` for `instances`.
+
+    If `chunk_size` is given - instances are split into batches with at most
+    `chunk_size` distinct keys and one query is made for each batch, so
+    size of ``IN (...)`` clause stays bounded.
+
+    `options` are :class:`QueryOptions` of the lookup, `using` - alias of
+    the database to query instead of the one chosen by `prefetcher`,
+    `joins` - relations to fetch by ``select_related`` (see `get_joins`),
+    `select` - ``Q`` object which selects related rows instead of keys of
+    `instances` (see :class:`SourceQuery`).
+
+    :returns: ``(discovered, rel_attr_fn, cur_attr_fn, single, cache_name,
+               additional_lookups)``
+    """
+    if chunk_size and select is None:
+        by_key = OrderedDict()
+        parent_key = get_parent_key(prefetcher, descriptor)
+        for obj in instances:
+            by_key.setdefault(parent_key(obj), []).append(obj)
+        batches = (list(concat(batch))
+                   for batch in chunks(by_key.itervalues(), chunk_size))
+    else:
+        batches = [instances]
+    discovered = []
+    additional_lookups = None
+    for batch in batches:
+        prefetch_qs, rel_attr_fn, cur_attr_fn, single, cache_name =         \
+        prefetcher.get_prefetch_query_set(batch)
+        if select is not None and isinstance(prefetch_qs, QuerySet):
+            prefetch_qs = reselect(prefetch_qs, prefetcher, select)
+        if using is not None and isinstance(prefetch_qs, QuerySet):
+            prefetch_qs = prefetch_qs.using(using)
+        if joins and isinstance(prefetch_qs, QuerySet):
+            prefetch_qs = select_joins(prefetch_qs, joins)
+        if additional_lookups is None:
+            #prefetch lookups from prefetch queries are merged into
+            #processing.
+            additional_lookups = getattr(prefetch_qs,
+                                         '_prefetch_related_lookups', [])
+        if additional_lookups:
+            setattr(prefetch_qs, '_prefetch_related_lookups', [])
+        if options is not None and isinstance(prefetch_qs, QuerySet):
+            info = DESCRIPTORS[prefetcher.__class__.__name__]
+            partition = info.get('partition')
+            prefetch_qs = limit_rows(
+                prefetch_qs, options,
+                partition and partition(prefetcher, descriptor))
+            key_fields = info['key_fields'](prefetcher, descriptor)
+            if options.values is not None:
+                key_fields = info.get('value_key', info['key_fields'])(
+                    prefetcher, descriptor)
+                rel_attr_fn = itemgetter(0)
+            discovered.extend(evaluate(prefetch_qs, options, key_fields))
+        else:
+            discovered.extend(prefetch_qs)
+    if is_values_mode(options):
+        additional_lookups = []
+    return (discovered, rel_attr_fn, cur_attr_fn, single, cache_name,
+            map(normalize_lookup, additional_lookups))
+
+
+def reselect(qs, prefetcher, select):
+    """
+    Prefetch query like `qs` made by `prefetcher`, but with rows selected
+    by ``Q`` object `select`.
+    """
+    if isinstance(prefetcher, Manager):
+        manager = qs.model._default_manager
+    else:
+        manager = qs.model._base_manager
+    reselected = manager.using(qs.db).filter(select)
+    if qs.query.extra:  # key column of many-to-many relations
+        reselected = reselected.extra(select=OrderedDict(
+            (name, sql) for name, (sql, _) in qs.query.extra.iteritems()))
+    return reselected
+
+
+class SourceQuery(object):
+    """
+    QuerySet which objects of the first level were loaded by.
+
+    Relations of all of them are selected by subqueries of it
+    (``WHERE fk IN (SELECT ...)``) instead of lists of keys
+    (see :meth:`PrefetchRun.key_source`). Subquery sees the current rows,
+    not the ones objects were loaded from.
+    """
+
+    def __init__(self, queryset):
+        queryset = queryset.order_by()
+        queryset._prefetch_related_lookups = []
+        self.queryset = queryset
+
+    @staticmethod
+    def usable(queryset):
+        """Whether `queryset` can be a subquery."""
+        return (queryset is not None and queryset.query.can_filter() and
+                not isinstance(queryset, ValuesQuerySet))
+
+
+#Objects of one model that need the same relation to be fetched.
+#Parts with equal `key` are fetched together by one query,
+#`key[0]` is the function that does it, `key[-2]` is `QueryOptions` (or
+#``None``) and `key[-1]` is chunk size or :class:`SourceQuery` if rows are
+#selected by subquery.
+#`lookup` is :class:`DeepPrefetch` the part is fetched for, `select` -
+#function which makes ``Q`` object that selects rows related to objects
+#of the part by their source QuerySet.
+Part = namedtuple('Part', 'key model attr objects cur_attr_fn '
+                          'prefetcher descriptor step lookup select')
+
+
+def fk_parts(prefetcher, objects):
+    field = prefetcher.field
+    if field.rel.get_related_field().rel:
+        return None # target field is a relation itself
+    target = field.rel.to
+    db = router.db_for_read(target, instance=objects[0])
+    select = lambda source: Q(**{'%s__in' % field.rel.field_name:
+                                 source.values(field.name)})
+    return [((fetch_rows, target, field.rel.field_name, db),
+             objects, attrgetter(field.attname), select)]
+
+
+#Fields whose columns are compared with each other without casts.
+INTEGER_FIELDS = frozenset(['AutoField', 'BigIntegerField', 'IntegerField',
+                            'PositiveIntegerField',
+                            'PositiveSmallIntegerField', 'SmallIntegerField'])
+
+
+def comparable(field, other, db):
+    """
+    Whether column of `field` can be compared with column of `other` in
+    database `db` as is - generic relations with text object ids can't
+    select rows of integer keys by subquery (``WHERE id IN (SELECT
+    object_pk ...)`` is an error in PostgreSQL).
+    """
+    while field.rel is not None:
+        field = field.rel.get_related_field()
+    while other.rel is not None:
+        other = other.rel.get_related_field()
+    types = field.get_internal_type(), other.get_internal_type()
+    if all(t in INTEGER_FIELDS for t in types):
+        return True
+    connection = connections[db]
+    return field.db_type(connection) == other.db_type(connection)
+
+
+def gfk_parts(prefetcher, objects):
+    ct_attname = prefetcher.model._meta.get_field(
+        prefetcher.ct_field).get_attname()
+    by_ct = defaultdict(list)
+    for obj in objects:
+        ct_id = getattr(obj, ct_attname)
+        if ct_id is not None:
+            by_ct[ct_id, obj._state.db].append(obj)
+    parts = []
+    for (ct_id, db), ct_objects in by_ct.iteritems():
+        target = prefetcher.get_content_type(id=ct_id,
+                                             using=db).model_class()
+        def cur_attr_fn(obj, prep=target._meta.pk.get_prep_value):
+            val = getattr(obj, prefetcher.fk_field)
+            return prep(val) if val is not None else None
+        fk_field = prefetcher.model._meta.get_field(prefetcher.fk_field)
+        if comparable(fk_field, target._meta.pk, db):
+            def select(source, ct_id=ct_id):
+                return Q(pk__in=source.filter(**{ct_attname: ct_id})
+                                      .values(prefetcher.fk_field))
+        else:
+            select = None
+        parts.append(((fetch_rows, target, target._meta.pk.name, db),
+                      ct_objects, cur_attr_fn, select))
+    return parts
+
+
+def generic_relation_parts(prefetcher, objects):
+    target = prefetcher.model
+    db = prefetcher._db or router.db_for_read(target, instance=objects[0])
+    fields = (prefetcher.content_type_field_name,
+              prefetcher.object_id_field_name)
+    ct_id = prefetcher.content_type.id
+    select = lambda source: Q(**{
+        '%s__pk' % fields[0]: ct_id, '%s__in' % fields[1]: source.values('pk')})
+    if not comparable(target._meta.get_field(fields[1]),
+                      objects[0]._meta.pk, db):
+        select = None
+    return [((fetch_generic_related, target, fields, db),
+             objects, lambda obj: (ct_id, obj._get_pk_val()), select)]
+
+
+def tree_parts(prefetcher, descriptor, model, objects, depth):
+    tree = DESCRIPTORS[prefetcher.__class__.__name__].get('tree')
+    field, descending = tree(prefetcher, descriptor) if tree else (None, None)
+    if field is None or field.model is not model or field.rel.to is not model:
+        raise ValueError('Tree prefetch needs foreign key of %s to itself.'
+                         % model.__name__)
+    db = router.db_for_read(model, instance=objects[0])
+    if descending:
+        cur_attr_fn = attrgetter(field.rel.get_related_field().attname)
+    else:
+        cur_attr_fn = attrgetter(field.attname)
+    return [((fetch_tree, model, (field.name, descending, depth), db),
+             objects, cur_attr_fn, None)]
+
+
+def fk_target(prefetcher):
+    field = prefetcher.field
+    if not field.rel.get_related_field().primary_key:
+        return None
+    target = field.rel.to
+    return lambda obj: (target, getattr(obj, field.attname))
+
+
+def gfk_target(prefetcher):
+    ct_attname = prefetcher.model._meta.get_field(
+        prefetcher.ct_field).get_attname()
+    def target(obj):
+        ct_id = getattr(obj, ct_attname)
+        if ct_id is None:
+            return None, None
+        model = prefetcher.get_content_type(id=ct_id,
+                                            using=obj._state.db).model_class()
+        pk = getattr(obj, prefetcher.fk_field)
+        if model is None or pk is None:
+            return None, None
+        return model, model._meta.pk.to_python(pk)
+    return target
+
+
+def get_target(prefetcher, descriptor):
+    """
+    Function which returns ``(model, pk)`` of the object referred by
+    single-valued relation, ``None`` if relation is not the one that
+    refers to primary key.
+    """
+    target_fn = DESCRIPTORS[prefetcher.__class__.__name__].get('target')
+    return target_fn(prefetcher, descriptor) if target_fn else None
+
+
+def get_parts(step, prefetcher, model, objects, chunk_size, lookup):
+    """
+    Splits `objects` into :class:`Part`'s.
+
+    Relations for which Django builds prefetch query with key column of
+    target model (FK, GFK, generic relations) make parts that can be
+    coalesced with parts of other relations which target same model and
+    column. Parts of other relations can be coalesced only with parts
+    of the same relation. Objects of different databases are never in one
+    part.
+    """
+    descriptor = step.descriptor
+    by_db = OrderedDict()
+    for obj in objects:
+        by_db.setdefault(obj._state.db, []).append(obj)
+    parts = []
+    for db, db_objects in by_db.iteritems():
+        if lookup.fetches_tree:
+            db_parts = tree_parts(prefetcher, descriptor, model, db_objects,
+                                  lookup.depth)
+        elif step.parts:
+            db_parts = step.parts(prefetcher, descriptor, db_objects)
+        else:
+            db_parts = None
+        if db_parts is None:
+            subquery = DESCRIPTORS[prefetcher.__class__.__name__].get(
+                'subquery')
+            select_fn = subquery and (lambda source: subquery(
+                prefetcher, descriptor, source))
+            db_parts = [((fetch_relation, model, step.attr, db), db_objects,
+                         None, select_fn)]
+        parts.extend(db_parts)
+    return [Part(key + (lookup.query_options, chunk_size), model, step.attr,
+                 part_objects, cur_attr_fn, prefetcher, descriptor, step,
+                 lookup, select)
+            for key, part_objects, cur_attr_fn, select in parts]
+
+
+#Descriptors of single-valued relations which can be followed by
+#``select_related``.
+JOINABLE_DESCRIPTORS = {
+    'ReverseSingleRelatedObjectDescriptor': lambda d: d.field.rel.to,
+    'SingleRelatedObjectDescriptor': lambda d: d.related.model,
+}
+
+
+def get_joins(model, lookups):
+    """
+    Single-valued relations with which `lookups` (:class:`DeepPrefetch` or
+    ``None``) start from `model` - they are fetched by ``select_related``
+    of the query that fetches objects of `model` and then are set up from
+    descriptor caches instead of being queried.
+    Relations which are the last ones of lookups with field restrictions or
+    values mode and relations of lookups with ``join=False`` are fetched
+    as usual.
+
+    :returns: tree of relations -
+              ``OrderedDict`` ``attr -> (cache name, subtree)``.
+    """
+    joins = OrderedDict()
+    for lookup in lookups:
+        level, current = joins, model
+        while (lookup is not None and lookup.join and
+               lookup.query_options is None and not lookup.fetches_tree):
+            descriptor = getattr(current, lookup.attr, None)
+            target_fn = JOINABLE_DESCRIPTORS.get(
+                descriptor.__class__.__name__)
+            if target_fn is None:
+                break
+            if lookup.attr not in level:
+                level[lookup.attr] = descriptor.cache_name, OrderedDict()
+            level = level[lookup.attr][1]
+            current, lookup = target_fn(descriptor), lookup.clip()
+    return joins
+
+
+def group_joins(parts):
+    """Relations joined to the query of group of `parts`, see `get_joins`."""
+    part = head(parts)
+    if part.key[-2] is not None:
+        return {}
+    return get_joins(related_model(part), [p.lookup.clip() for p in parts])
+
+
+def join_paths(joins, prefix=''):
+    """Arguments of ``select_related`` for tree of `joins`."""
+    paths = []
+    for attr, (_, subtree) in joins.iteritems():
+        path = prefix + attr
+        paths.extend(join_paths(subtree, path + LOOKUP_SEP) or [path])
+    return paths
+
+
+def select_joins(qs, joins):
+    paths = join_paths(joins)
+    return qs.select_related(*paths) if paths else qs
+
+
+def joined_objects(obj, joins):
+    """Objects joined to `obj` by `joins`, deepest first."""
+    for attr, (cache_name, subtree) in joins.iteritems():
+        related = obj.__dict__.get(cache_name)
+        if related is not None:
+            for joined in joined_objects(related, subtree):
+                yield joined
+            yield related
+
+
+def canonical_joins(identity, obj, joins):
+    """
+    Replaces objects joined to `obj` by their canonical instances, joined
+    objects of replaced instances are passed to canonical ones if those
+    lack them.
+    """
+    for attr, (cache_name, subtree) in joins.iteritems():
+        related = obj.__dict__.get(cache_name)
+        if related is None:
+            continue
+        canonical_joins(identity, related, subtree)
+        canonical = identity.canonical(related)
+        if canonical is not related:
+            for _, (sub_cache_name, _) in subtree.iteritems():
+                if sub_cache_name in related.__dict__:
+                    canonical.__dict__.setdefault(
+                        sub_cache_name, related.__dict__[sub_cache_name])
+            obj.__dict__[cache_name] = canonical
+
+
+def part_keys(parts):
+    keys = OrderedDict()
+    for part in parts:
+        for obj in part.objects:
+            key = part.cur_attr_fn(obj)
+            if key is not None:
+                keys[key] = None
+    return keys.keys()
+
+
+def selected_by_source(parts):
+    """
+    ``Q`` object which selects rows of `parts` by subqueries, ``None`` if
+    they are selected by keys.
+    """
+    source = head(parts).key[-1]
+    if not isinstance(source, SourceQuery):
+        return None
+    return reduce(or_, (p.select(source.queryset) for p in parts))
+
+
+def fetch_relation(parts, using=None):
+    """Fetches parts of one relation with its prefetcher."""
+    part = head(parts)
+    objects = OrderedDict((id(o), o) for p in parts for o in p.objects)
+    (discovered, rel_attr_fn, cur_attr_fn, _, _,
+     additional_lookups) = execute_prefetch(part.prefetcher, part.descriptor,
+                                            objects.values(), part.key[-1],
+                                            part.key[-2], using,
+                                            group_joins(parts),
+                                            selected_by_source(parts))
+    return discovered, rel_attr_fn, cur_attr_fn, additional_lookups
+
+
+def fetch_rows(parts, using=None):
+    """Fetches rows of target model by values of its key column."""
+    _, model, key_name, db, options, chunk_size = head(parts).key
+    discovered = []
+    qs = select_joins(model._base_manager.using(using or db),
+                      group_joins(parts))
+    select = selected_by_source(parts)
+    if select is not None:
+        batches = [select]
+    else:
+        keys = part_keys(parts)
+        batches = (Q(**{'%s__in' % key_name: batch})
+                   for batch in chunks(keys, chunk_size or len(keys) or 1))
+    for batch in batches:
+        discovered.extend(evaluate(qs.filter(batch), options, [key_name]))
+    if is_values_mode(options):
+        rel_attr_fn = itemgetter(0)
+    else:
+        rel_attr_fn = attrgetter(model._meta.get_field(key_name).attname)
+    return discovered, rel_attr_fn, None, []
+
+
+def fetch_generic_related(parts, using=None):
+    """
+    Fetches objects of target model of generic relations
+    by (content type, object id) pairs.
+    """
+    _, model, (ct_field, fk_field), db, options, chunk_size = head(parts).key
+    discovered = []
+    additional_lookups = []
+    base_qs = select_joins(model._default_manager.using(using or db),
+                           group_joins(parts))
+    select = selected_by_source(parts)
+    if select is not None:
+        batches = [select]
+    else:
+        keys = part_keys(parts)
+        batches = (by_content_type(batch, ct_field, fk_field)
+                   for batch in chunks(keys, chunk_size or len(keys) or 1))
+    for batch in batches:
+        qs = base_qs.filter(batch)
+        additional_lookups = getattr(qs, '_prefetch_related_lookups', [])
+        if additional_lookups:
+            setattr(qs, '_prefetch_related_lookups', [])
+        qs = limit_rows(qs, options,
+                        generic_partition(model, ct_field, fk_field))
+        discovered.extend(evaluate(qs, options, [ct_field, fk_field]))
+    if is_values_mode(options):
+        return discovered, itemgetter(0), None, []
+    ct_attname = model._meta.get_field(ct_field).get_attname()
+    return (discovered, attrgetter(ct_attname, fk_field), None,
+            map(normalize_lookup, additional_lookups))
+
+
+def tree_where(model, field, descending, keys, depth, db):
+    """
+    ``(where, params)`` which select rows of `model` reached from rows with
+    `keys` by foreign key `field` of it in at most `depth` steps - children
+    (keys are values of the target column), if `descending`, otherwise
+    parents (keys are values of the foreign key).
+    """
+    qn = connections[db].ops.quote_name
+    table = qn(model._meta.db_table)
+    key = qn(field.rel.get_related_field().column)
+    fk = qn(field.column)
+    match, link = (fk, '_prefetch_key') if descending else (key,
+                                                            '_prefetch_next')
+    where = ('%(table)s.%(key)s IN ('
+             'WITH RECURSIVE _prefetch_tree'
+             '(_prefetch_key, _prefetch_next, _prefetch_depth) AS ('
+             'SELECT %(key)s, %(fk)s, 1 FROM %(table)s '
+             'WHERE %(match)s IN (%(keys)s) '
+             'UNION SELECT T.%(key)s, T.%(fk)s, '
+             '_prefetch_tree._prefetch_depth + 1 '
+             'FROM %(table)s T, _prefetch_tree '
+             'WHERE T.%(match)s = _prefetch_tree.%(link)s '
+             'AND _prefetch_tree._prefetch_depth < %%s) '
+             'SELECT _prefetch_key FROM _prefetch_tree)' % {
+                 'table': table, 'key': key, 'fk': fk, 'match': match,
+                 'link': link, 'keys': ', '.join(['%s'] * len(keys))})
+    return where, list(keys) + [depth]
+
+
+def fetch_tree(parts, using=None):
+    """
+    Fetches all levels of recursive relation of a model to itself by
+    ``WITH RECURSIVE`` query - subtrees or ancestors of objects of parts.
+    Relations of fetched objects are stored to seen data by
+    :func:`set_up_tree`.
+    """
+    _, model, (field_name, descending, depth), db, options, chunk_size = \
+        head(parts).key
+    field = model._meta.get_field(field_name)
+    if descending:
+        manager = model._default_manager
+        rel_attr_fn = attrgetter(field.attname)
+    else:
+        manager = model._base_manager
+        rel_attr_fn = attrgetter(field.rel.get_related_field().attname)
+    qs = limit_rows(manager.using(using or db), options, None)
+    key_names = [field.name, field.rel.field_name]
+    keys = part_keys(parts)
+    discovered = []
+    for batch in chunks(keys, chunk_size or len(keys) or 1):
+        where, params = tree_where(model, field, descending, batch, depth,
+                                   using or db)
+        discovered.extend(evaluate(qs.extra(where=[where], params=params),
+                                   options, key_names))
+    return discovered, rel_attr_fn, None, []
+
+
+def set_up_tree(run, part, rel_to_cur, cur_attr_fn):
+    """
+    Stores relations of objects fetched by :func:`fetch_tree` for `part`
+    to seen data - next levels of recursion are set up from it without
+    queries. Relations of objects of the last level are not known.
+    """
+    depth = part.key[2][2]
+    seen_cache = get_seen_cache(run.seen, part.model, part.step)
+    visited = set(id(obj) for obj in part.objects)
+    level = concat(rel_to_cur.get(cur_attr_fn(obj), [])
+                   for obj in part.objects)
+    for _ in xrange(depth - 1):
+        next_level = []
+        for obj in level:
+            if id(obj) in visited:
+                continue
+            visited.add(id(obj))
+            obj_cache = rel_to_cur.get(cur_attr_fn(obj), [])
+            seen_cache[obj._state.db][obj] = obj_cache
+            next_level.extend(obj_cache)
+        level = next_level
+
+
+def by_content_type(keys, ct_field, fk_field):
+    """``Q`` object which selects rows by (content type, object id) keys."""
+    by_ct = defaultdict(set)
+    for ct_id, pk in keys:
+        by_ct[ct_id].add(pk)
+    return reduce(or_, (
+        Q(**{'%s__pk' % ct_field: ct_id, '%s__in' % fk_field: pks})
+        for ct_id, pks in by_ct.iteritems()))
+
+
+def fetch_group(parts, route=None):
+    """
+    Fetches group of parts with equal keys.
+
+    :param route: ``(replica, db)`` - query is made on database `replica`
+                  instead of `db`, fetched objects are marked as loaded
+                  from `db` (see :mod:`deep_prefetch.routing`).
+    """
+    part = head(parts)
+    if route is None:
+        return part.key[0](parts)
+    replica, db = route
+    result = part.key[0](parts, replica)
+    if not is_values_mode(part.key[-2]):
+        joins = group_joins(parts)
+        for obj in result[0]:
+            obj._state.db = db
+            for joined in joined_objects(obj, joins):
+                joined._state.db = db
+    return result
+
+
+def timed_fetch_group(parts, route=None):
+    """
+    Returns ``(time of fetching, executed SQL, result)``, SQL is known only
+    if connections log queries.
+    """
+    logged = [(alias, len(connections[alias].queries))
+              for alias in connections]
+    start = time()
+    result = fetch_group(parts, route)
+    elapsed = time() - start
+    sql = [query['sql'] for alias, count in logged
+           for query in connections[alias].queries[count:]]
+    return elapsed, sql, result
+
+
+def related_model(part):
+    """Model of objects fetched for `part`."""
+    if part.key[0] is not fetch_relation:
+        return part.key[1]
+    prefetcher = part.prefetcher
+    if isinstance(prefetcher, Manager):
+        return prefetcher.model
+    if hasattr(prefetcher, 'related'):
+        return prefetcher.related.model
+    return prefetcher.field.rel.to
+
+
+def deep_prefetch_related_objects(objects, lookups, chunk_size=None,
+                                  parallel=None, cache=None, model=None,
+                                  compact=False, routing=None, source=None,
+                                  subquery_threshold=None):
     """
     Helper function for prefetch_related functionality.
 
@@ -187,7 +1798,46 @@ def deep_prefetch_related_objects(objects, lookups):
     in that that it can prefetch "non-strict" lookups through GFK.
 
     :param objects: result cache of base queryset.
-    :param lookups: list with lookups.
+    :param lookups: list with lookups (strings or :class:`DeepPrefetch`).
+    :param chunk_size: maximum number of parent objects per prefetch query,
+                       bigger sets are fetched in several queries.
+                       ``None`` - no limit.
+    :param parallel: maximum number of worker threads used to run
+                     independent prefetch queries of one level in parallel,
+                     each worker uses its own database connections (kept
+                     open for the following calls), which don't see
+                     uncommitted changes of the calling thread.
+                     ``None`` - queries are run one after another.
+    :param cache: :class:`deep_prefetch.cache.PrefetchCache` to take
+                  relations from and store fetched ones to, ``True`` -
+                  default cache. ``None`` - cache is not used.
+    :param model: model of `objects` if they are dictionaries returned by
+                  ``QuerySet.values()``. Results of the first relation of
+                  each lookup are stored to dictionaries by name of the
+                  relation (by `to_attr` if it is given).
+    :param compact: whether multi-valued relations are stored as arrays of
+                    primary keys of related objects, instances are made
+                    into QuerySet when relation is accessed. Memory used by
+                    relations that are not accessed is then proportional to
+                    number of fetched rows, not to number of QuerySets.
+    :param routing: :class:`deep_prefetch.routing.ReplicaPolicy` which
+                    chooses database for each prefetch query (read replica
+                    instead of the primary database).
+                    ``None`` - queries go to databases of parent objects.
+    :param source: QuerySet which `objects` were loaded by. If there are
+                   at least `subquery_threshold` objects, queries of their
+                   relations select rows by subquery of it
+                   (``WHERE fk IN (SELECT ...)``) instead of list of keys -
+                   keys are not sent to the database and it can plan
+                   a semi-join. Subquery is evaluated again, so objects
+                   whose rows were changed or deleted after `objects` were
+                   loaded (by other transactions too, unless isolation
+                   level is REPEATABLE READ or stricter) get empty
+                   relations, rows of added objects are fetched too, but
+                   not used.
+    :param subquery_threshold: minimal number of objects for which `source`
+                               is used, ``None`` (default) - it is never
+                               used.
     """
 
     #How it works
@@ -215,122 +1865,451 @@ def deep_prefetch_related_objects(objects, lookups):
     #     `obj -> lookup` used for storing data for traversed lookups
     #     (``seen``) - that's done to reduce redundancy in data, but
     #     "primary key" for stroed data is `obj -> lookup`.
-    #   - Data flows through `buffer`, during processing.
-    #     Objects discovered while traversing DB structure are being added
-    #     and processed objects are removed.
-    #todo beauty and refactoring
+    #   - Data flows through `scheduler` (see `Scheduler`), during
+    #     processing. Objects discovered while traversing DB structure are
+    #     scheduled for the next level and processed objects are removed.
+    #   - Before querying, work of a level is split into parts
+    #     (see `get_parts`) and parts which target the same model and key
+    #     column are fetched by the same query (coalesced).
+    #   - Queries of one level are independent, in parallel mode they are
+    #     run by a thread pool, but results are set up to objects only in
+    #     the calling thread and in the same order as in serial mode.
+    #   - Each fetched row is represented by one instance during the run
+    #     (see `IdentityMap`), targets of foreign keys which are already
+    #     loaded are set up without querying.
+    #   - Objects are tracked for N+1 queries detection afterwards
+    #     (see `deep_prefetch.nplusone`).
+    #   - If anybody listens - run and each query are reported
+    #     (see `deep_prefetch.metrics`).
     if len(objects) == 0:
         return # nothing to do
 
-    #lookup -> model -> {(id(obj), obj), ...}
-    #id(obj) - because objects must be distinguished by id.
-    #DefaultOrederedDict because order of lookups matter,
-    #see tests.LookupOrderingTest.test_order of Django test suite.
-    buffer = DefaultOrderedDict(lambda: defaultdict(set))
-
-    update_buffer(buffer, objects, reversed(lookups))
-    seen = tree()     # model -> attr ->
-                      #              single     -> bool
-                      #              cache_name -> str
-                      #              cache      ->
-                      #                         obj -> [cache]
-    while True:
-        try:
-            lookup = last(buffer.keys())
-        except TypeError:
-            break
-        try:
-            model, current = buffer[lookup].popitem()
-        except KeyError:
-            del buffer[lookup]
+    if cache is True:
+        cache = get_default_cache()
+    lookups = map(normalize_lookup, lookups)
+    # source is cloned only if it can be used
+    if (subquery_threshold is not None and
+        len(objects) >= subquery_threshold and SourceQuery.usable(source)):
+        source = SourceQuery(source)
+    else:
+        source = None
+    run = PrefetchRun(chunk_size, parallel, cache, compact, routing, source,
+                      subquery_threshold)
+    rows = None
+    if isinstance(head(objects), dict):
+        if model is None:
+            raise ValueError('model must be given to prefetch for '
+                             'dictionaries.')
+        rows, objects = objects, row_instances(objects, model)
+        run.source = None
+    else:
+        for obj in objects:
+            run.identity.canonical(obj)
+    run.roots = frozenset(id(obj) for obj in objects)
+    for order, lookup in enumerate(lookups):
+        run.scheduler.add(objects, [lookup], order)
+
+    if run.instrumented:
+        start = time()
+        event = metrics.RunEvent(head(objects).__class__,
+                                 [l.lookup for l in lookups], len(objects),
+                                 None, None, None, None, None)
+        metrics.run_started(event)
+    with quiet():  # relations accessed here are not accessed by user
+        while True:
+            level = run.scheduler.pop_level()
+            if level is None:
+                break
+            process_level(run, level)
+    if run.instrumented:
+        metrics.run_finished(event._replace(
+            duration=time() - start, fetches=run.fetches, rows=run.rows,
+            seen_hits=run.seen_hits, cache_hits=run.cache_hits))
+    if rows is not None:
+        copy_to_rows(rows, objects, lookups)
+    else:
+        track(objects)
+
+
+def row_instances(rows, model):
+    """
+    Instances of `model` with values of `rows` (dictionaries returned by
+    ``QuerySet.values()``), they are used to traverse relations of rows.
+    Instances are not initialized - only fields present in rows are set,
+    primary key is required (instances are compared by it).
+    """
+    pk_attname = model._meta.pk.attname
+    attnames = {'pk': pk_attname}
+    for field in model._meta.fields:
+        attnames[field.name] = attnames[field.attname] = field.attname
+    instances = []
+    for row in rows:
+        obj = model.__new__(model)
+        obj._state = ModelState()
+        obj._state.adding = False
+        obj.__dict__.update((attnames[name], value)
+                            for name, value in row.iteritems()
+                            if name in attnames)
+        if pk_attname not in obj.__dict__:
+            raise ValueError('Primary key must be among values of '
+                             'dictionaries to prefetch for them.')
+        instances.append(obj)
+    return instances
+
+
+def copy_to_rows(rows, instances, lookups):
+    """Copies results of first relations of `lookups` to `rows`."""
+    for lookup in lookups:
+        for row, obj in zip(rows, instances):
+            if lookup.values_mode:
+                row[lookup.to_attr] = obj.__dict__.get(lookup.to_attr, [])
+                continue
+            step = get_step(obj, lookup.attr)
+            if step is None:
+                continue
+            if lookup.store_attr:
+                row[lookup.store_attr] = obj.__dict__.get(
+                    lookup.store_attr, None if step.single else [])
+                continue
+            try:
+                cache = get_cache(obj, step.single, step.cache_name,
+                                  step.attr)
+            except ValueError:
+                cache = [None] if step.single else []
+            row[lookup.attr] = cache[0] if step.single else list(cache)
+
+
+def adeep_prefetch_related_objects(objects, lookups, executor=None,
+                                   **options):
+    """
+    Non-blocking version of :func:`deep_prefetch_related_objects`.
+
+    Prefetching is done in a thread of `executor`, independent queries
+    are run concurrently if ``parallel`` option is given.
+    Connections opened by the thread are closed when it is done.
+
+    :param executor: object with :meth:`submit` method like
+                     :class:`concurrent.futures.ThreadPoolExecutor`,
+                     by default - shared pool of
+                     :mod:`deep_prefetch.parallel`.
+    :returns: future which result is ``None`` when prefetching is done,
+              can be wrapped for event loop (for example, by
+              ``asyncio.wrap_future``) if `executor` returns
+              :class:`concurrent.futures.Future`.
+    """
+    executor = executor or get_default_pool()
+    # writes of the calling thread are read from primary databases
+    return executor.submit(run_detached, routing.run_pinned,
+                           routing.pinned(), deep_prefetch_related_objects,
+                           objects, lookups, **options)
+
+
+def process_level(run, level):
+    scheduler = run.scheduler
+    relations = []
+    for item in level:
+        sample = head(item.objects)
+        step = get_step(sample, item.lookup.attr)
+        if step is not None:
+            relations.append((item, step, step.get_prefetcher(sample)))
+            continue
+        if not scheduler.is_ready(item):
+            scheduler.defer(item)
             continue
+        prefetcher, descriptor, attr_found, _ = get_prefetcher(
+            sample, item.lookup.attr)
+        if prefetcher is not None:
+            step = Step(item.lookup.attr, prefetcher, descriptor)
+            relations.append((item, step, prefetcher))
+            continue
+        traverse_attribute(scheduler, item, attr_found)
 
-        attr = lookup.split(LOOKUP_SEP)[0]
+    fetch_relations(run, relations)
 
-        sample = current.pop()
-        current.add(sample)
-        _, object = sample
-        prefetcher, _, attr_found, _ = get_prefetcher(object, attr)
 
-        #Lookup is not valid for that object, it must be skipped.
-        #No exception, because data it is that data is of diffrerent types,
-        #so - such situation is normal.
-        if not attr_found:
+def set_rows(objects, cur_attr_fn, rel_to_cur, to_attr, aggregate=None):
+    """
+    Stores rows fetched in values mode to `to_attr` of `objects`, with
+    `aggregate` - result of it for numbers of rows.
+    """
+    for obj in objects:
+        rows = rel_to_cur.get(cur_attr_fn(obj), [])
+        obj.__dict__[to_attr] = aggregate(rows) if aggregate else rows
+
+
+def is_loaded(obj, step):
+    """Whether relation `step` of `obj` is set up."""
+    if step.single:
+        return step.cache_name in obj.__dict__
+    return step.cache_name in getattr(obj, '_prefetched_objects_cache', {})
+
+
+def related_to(objects, step):
+    """Objects which are set up as relation `step` of `objects`."""
+    for obj in objects:
+        try:
+            cache = get_cache(obj, step.single, step.cache_name, step.attr)
+        except ValueError:
             continue
+        for related_obj in cache:
+            if related_obj is not None:
+                yield related_obj
 
-        if LOOKUP_SEP not in lookup and prefetcher is None:
-            raise ValueError("'%s' does not resolve to a item that supports "
-                             "prefetching - this is an invalid parameter to "
-                             "prefetch_related()." % lookup)
 
-        if prefetcher is None:
-            clipped = clip_lookup(lookup)
-            if clipped:
-                update_buffer(
-                    buffer,
-                    filter(is_not_none, [getattr(o, attr)
-                                         for _, o in current]),
-                    [clipped])
+def schedule_cached(run, item, obj, cache):
+    """Schedules traversal of the rest of lookup for cached objects."""
+    # if data was cached it still must be traversed.
+    run.schedule_rest(item, [obj], filter(is_not_none, cache))
+
+
+def traverse_attribute(scheduler, item, attr_found):
+    """Schedules objects referred by attribute that is not a relation."""
+    lookup = item.lookup
+    scheduler.done(item)
+    #Lookup is not valid for that object, it must be skipped.
+    #No exception, because data it is that data is of diffrerent types,
+    #so - such situation is normal.
+    if not attr_found:
+        return
+
+    if lookup.clip() is None:
+        raise ValueError("'%s' does not resolve to a item that supports "
+                         "prefetching - this is an invalid parameter to "
+                         "prefetch_related()." % lookup.lookup)
+
+    scheduler.add(filter(is_not_none, [getattr(o, lookup.attr)
+                                       for o in item.objects]),
+                  [lookup.clip()], item.order)
+
+
+def take_uncached(run, item, step, cache_versions):
+    """
+    Sets up relation `step` for objects of `item` for which it is already
+    known.
+
+    :returns: ``(objects for which relation must be fetched, number of
+               objects set up from seen data, number of objects set up
+               from cross-request cache)``.
+
+    :param cache_versions: dictionary ``(model, attr) -> versions`` to which
+                           versions of cross-request cache are put.
+    """
+    identity, cache = run.identity, run.cache
+    model = item.model
+    attr, single, cache_name = step.attr, step.single, step.cache_name
+    is_cached, target = step.is_cached, step.target
+    to_attr, instances = item.lookup.store_attr, run.instances
+    seen_caches = get_seen_cache(run.seen, model, step)
+    current = []
+    for obj in item.objects:
+        seen_cache = seen_caches[obj._state.db]
+        # no need to query for already prefetched data
+        if is_cached and is_cached(obj): # case of Django internal cache
+            obj_cache = seen_cache[obj] = get_cache(obj, single,
+                                                    cache_name, attr)
+            if to_attr:
+                set_relation(obj, step, obj_cache, to_attr)
+        elif obj in seen_cache:  # case of `seen`
+            obj_cache = seen_cache[obj]
+            set_relation(obj, step, obj_cache, to_attr, instances)
+        elif target and identity.related(target, obj) is not None:
+            # already loaded
+            obj_cache = seen_cache[obj] = [identity.related(target, obj)]
+            set_relation(obj, step, obj_cache, to_attr, instances)
+        else:
+            current.append(obj)
             continue
+        schedule_cached(run, item, obj, obj_cache)
+    seen_hits = len(item.objects) - len(current)
+    cache_hits = 0
+    if current and cache is not None:   # case of cross-request cache
+        cached = cache.get_many(model, attr, current)
+        for obj in current:
+            if id(obj) in cached:
+                obj_cache = map(identity.canonical, cached[id(obj)])
+                if instances is not None and not single:
+                    obj_cache = pack(obj_cache, instances)
+                seen_caches[obj._state.db][obj] = obj_cache
+                set_relation(obj, step, obj_cache, to_attr, instances)
+                schedule_cached(run, item, obj, obj_cache)
+        cache_hits = len(cached)
+        current = [o for o in current if id(o) not in cached]
+        versions = cache_versions.setdefault((model, attr), {})
+        for db in set(o._state.db for o in current):
+            versions.update(cache.get_versions(
+                model, db, [o.pk for o in current if o._state.db == db]))
+    return current, seen_hits, cache_hits
 
 
-        to_discard = set()
-        for e in current: # no need to query for already prefetched data
-            obj = e[1]
-            obj_model = obj.__class__
-            p, d, _, is_fetched = get_prefetcher(obj, attr)
-            cache = None
-            if is_fetched: # case of Django internal cache
-                single, cache_name = get_info(p, d)
-                cache = get_cache(obj, single, cache_name, attr)
-                single, cache_name = get_info(p, d)
-                update_seen(seen, model, attr, single, cache_name, obj, cache)
-                to_discard.add(e)
-            elif (model in seen and  # case of `seen`
-                attr in seen[obj_model] and
-                obj in seen[obj_model][attr]['cache']):
-                single = seen[obj_model][attr]['single']
-                cache_name = seen[obj_model][attr]['cache_name']
-                cache = seen[obj_model][attr]['cache'][obj]
-                to_discard.add(e)
-                set_cache(obj, single, cache, cache_name, attr)
-            if cache is not None and len(cache) != 0:  # if data was cached
-                clipped = clip_lookup(lookup)          # it still must get
-                if clipped:                            # into `buffer`.
-                    update_buffer(buffer, cache, [clipped])
-
-        current -= to_discard
+def fetch_relations(run, relations):
+    """
+    Fetches relations of one level.
 
+    :param relations: list of ``(item, step, prefetcher)``.
+    """
+    scheduler = run.scheduler
+    parts = []
+    part_items = {}
+    cache_versions = {} # (model, attr) -> versions of objects to be fetched
+    hits = {} # id(item) -> (seen hits, cache hits)
+    for item, step, prefetcher in relations:
+        lookup = item.lookup
+        model = item.model
+        if lookup.values_mode or lookup.limited:
+            # rows are not cached anywhere, limited relations are not reused
+            current = list(item.objects)
+        else:
+            current, seen_hits, cache_hits = take_uncached(
+                run, item, step, cache_versions)
+            hits[id(item)] = seen_hits, cache_hits
         if current:
-            prefetch_qs, rel_attr_fn, cur_attr_fn, single, cache_name =       \
-            prefetcher.get_prefetch_query_set(
-                map(itemgetter(1), current)
-            )
+            if lookup.chunk_size is not None:
+                lookup_chunk_size = lookup.chunk_size
+            else:
+                lookup_chunk_size = run.chunk_size
+            key_source = run.key_source(current, lookup_chunk_size)
+            item_parts = get_parts(step, prefetcher, model, current,
+                                   key_source, lookup)
+            for part in item_parts:
+                if part.select is None and key_source is not \
+                   lookup_chunk_size: # part can't be selected by subquery
+                    part = part._replace(
+                        key=part.key[:-1] + (lookup_chunk_size,))
+                parts.append(part)
+                part_items[id(part)] = item
+            if item_parts:
+                continue
+            # nothing to fetch, e.g. all generic foreign keys are empty
+        scheduler.done(item)
+        if run.instrumented and id(item) in hits:
+            report_hits(run, item, hits)
+
+    groups = OrderedDict()
+    for part in parts:
+        groups.setdefault(part.key, []).append(part)
+    for key in groups.keys():
+        # restricted parts are fetched by unrestricted query of the same rows
+        full_key = key[:-2] + (None, key[-1])
+        if (key[-2] is not None and not is_values_mode(key[-2]) and
+            not is_limited(key[-2]) and key[-2].order_by is None and
+            full_key in groups):
+            groups[full_key].extend(groups.pop(key))
+
+    routes = [run.route(group, part_items) for group in groups.itervalues()]
+    results = run.map_groups(groups.values(), routes)
+    for key, group, result in zip(groups.iterkeys(), groups.itervalues(),
+                                  results):
+        if not run.instrumented:
+            set_up_group(run, key, group, result, part_items, cache_versions)
+            continue
+        sql_time, sql, result = result
+        start = time()
+        set_up_group(run, key, group, result, part_items, cache_versions)
+        report_group(run, group, result, part_items, hits, sql_time,
+                     time() - start, sql)
+
+    for item in set(part_items.itervalues()):
+        scheduler.done(item)
+
+
+def set_up_group(run, key, group, result, part_items, cache_versions):
+    """Sets up objects fetched for `group` of parts to their parents."""
+    scheduler, seen, identity, cache = (run.scheduler, run.seen,
+                                        run.identity, run.cache)
+    discovered, rel_attr_fn, cur_attr_fn, additional_lookups = result
+    rel_to_cur = defaultdict(list)
+    if is_values_mode(key[-2]):
+        for val, row in discovered:
+            rel_to_cur[val].append(row)
+        aggregate = AGGREGATES.get(key[-2].aggregate)
+        for part in group:
+            set_rows(part.objects, part.cur_attr_fn or cur_attr_fn,
+                     rel_to_cur, part_items[id(part)].lookup.to_attr,
+                     aggregate)
+        return
+    joins = group_joins(group)
+    for obj in discovered:
+        val = rel_attr_fn(obj)
+        canonical_joins(identity, obj, joins)
+        rel_to_cur[val].append(identity.canonical(obj))
+
+    if additional_lookups and discovered:
+        order = min(part_items[id(part)].order for part in group)
+        scheduler.add(unique_by_id(concat(rel_to_cur.itervalues())),
+                      additional_lookups, order)
+
+    instances = run.instances
+    limited = is_limited(key[-2])
+    packed = {} # key -> packed objects, in compact mode
+    for part in group: # queried data is set up to objects
+        item = part_items[id(part)]
+        step, to_attr = part.step, item.lookup.store_attr
+        # objects of a part are of one database, see `get_parts`
+        seen_cache = get_seen_cache(seen, part.model, step)[
+            head(part.objects)._state.db]
+        part_cur_attr_fn = part.cur_attr_fn or cur_attr_fn
+        compact = instances is not None and not step.single
+        part_discovered = []
+        fetched = []
+        for obj in part.objects:
+            val = part_cur_attr_fn(obj)
+            if compact:
+                if val not in packed:
+                    packed[val] = pack(rel_to_cur.get(val, ()), instances)
+                obj_cache = packed[val]
+            else:
+                obj_cache = rel_to_cur.get(val, [])
+            if not limited:
+                seen_cache[obj] = obj_cache
+            set_relation(obj, step, obj_cache, to_attr, instances)
+            part_discovered.extend(obj_cache)
+            fetched.append((obj, obj_cache))
+        if cache is not None and not limited:
+            cache.set_many(part.model, part.attr, fetched,
+                           cache_versions[part.model, part.attr])
+        if key[0] is fetch_tree:
+            set_up_tree(run, part, rel_to_cur, part_cur_attr_fn)
+        run.schedule_rest(item, part.objects, unique_by_id(part_discovered))
+
+
+def count_hits(run, items, hits):
+    """Sums up hits of `items`, each item is counted once."""
+    seen_hits = cache_hits = 0
+    for item in items:
+        item_seen, item_cache = hits.pop(id(item), (0, 0))
+        seen_hits += item_seen
+        cache_hits += item_cache
+    run.seen_hits += seen_hits
+    run.cache_hits += cache_hits
+    return seen_hits, cache_hits
+
+
+def report_hits(run, item, hits):
+    """Reports relation which was set up for `item` without querying."""
+    seen_hits, cache_hits = count_hits(run, [item], hits)
+    metrics.lookup_fetched(metrics.LookupEvent(
+        [item.lookup.relation_path], None, 0, 0, 0, 0.0, 0.0,
+        seen_hits, cache_hits, []))
 
-            #prefetch lookups from prefetch queries are merged into processing.
-            additional_lookups = getattr(prefetch_qs,
-                                         '_prefetch_related_lookups', [])
 
-            if additional_lookups:
-                setattr(prefetch_qs, '_prefetch_related_lookups', [])
-            discovered = list(prefetch_qs)
-            lookups_for_discovered = additional_lookups
-            clipped_lookup = LOOKUP_SEP.join(lookup.split(LOOKUP_SEP)[1:])
-            if len(clipped_lookup) > 0:
-                lookups_for_discovered = chain([clipped_lookup],
-                                               additional_lookups)
-            if lookups_for_discovered:
-                update_buffer(buffer, discovered, reversed(list(lookups_for_discovered)))
-
-
-            rel_to_cur = defaultdict(list)
-
-            for obj in discovered:
-                val = rel_attr_fn(obj)
-                rel_to_cur[val].append(obj)
-            for pair in current: # queried data is set up to objects
-                obj = pair[1]
-                val = cur_attr_fn(obj)
-                cache = rel_to_cur.get(val, [])
-                update_seen(seen, model, attr, single, cache_name, obj, cache)
-                set_cache(obj, single, cache, cache_name, attr)
\ No newline at end of file
+def report_group(run, group, result, part_items, hits, sql_time,
+                 stitch_time, sql):
+    """Reports query of `group` of parts."""
+    discovered, _, cur_attr_fn, _ = result
+    items = unique_by_id(part_items[id(part)] for part in group)
+    seen_hits, cache_hits = count_hits(run, items, hits)
+    parents = {}
+    keys = set()
+    for part in group:
+        part_cur_attr_fn = part.cur_attr_fn or cur_attr_fn
+        for obj in part.objects:
+            parents[id(obj)] = obj
+            keys.add(part_cur_attr_fn(obj))
+    keys.discard(None)
+    run.fetches += 1
+    run.rows += len(discovered)
+    metrics.lookup_fetched(metrics.LookupEvent(
+        list(OrderedDict.fromkeys(i.lookup.relation_path for i in items)),
+        related_model(head(group)), len(parents),
+        len(keys), len(discovered), sql_time, stitch_time,
+        seen_hits, cache_hits, sql))
@@ -0,0 +1,225 @@
+# coding=utf-8
+"""
+Cache of prefetched relations shared between requests.
+
+Entry of the cache is the list of objects related to one object by one
+relation - it is keyed by ``(model, database, pk, relation attribute)``.
+Empty lists are cached too.
+
+Each entry remembers version tokens of the object and of all related
+objects at the moment it was stored. Tokens are replaced on ``post_save``,
+``post_delete`` and ``m2m_changed`` signals - for the changed object itself
+and for objects it refers to by foreign keys and generic foreign keys
+(because those objects gain or lose related object), so an entry which
+depends on a changed object is never used again.
+Changes that don't send signals (``QuerySet.update()``, raw SQL) are not
+tracked.
+"""
+from uuid import uuid4
+from weakref import WeakSet
+
+from django.contrib.contenttypes.generic import GenericForeignKey
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import get_cache
+from django.db.models import get_model, signals
+from django.db.models.fields.related import ManyToOneRel
+
+from deep_prefetch import model_label
+
+
+DEFAULT_BACKEND = 'django.core.cache.backends.locmem.LocMemCache'
+
+#Caches which must be invalidated on changes.
+caches = WeakSet()
+
+
+def root_model(model):
+    """Model in which row of `model` is stored (top of inheritance chain)."""
+    model = model._meta.concrete_model
+    while model._meta.parents:
+        model = next(iter(model._meta.parents))
+    return model
+
+
+def dump_objects(objects):
+    """Converts model instances to picklable form."""
+    return [(model_label(o.__class__), o._state.db,
+             tuple(getattr(o, f.attname) for f in o._meta.fields))
+            for o in objects]
+
+
+def load_objects(dumped):
+    objects = []
+    for label, db, values in dumped:
+        obj = get_model(*label.split('.'))(*values)
+        obj._state.db = db
+        obj._state.adding = False
+        objects.append(obj)
+    return objects
+
+
+class PrefetchCache(object):
+    """
+    Cache of prefetched relations stored in a Django cache backend.
+
+    :param backend: cache backend object or argument for
+                    :func:`django.core.cache.get_cache`, by default -
+                    separate local-memory cache.
+    :param timeout: timeout of entries, by default - timeout of backend.
+    :param prefix: prefix of keys in backend.
+    """
+
+    def __init__(self, backend=None, timeout=None, prefix='deep_prefetch'):
+        if backend is None:
+            backend = get_cache(DEFAULT_BACKEND, LOCATION=prefix)
+        elif isinstance(backend, basestring):
+            backend = get_cache(backend)
+        self.backend = backend
+        self.timeout = timeout
+        self.prefix = prefix
+        caches.add(self)
+
+    def entry_key(self, model, db, pk, attr):
+        return '%s:entry:%s:%s:%s:%s' % (self.prefix, model_label(model),
+                                         db, pk, attr)
+
+    def version_key(self, model, db, pk):
+        return '%s:version:%s:%s:%s' % (self.prefix,
+                                        model_label(root_model(model)),
+                                        db, pk)
+
+    def get_many(self, model, attr, objects):
+        """
+        :returns: dictionary ``id(obj) -> list of related objects`` for
+                  objects which relation `attr` is cached.
+        """
+        keys = dict((self.entry_key(model, o._state.db, o.pk, attr), o)
+                    for o in objects if o.pk is not None)
+        if not keys:
+            return {}
+        entries = self.backend.get_many(keys.keys())
+        versions = self.backend.get_many(
+            list(set(k for _, deps in entries.itervalues() for k, _ in deps)))
+        result = {}
+        for key, (dumped, deps) in entries.iteritems():
+            if all(versions.get(k) == token for k, token in deps):
+                result[id(keys[key])] = load_objects(dumped)
+        return result
+
+    def get_versions(self, model, db, pks):
+        """
+        Returns current version tokens of objects of database `db`, tokens
+        of objects that don't have one yet are created.
+        """
+        keys = [self.version_key(model, db, pk) for pk in pks]
+        versions = self.backend.get_many(keys)
+        missing = dict((k, uuid4().hex) for k in keys if k not in versions)
+        for key, token in missing.iteritems():
+            if not self.backend.add(key, token, self.timeout):
+                token = self.backend.get(key)
+            versions[key] = token
+        return versions
+
+    def set_many(self, model, attr, pairs, parent_versions=None):
+        """
+        Stores relations.
+
+        :param pairs: list of ``(obj, list of related objects)``.
+        :param parent_versions: version tokens of objects taken before
+                                relations were queried, by default - current.
+        """
+        pairs = [(o, cache) for o, cache in pairs if o.pk is not None]
+        if parent_versions is None:
+            parent_versions = {}
+            for db in set(o._state.db for o, _ in pairs):
+                parent_versions.update(self.get_versions(
+                    model, db, [o.pk for o, _ in pairs if o._state.db == db]))
+        related = set((root_model(r.__class__), r._state.db, r.pk)
+                      for _, cache in pairs for r in cache)
+        related_versions = {}
+        for related_model, db in set((m, db) for m, db, _ in related):
+            related_versions.update(self.get_versions(
+                related_model, db, [pk for m, d, pk in related
+                                    if m is related_model and d == db]))
+        entries = {}
+        for obj, cache in pairs:
+            key = self.version_key(model, obj._state.db, obj.pk)
+            if (parent_versions.get(key) is None or
+                any(r._deferred for r in cache)):
+                continue
+            deps = [(key, parent_versions[key])]
+            for r in cache:
+                r_key = self.version_key(r.__class__, r._state.db, r.pk)
+                deps.append((r_key, related_versions[r_key]))
+            entries[self.entry_key(model, obj._state.db, obj.pk, attr)] = (
+                dump_objects(cache), deps)
+        self.backend.set_many(entries, self.timeout)
+
+    def invalidate(self, db, objects):
+        """
+        Replaces version tokens of `objects` of database `db`.
+
+        :param objects: list of ``(model, pk)``.
+        """
+        self.backend.set_many(
+            dict((self.version_key(model, db, pk), uuid4().hex)
+                 for model, pk in objects if pk is not None),
+            self.timeout)
+
+    def clear(self):
+        self.backend.clear()
+
+
+_default_cache = None
+
+
+def get_default_cache():
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = PrefetchCache()
+    return _default_cache
+
+
+def referred_objects(instance):
+    """``(model, pk)`` of objects referred by `instance` and itself."""
+    objects = [(instance.__class__, instance.pk)]
+    opts = instance._meta
+    for field in opts.fields:
+        if (isinstance(field.rel, ManyToOneRel) and
+            field.rel.get_related_field().primary_key):
+            objects.append((field.rel.to, getattr(instance, field.attname)))
+    for field in opts.virtual_fields:
+        if isinstance(field, GenericForeignKey):
+            ct_id = getattr(instance,
+                            opts.get_field(field.ct_field).get_attname())
+            if ct_id is not None:
+                model = ContentType.objects.get_for_id(ct_id).model_class()
+                if model is not None:
+                    objects.append((model, getattr(instance, field.fk_field)))
+    return objects
+
+
+def invalidate_instance(sender, instance, using, **kwargs):
+    if not caches:
+        return
+    objects = referred_objects(instance)
+    for cache in list(caches):
+        cache.invalidate(using, objects)
+
+
+def invalidate_m2m(sender, instance, action, model, pk_set, using,
+                   **kwargs):
+    if not caches or action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    objects = [(instance.__class__, instance.pk)]
+    objects.extend((model, pk) for pk in pk_set or ())
+    for cache in list(caches):
+        cache.invalidate(using, objects)
+
+
+signals.post_save.connect(invalidate_instance,
+                          dispatch_uid='deep_prefetch_cache_post_save')
+signals.post_delete.connect(invalidate_instance,
+                            dispatch_uid='deep_prefetch_cache_post_delete')
+signals.m2m_changed.connect(invalidate_m2m,
+                            dispatch_uid='deep_prefetch_cache_m2m_changed')
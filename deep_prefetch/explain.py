@@ -0,0 +1,367 @@
+# coding=utf-8
+"""
+Plans of prefetching.
+
+:func:`explain_prefetch` shows relations which
+:func:`deep_prefetch.base.deep_prefetch_related_objects` follows for
+lookups of a queryset - as a tree of :class:`PlanNode`'s, one node per
+relation of one model and model it leads to (so relation through GFK makes
+node per content type)::
+
+    tests.Like: 3 objects
+      content_object [GenericForeignKey] -> tests.Photo: parents ~2, keys ~2, rows ~2
+        comments [GenericRelatedObjectManager] -> tests.Comment: parents ~2, keys ~2, rows ~4
+      content_object [GenericForeignKey] -> tests.BlogPost: parents ~1, keys ~1, rows ~1
+
+Numbers of parent objects, their distinct keys and fetched rows are
+estimated from table statistics by a few ``COUNT`` queries (objects of the
+queryset and their content types are counted exactly), models behind GFK
+of deeper levels are taken from the whole table.
+
+With ``analyze=True`` prefetching is actually done and nodes get events of
+queries that fetched their objects (see
+:class:`deep_prefetch.metrics.LookupEvent`) - with SQL, numbers of parents,
+keys and rows and timings. Query that fetched objects for several nodes
+(coalesced) is shown in each of them.
+"""
+from django.contrib.contenttypes import generic
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections
+from django.db.models import Count
+from django.db.models.fields import related
+from django.db.models.sql.constants import LOOKUP_SEP
+from threading import current_thread
+from time import time
+
+from deep_prefetch import metrics, model_label
+from deep_prefetch.base import (deep_prefetch_related_objects, expand_lookup,
+                                normalize_lookup)
+
+
+class PlanNode(object):
+    """
+    Relation `attr` of `model` which leads to `target` (``None`` if
+    relation is not known - attribute that is not a relation).
+
+    :param lookup: path of the relation from objects of queryset.
+    :param kind: kind of relation - name of Django's class which prefetches
+                 it (like ``'ManyRelatedManager'``) or ``'attribute'``.
+    :param parents: estimated number of parent objects.
+    :param keys: estimated number of distinct keys in the query.
+    :param rows: estimated number of distinct fetched objects, they are
+                 parents of child nodes.
+    """
+
+    def __init__(self, lookup, attr, model, kind, target, single, parents,
+                 keys, rows):
+        self.lookup = lookup
+        self.attr = attr
+        self.model = model
+        self.kind = kind
+        self.target = target
+        self.single = single
+        self.parents = parents
+        self.keys = keys
+        self.rows = rows
+        self.children = []
+        #Events of queries in analyze mode.
+        self.queries = []
+
+    def as_dict(self, queries=None):
+        result = {'lookup': self.lookup, 'attr': self.attr,
+                  'model': model_label(self.model), 'kind': self.kind,
+                  'target': model_label(self.target) if self.target else None,
+                  'single': self.single, 'parents': self.parents,
+                  'keys': self.keys, 'rows': self.rows,
+                  'children': [c.as_dict(queries) for c in self.children]}
+        if queries is not None:
+            result['queries'] = [queries.index(q) for q in self.queries]
+        return result
+
+    def format(self, indent, queries=None):
+        target = model_label(self.target) if self.target else '?'
+        lines = ['%s%s [%s] -> %s: parents ~%s, keys ~%s, rows ~%s' % (
+            '  ' * indent, self.attr, self.kind, target, self.parents,
+            self.keys, self.rows)]
+        for event in self.queries:
+            lines.extend(format_event(event, queries.index(event),
+                                      indent + 2))
+        for child in self.children:
+            lines.extend(child.format(indent + 1, queries))
+        return lines
+
+
+def format_event(event, number, indent):
+    prefix = '  ' * indent
+    if event.model is None:
+        return ['%sno query: %d seen, %d cached' % (
+            prefix, event.seen_hits, event.cache_hits)]
+    lines = ['%s#%d %s: parents %d, keys %d, rows %d, sql %.2f ms, '
+             'stitch %.2f ms, %d seen, %d cached' % (
+                 prefix, number, model_label(event.model), event.parents,
+                 event.keys, event.rows, event.sql_time * 1000,
+                 event.stitch_time * 1000, event.seen_hits,
+                 event.cache_hits)]
+    lines.extend(prefix + '  ' + sql for sql in event.sql)
+    return lines
+
+
+class PrefetchPlan(object):
+    """
+    Plan of prefetching for `objects` (number) of `model`.
+
+    In analyze mode `queries` is the list of events of all queries
+    (and of relations set up without querying), `sql` and `time` belong
+    to the query of objects themselves.
+    """
+
+    def __init__(self, model, objects, nodes, queries=None, sql=None,
+                 time=None):
+        self.model = model
+        self.objects = objects
+        self.nodes = nodes
+        self.queries = queries
+        self.sql = sql
+        self.time = time
+
+    @property
+    def analyzed(self):
+        return self.queries is not None
+
+    def find(self, lookup, target=None):
+        """Nodes of relation path `lookup` (which lead to `target`)."""
+        result = []
+        nodes = list(self.nodes)
+        while nodes:
+            node = nodes.pop(0)
+            if (node.lookup == lookup and
+                (target is None or node.target is target)):
+                result.append(node)
+            nodes.extend(node.children)
+        return result
+
+    def as_dict(self):
+        result = {'model': model_label(self.model), 'objects': self.objects,
+                  'nodes': [n.as_dict(self.queries) for n in self.nodes]}
+        if self.analyzed:
+            result['sql'], result['time'] = self.sql, self.time
+            result['queries'] = [
+                dict(e._asdict(),
+                     model=model_label(e.model) if e.model else None)
+                for e in self.queries]
+        return result
+
+    def __str__(self):
+        lines = ['%s: %s objects' % (model_label(self.model), self.objects)]
+        if self.analyzed:
+            lines[0] += ', %.2f ms' % (self.time * 1000)
+            lines.extend('  ' + sql for sql in self.sql)
+        for node in self.nodes:
+            lines.extend(node.format(1, self.queries))
+        return '\n'.join(lines)
+
+
+class Statistics(object):
+    """Counts of rows used for estimates, each is queried once."""
+
+    def __init__(self):
+        self.counts = {}
+
+    def count(self, key, queryset):
+        if key not in self.counts:
+            self.counts[key] = queryset.count()
+        return self.counts[key]
+
+    def rows(self, model):
+        return self.count(model, model._base_manager.all())
+
+    def fanout(self, model, key, queryset):
+        """Average number of rows of `queryset` per row of `model`."""
+        total = self.rows(model)
+        return float(self.count(key, queryset)) / total if total else 0.0
+
+    def content_types(self, key, queryset, ct_field):
+        """List of ``(model, number of rows)`` by content types."""
+        if key not in self.counts:
+            self.counts[key] = [
+                (ContentType.objects.get_for_id(row[ct_field]).model_class(),
+                 row['rows'])
+                for row in queryset.values(ct_field).order_by()
+                                   .annotate(rows=Count('pk'))
+                if row[ct_field] is not None]
+        return self.counts[key]
+
+
+def estimate_relation(model, attr, parents, stats, queryset=None):
+    """
+    :returns: list of ``(kind, single, target, parents, keys, rows)`` for
+              models relation `attr` of `model` leads to, estimated for
+              `parents` objects (objects of `queryset` if it is given).
+    """
+    descriptor = getattr(model, attr, None)
+    if isinstance(descriptor, generic.GenericForeignKey):
+        source = queryset if queryset is not None else model._base_manager
+        by_ct = stats.content_types((model, attr, queryset is not None),
+                                    source.all(), descriptor.ct_field)
+        total = sum(rows for _, rows in by_ct)
+        result = []
+        for target, rows in by_ct:
+            if target is None:
+                continue
+            if queryset is not None:
+                ct_parents = rows
+            else:
+                ct_parents = int(round(float(parents) * rows / total))
+            keys = min(ct_parents, stats.rows(target))
+            result.append(('GenericForeignKey', True, target, ct_parents,
+                           keys, keys))
+        return result
+    if isinstance(descriptor, related.ReverseSingleRelatedObjectDescriptor):
+        target = descriptor.field.rel.to
+        if queryset is not None:
+            keys = queryset.exclude(**{descriptor.field.attname: None}) \
+                .values(descriptor.field.attname).distinct().count()
+        else:
+            keys = min(parents, stats.rows(target))
+        return [('ReverseSingleRelatedObjectDescriptor', True, target,
+                 parents, keys, keys)]
+    if isinstance(descriptor, related.SingleRelatedObjectDescriptor):
+        target = descriptor.related.model
+        return [('SingleRelatedObjectDescriptor', True, target, parents,
+                 parents, min(parents, stats.rows(target)))]
+    if isinstance(descriptor, related.ForeignRelatedObjectsDescriptor):
+        target = descriptor.related.model
+        name = descriptor.related.field.name
+        fanout = stats.fanout(model, (target, name), target._base_manager
+                              .exclude(**{name: None}))
+        kind = 'RelatedManager'
+    elif isinstance(descriptor, (related.ManyRelatedObjectsDescriptor,
+                                 related.ReverseManyRelatedObjectsDescriptor)):
+        if isinstance(descriptor, related.ManyRelatedObjectsDescriptor):
+            target = descriptor.related.model
+            through = descriptor.related.field.rel.through
+        else:
+            target = descriptor.field.rel.to
+            through = descriptor.field.rel.through
+        fanout = stats.fanout(model, through, through._base_manager.all())
+        kind = 'ManyRelatedManager'
+    elif isinstance(descriptor, generic.ReverseGenericRelatedObjectsDescriptor):
+        field = descriptor.field
+        target = field.rel.to
+        ct = ContentType.objects.get_for_model(model)
+        fanout = stats.fanout(
+            model, (target, field.name, ct.pk), target._base_manager.filter(
+                **{field.content_type_field_name: ct}))
+        kind = 'GenericRelatedObjectManager'
+    elif hasattr(model, attr):
+        return [('attribute', None, None, parents, None, None)]
+    else:
+        return []  # lookup is not valid for the model, it is skipped
+    rows = min(int(round(parents * fanout)), stats.rows(target))
+    return [(kind, False, target, parents, parents, rows)]
+
+
+def plan_nodes(nodes, model, parts, path, parents, stats, queryset=None):
+    """Adds nodes of lookup `parts` to `nodes` (children of one node)."""
+    attr = parts[0]
+    lookup = path + LOOKUP_SEP + attr if path else attr
+    for (kind, single, target, rel_parents, keys,
+         rows) in estimate_relation(model, attr, parents, stats, queryset):
+        node = None
+        for other in nodes:
+            if other.attr == attr and other.target is target:
+                node = other
+        if node is None:
+            node = PlanNode(lookup, attr, model, kind, target, single,
+                            rel_parents, keys, rows)
+            nodes.append(node)
+        if parts[1:] and target is not None:
+            plan_nodes(node.children, target, parts[1:], lookup, rows, stats)
+
+
+def plan(model, lookups, objects, queryset=None):
+    """Estimated :class:`PrefetchPlan` of `lookups` for `objects` number."""
+    stats = Statistics()
+    nodes = []
+    for lookup in map(normalize_lookup, lookups):
+        plan_nodes(nodes, model, expand_lookup(lookup.lookup), '',
+                   objects, stats, queryset)
+    return PrefetchPlan(model, objects, nodes)
+
+
+def without_prefetch(queryset):
+    clone = queryset._clone()
+    clone._prefetch_related_lookups = []
+    return clone
+
+
+class Recorder(metrics.Collector):
+    """
+    Records events of prefetching done by the current thread (events of
+    prefetches made by other threads meanwhile are not of the analyzed one).
+    """
+
+    def __init__(self):
+        self.events = []
+        self.thread = current_thread()
+
+    def lookup_fetched(self, event):
+        if current_thread() is self.thread:
+            self.events.append(event)
+
+
+def analyze_prefetch(queryset):
+    """Evaluates `queryset`, returns :class:`PrefetchPlan` with events."""
+    lookups = queryset._prefetch_related_lookups
+    options = dict(getattr(queryset, '_prefetch_options', {}))
+    # SQL of queries is known only in the calling thread
+    options.pop('parallel', None)
+    queryset = without_prefetch(queryset)
+    debug_cursors = dict((alias, connections[alias].use_debug_cursor)
+                         for alias in connections)
+    recorder = Recorder()
+    try:
+        for alias in connections:
+            connections[alias].use_debug_cursor = True
+        logged = len(connections[queryset.db].queries)
+        start = time()
+        objects = list(queryset)
+        elapsed = time() - start
+        sql = [q['sql'] for q in connections[queryset.db].queries[logged:]]
+        metrics.register_collector(recorder)
+        try:
+            deep_prefetch_related_objects(objects, lookups,
+                                          model=queryset.model,
+                                          source=queryset, **options)
+        finally:
+            metrics.unregister_collector(recorder)
+    finally:
+        for alias, debug_cursor in debug_cursors.iteritems():
+            connections[alias].use_debug_cursor = debug_cursor
+    result = plan(queryset.model, lookups, len(objects), queryset)
+    result.queries, result.sql, result.time = recorder.events, sql, elapsed
+    for event in recorder.events:
+        for lookup in event.lookups:
+            for node in result.find(lookup):
+                if event.model is None or node.target is event.model:
+                    node.queries.append(event)
+    return result
+
+
+def explain_prefetch(queryset, analyze=False):
+    """
+    Returns :class:`PrefetchPlan` of prefetching for `queryset` with its
+    ``prefetch_related`` lookups and ``prefetch_options``.
+
+    :param analyze: whether prefetching is done to get actual queries
+                    (queries are run serially even if ``parallel`` option
+                    is set).
+    """
+    if analyze:
+        return analyze_prefetch(queryset)
+    if queryset._result_cache is not None:
+        objects = len(queryset._result_cache)
+    else:
+        objects = queryset.count()
+    return plan(queryset.model, queryset._prefetch_related_lookups, objects,
+                without_prefetch(queryset))
@@ -0,0 +1,85 @@
+# coding=utf-8
+"""
+Prefetching on first access.
+
+Objects loaded together (by one queryset or one chunk of it) share
+a :class:`PrefetchBatch`. When relation of one of them is accessed for
+the first time and it was not prefetched, it is prefetched for the whole
+batch by :func:`deep_prefetch.base.deep_prefetch_related_objects`, so
+conditional access to relations (in templates, for example) costs one
+query per relation instead of one query per object.
+
+Objects fetched that way form batch too, so following relations further
+(including relations of objects behind generic foreign keys) is batched
+as well.
+
+Relation access is intercepted by hooks of :mod:`deep_prefetch.access`.
+"""
+from collections import OrderedDict
+
+from deep_prefetch import access
+from deep_prefetch.base import (deep_prefetch_related_objects, get_step,
+                                is_loaded, related_to, unique_by_id)
+
+
+class PrefetchBatch(object):
+    """
+    Objects loaded together.
+
+    :param objects: list of model instances.
+    :param options: keyword arguments for
+                    :func:`deep_prefetch_related_objects`.
+    """
+
+    def __init__(self, objects, options=None):
+        self.objects = objects
+        self.options = options or {}
+        self.loaded = set() # names of relations that are already loaded
+
+    def load(self, attr):
+        """Prefetches relation `attr` for objects of the batch."""
+        if attr in self.loaded:
+            return
+        self.loaded.add(attr)
+        by_class = OrderedDict()
+        for obj in self.objects:
+            by_class.setdefault(obj.__class__, []).append(obj)
+        missing = []
+        steps = []
+        for objects in by_class.itervalues():
+            step = get_step(objects[0], attr)
+            if step is None:
+                continue
+            steps.append((step, objects))
+            missing.extend(o for o in objects if not is_loaded(o, step))
+        if missing:
+            deep_prefetch_related_objects(missing, [attr], **self.options)
+        related_objects = []
+        for step, objects in steps:
+            related_objects.extend(o for o in related_to(objects, step)
+                                   if '_prefetch_batch' not in o.__dict__)
+        if related_objects:
+            attach_batch(unique_by_id(related_objects), self.options)
+
+    def __reduce__(self):
+        # siblings are not pickled along with an object
+        return PrefetchBatch, ([],)
+
+
+def attach_batch(objects, options=None):
+    """Makes `objects` one batch, returns it."""
+    batch = PrefetchBatch(objects, options)
+    for obj in objects:
+        obj.__dict__['_prefetch_batch'] = batch
+    return batch
+
+
+def load_batch(instance, attr):
+    batch = instance.__dict__.get('_prefetch_batch')
+    if batch is not None:
+        batch.load(attr)
+
+
+#batch is loaded before other hooks look at the relation
+access.ACCESS_HOOKS.insert(0, load_batch)
+access.MARKERS.append('_prefetch_batch')
@@ -0,0 +1,134 @@
+# coding=utf-8
+"""
+Metrics of prefetching.
+
+:func:`deep_prefetch.base.deep_prefetch_related_objects` reports events to
+signals of :mod:`deep_prefetch.signals` and to registered collectors
+(see :func:`register_collector`). Nothing is measured if there are neither
+receivers nor collectors.
+
+Times are in seconds. "Hits" are parent objects for which relation was
+set up without querying: ``seen_hits`` - from objects fetched earlier in
+the same call (or Django's caches), ``cache_hits`` - from
+:class:`deep_prefetch.cache.PrefetchCache`.
+"""
+from collections import defaultdict, namedtuple
+from threading import Lock
+
+from deep_prefetch import signals
+
+
+#Prefetching of `lookups` for `objects` number of objects of `model`.
+#`duration`, `fetches` (number of prefetch queries, chunked query is counted
+#once), `rows` and hits are ``None`` in event of start.
+RunEvent = namedtuple('RunEvent', 'model lookups objects duration fetches '
+                                  'rows seen_hits cache_hits')
+
+#One prefetch query: `lookups` - paths (from objects of the call) of
+#relations fetched by it, `model` - model of fetched objects, `parents` -
+#number of parent objects and `keys` - number of distinct keys in query,
+#`rows` - number of fetched rows, `sql_time` - time of querying
+#(including instantiation), `stitch_time` - time of setting up fetched
+#objects to parents, hits of parents of the same relations, `sql` - list
+#of executed statements if database connection logs queries (``DEBUG``).
+LookupEvent = namedtuple('LookupEvent', 'lookups model parents keys rows '
+                                        'sql_time stitch_time seen_hits '
+                                        'cache_hits sql')
+
+collectors = []
+
+
+class Collector(object):
+    """Base class of collectors, receives events of prefetching."""
+
+    def run_started(self, event):
+        pass
+
+    def run_finished(self, event):
+        pass
+
+    def lookup_fetched(self, event):
+        pass
+
+
+class MemoryCollector(Collector):
+    """
+    Collector that aggregates events in memory, in the form of
+    statsd counters and timers::
+
+        deep_prefetch.runs                             counter
+        deep_prefetch.run                              timer
+        deep_prefetch.lookup.<lookup>.{fetches,rows,keys,seen_hits,
+                                       cache_hits}    counters
+        deep_prefetch.lookup.<lookup>.{sql,stitch}    timers
+
+    Timers are kept in milliseconds.
+
+    :param prefix: prefix of metric names.
+    """
+
+    def __init__(self, prefix='deep_prefetch'):
+        self.prefix = prefix
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = defaultdict(int)
+            self.timers = defaultdict(list)
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters['%s.%s' % (self.prefix, name)] += value
+
+    def timing(self, name, seconds):
+        with self.lock:
+            self.timers['%s.%s' % (self.prefix, name)].append(seconds * 1000)
+
+    def run_finished(self, event):
+        self.incr('runs')
+        self.timing('run', event.duration)
+
+    def lookup_fetched(self, event):
+        for lookup in event.lookups:
+            name = 'lookup.%s.' % lookup
+            self.incr(name + 'fetches')
+            for counter in ('rows', 'keys', 'seen_hits', 'cache_hits'):
+                self.incr(name + counter, getattr(event, counter))
+            self.timing(name + 'sql', event.sql_time)
+            self.timing(name + 'stitch', event.stitch_time)
+
+
+def register_collector(collector):
+    if collector not in collectors:
+        collectors.append(collector)
+
+
+def unregister_collector(collector):
+    if collector in collectors:
+        collectors.remove(collector)
+
+
+def enabled():
+    """Whether events are received by anybody."""
+    return bool(collectors or signals.prefetch_started.receivers or
+                signals.prefetch_finished.receivers or
+                signals.lookup_fetched.receivers)
+
+
+def run_started(event):
+    signals.prefetch_started.send(sender=event.model, event=event)
+    for collector in list(collectors):
+        collector.run_started(event)
+
+
+def run_finished(event):
+    signals.prefetch_finished.send(sender=event.model, event=event)
+    for collector in list(collectors):
+        collector.run_finished(event)
+
+
+def lookup_fetched(event):
+    signals.lookup_fetched.send(sender=event.model, event=event)
+    for collector in list(collectors):
+        collector.lookup_fetched(event)
@@ -0,0 +1,169 @@
+# coding=utf-8
+"""
+Detection of N+1 queries.
+
+Objects loaded by ``DeepPrefetchQuerySet`` and
+:func:`deep_prefetch.base.deep_prefetch_related_objects` are tracked
+together with the lookup path by which they were reached from the objects
+loaded first (roots). Access to a relation of tracked object that is not
+prefetched makes a query, when that happens for `Detector.threshold`
+objects of the same roots and the same path - it is reported once with
+the lookup which would have prefetched the relation::
+
+    N+1 queries: 'content_object__comments' of tests.Like objects
+    is accessed without prefetching, add prefetch_related('content_object__comments')
+
+Reports are logged to ``deep_prefetch.nplusone`` logger with ``WARNING``
+level or passed to `Detector.callback`.
+
+Detection is on if ``DEEP_PREFETCH_DETECT_N_PLUS_ONE`` setting is true,
+by default - if ``DEBUG`` is true.
+"""
+from collections import namedtuple
+import logging
+
+from django.conf import settings
+from django.db.models.sql.constants import LOOKUP_SEP
+
+from deep_prefetch import access, model_label
+
+
+logger = logging.getLogger('deep_prefetch.nplusone')
+
+#Report of N+1 queries: model of roots, model of object which relation
+#is accessed, lookup from roots which must be prefetched and number of
+#objects which relation was queried so far.
+NPlusOne = namedtuple('NPlusOne', 'root_model model lookup count')
+
+
+class Detector(object):
+    """
+    :param enabled: whether detection is on, by default - see module
+                    documentation.
+    :param callback: function that receives :class:`NPlusOne`, by default
+                     reports are logged.
+    :param threshold: number of distinct objects reached by one relation
+                      path of the same roots which relation is queried
+                      that is reported.
+    """
+
+    def __init__(self, enabled=None, callback=None, threshold=2):
+        self._enabled = enabled
+        self.callback = callback
+        self.threshold = threshold
+
+    @property
+    def enabled(self):
+        if self._enabled is not None:
+            return self._enabled
+        return getattr(settings, 'DEEP_PREFETCH_DETECT_N_PLUS_ONE',
+                       settings.DEBUG)
+
+    @enabled.setter
+    def enabled(self, value):
+        self._enabled = value
+
+    def report(self, n_plus_one):
+        if self.callback is not None:
+            self.callback(n_plus_one)
+        else:
+            logger.warning(
+                "N+1 queries: '%s' of %s objects is accessed without "
+                "prefetching, add prefetch_related('%s')",
+                n_plus_one.lookup, model_label(n_plus_one.root_model),
+                n_plus_one.lookup)
+
+
+detector = Detector()
+
+
+class Tracking(object):
+    """
+    Roots loaded together, counts objects reached from them which relations
+    are queried (repeated queries of one object are not N+1).
+    """
+
+    __slots__ = ('root_model', 'queried')
+
+    def __init__(self, root_model):
+        self.root_model = root_model
+        self.queried = {} # lookup -> ids of objects which relation is queried
+
+    def query(self, instance, lookup):
+        queried = self.queried.setdefault(lookup, set())
+        if id(instance) in queried:
+            return
+        queried.add(id(instance))
+        if len(queried) == detector.threshold:
+            detector.report(NPlusOne(self.root_model, instance.__class__,
+                                     lookup, len(queried)))
+
+    def __reduce__(self):
+        # tracking is not pickled along with an object (queries of the
+        # original roots would go to caches), unpickled object is untracked
+        return untracked, ()
+
+
+def untracked():
+    return None
+
+
+def mark(obj, tracking, path):
+    """Tracks `obj` reached by `path`, unless it is tracked already."""
+    marked = obj.__dict__.get('_prefetch_track')
+    if marked is None or marked[0] is None:
+        obj.__dict__['_prefetch_track'] = tracking, path
+
+
+def track(objects):
+    """Starts tracking of `objects` as roots, if detection is on."""
+    if not objects or not detector.enabled:
+        return
+    tracking = Tracking(objects[0].__class__)
+    for obj in objects:
+        mark(obj, tracking, None)
+
+
+def track_iterator(iterator):
+    """Tracks objects of `iterator` as roots, if detection is on."""
+    if not detector.enabled:
+        return iterator
+    return _track_iterator(iterator)
+
+
+def _track_iterator(iterator):
+    tracking = None
+    for obj in iterator:
+        if tracking is None:
+            tracking = Tracking(obj.__class__)
+        mark(obj, tracking, None)
+        yield obj
+
+
+def check_access(instance, attr):
+    """
+    Counts `instance` if relation `attr` of it is not loaded,
+    otherwise tracks related objects.
+    """
+    from deep_prefetch.base import get_step, is_loaded, related_to
+    tracking, path = instance.__dict__['_prefetch_track']
+    step = get_step(instance, attr)
+    if step is None:
+        return
+    lookup = path + LOOKUP_SEP + attr if path else attr
+    if is_loaded(instance, step):
+        for obj in related_to([instance], step):
+            mark(obj, tracking, lookup)
+    elif not (step.target and step.target(instance)[1] is None):
+        # relation which refers to nothing needs no query
+        tracking.query(instance, lookup)
+
+
+def on_access(instance, attr):
+    marked = instance.__dict__.get('_prefetch_track')
+    if marked is not None and marked[0] is not None:
+        check_access(instance, attr)
+
+
+access.ACCESS_HOOKS.append(on_access)
+access.MARKERS.append('_prefetch_track')
@@ -0,0 +1,224 @@
+# coding=utf-8
+"""
+Thread pool used to run independent prefetch queries in parallel.
+
+Django database connections are thread-local, so each worker thread
+opens its own connections for the aliases it queries and closes them when
+the pool is closed. Pools of parallel queries (see :func:`get_query_pool`)
+are kept between prefetches, so their connections are reused; transactions
+opened by a task are ended after it, so workers don't keep snapshots or
+locks between prefetches. Workers don't see uncommitted changes made by
+connections of the calling thread.
+
+Non-blocking calls are run by another pool (see :func:`get_default_pool`),
+so they can wait for queries of their own without taking all workers.
+"""
+import sys
+from collections import OrderedDict
+from Queue import Queue
+from threading import Thread, Event, Lock
+
+from django.db import connections
+
+
+#Number of threads of the pool used by non-blocking API by default.
+DEFAULT_WORKERS = 4
+
+_default_pool = None
+_default_pool_lock = Lock()
+
+#Number of pools of parallel queries of different sizes kept alive.
+MAX_QUERY_POOLS = 4
+
+_query_pools = OrderedDict() # size -> pool, the least recently used first
+_query_pools_lock = Lock()
+
+
+class TimeoutError(Exception):
+    pass
+
+
+def get_default_pool():
+    """Pool that is shared by non-blocking calls made without executor."""
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = ThreadPool(DEFAULT_WORKERS)
+        return _default_pool
+
+
+def get_query_pool(size):
+    """
+    Pool of `size` workers that is shared by prefetches run with
+    ``parallel=size``, created on first use. Only :data:`MAX_QUERY_POOLS`
+    recently used pools are kept, others are closed.
+    """
+    with _query_pools_lock:
+        pool = _query_pools.pop(size, None)
+        if pool is None:
+            pool = ThreadPool(size)
+        _query_pools[size] = pool
+        while len(_query_pools) > MAX_QUERY_POOLS:
+            _, unused = _query_pools.popitem(last=False)
+            unused.close(wait=False)
+        return pool
+
+
+def close_connections():
+    """
+    Closes connections of the current thread.
+
+    Connections which are shared between threads are not owned by the
+    thread and are left open.
+    """
+    for connection in connections.all():
+        if not connection.allow_thread_sharing:
+            connection.close()
+
+
+def end_transactions():
+    """
+    Rolls back transactions of connections of the current thread which are
+    not in managed transaction mode, connections which can't do it (lost
+    ones, for example) are closed to be reopened by the next query.
+    """
+    for connection in connections.all():
+        if connection.allow_thread_sharing:
+            continue
+        try:
+            connection.rollback_unless_managed()
+        except Exception: # errors of lost connections are backend-specific
+            try:
+                connection.close()
+            except Exception:
+                connection.connection = None
+
+
+def run_detached(func, *args, **kwargs):
+    """
+    Calls `func` and closes connections of the current thread after it,
+    for calls made outside of request-response cycle.
+    """
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_connections()
+
+
+class Task(object):
+    """
+    Call of function made by worker thread.
+
+    Implements subset of :class:`concurrent.futures.Future` interface.
+    """
+
+    def __init__(self, func, args, kwargs=None):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+        self._result = None
+        self.exc_info = None
+        self.finished = Event()
+        self.callbacks = []
+        self.lock = Lock()
+
+    def run(self):
+        try:
+            self._result = self.func(*self.args, **self.kwargs)
+        except Exception:
+            self.exc_info = sys.exc_info()
+        finally:
+            with self.lock:
+                self.finished.set()
+                callbacks, self.callbacks = self.callbacks, []
+            for callback in callbacks:
+                callback(self)
+
+    def done(self):
+        return self.finished.is_set()
+
+    def add_done_callback(self, callback):
+        """Calls `callback` with the task when it is finished."""
+        with self.lock:
+            if not self.finished.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def exception(self, timeout=None):
+        if not self.finished.wait(timeout):
+            raise TimeoutError
+        return self.exc_info[1] if self.exc_info is not None else None
+
+    def result(self, timeout=None):
+        if not self.finished.wait(timeout):
+            raise TimeoutError
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self._result
+
+
+class ThreadPool(object):
+    """Bounded pool of worker threads."""
+
+    def __init__(self, size):
+        self.tasks = Queue()
+        self.lock = Lock()
+        self.closed = False
+        self.threads = [Thread(target=self._work) for _ in xrange(size)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, func, *args, **kwargs):
+        """Schedules call of `func`, returns :class:`Task`."""
+        task = Task(func, args, kwargs)
+        if not self._put([task]):
+            raise RuntimeError('Pool is closed.')
+        return task
+
+    def map(self, func, args_list):
+        """
+        Calls `func` with each of `args_list` in worker threads.
+
+        :returns: list of results in order of `args_list`, first exception
+                  (in that order) is re-raised.
+        """
+        tasks = [Task(func, args) for args in args_list]
+        if not self._put(tasks): # closed meanwhile, calls are made here
+            for task in tasks:
+                task.run()
+        return [task.result() for task in tasks]
+
+    def close(self, wait=True):
+        """
+        Stops workers after tasks already submitted, with `wait` - waits
+        for them.
+        """
+        with self.lock:
+            self.closed = True
+            for _ in self.threads:
+                self.tasks.put(None)
+        if wait:
+            for thread in self.threads:
+                thread.join()
+
+    def _put(self, tasks):
+        """Queues `tasks`, ``False`` if the pool is closed."""
+        with self.lock:
+            if self.closed:
+                return False
+            for task in tasks:
+                self.tasks.put(task)
+            return True
+
+    def _work(self):
+        try:
+            while True:
+                task = self.tasks.get()
+                if task is None:
+                    break
+                task.run()
+                end_transactions()
+        finally:
+            close_connections()
@@ -0,0 +1,166 @@
+# coding=utf-8
+"""
+Routing of prefetch queries to read replicas.
+
+:class:`ReplicaPolicy` is passed to
+:func:`deep_prefetch.base.deep_prefetch_related_objects` as ``routing``
+option. Each prefetch query is routed separately, by model it fetches and
+by lookups it serves, objects fetched from replicas are marked as loaded
+from the primary database - relations accessed and saves made through them
+go where they would go without routing.
+
+Read-your-writes: after the thread has written to the primary database
+(objects were saved or deleted, many-to-many relations were changed) its
+prefetch queries are not routed to replicas until the end of the request
+(or until :func:`reset`), so it doesn't read data which replicas have not
+received yet. Changes that don't send signals (``QuerySet.update()``, raw
+SQL) are not tracked - :func:`pin` marks them. Non-blocking prefetching
+runs with pins of the thread that started it (see :func:`run_pinned`).
+"""
+from contextlib import contextmanager
+from itertools import count
+from threading import local, Lock
+
+from django.core.signals import request_started, request_finished
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import signals
+from django.db.models.sql.constants import LOOKUP_SEP
+
+from deep_prefetch import model_label
+
+
+_state = local()
+
+
+def written():
+    """Aliases of databases written by the current thread."""
+    try:
+        return _state.written
+    except AttributeError:
+        _state.written = set()
+        return _state.written
+
+
+def pin(using=DEFAULT_DB_ALIAS):
+    """Makes the current thread read from `using` instead of replicas."""
+    written().add(using)
+
+
+def is_pinned(using=DEFAULT_DB_ALIAS):
+    return using in written()
+
+
+def reset(**kwargs):
+    """Forgets writes of the current thread, replicas are used again."""
+    written().clear()
+
+
+def pinned():
+    """Aliases the current thread reads from instead of replicas."""
+    return frozenset(written())
+
+
+@contextmanager
+def pinned_as(aliases):
+    """
+    Makes the current thread read from `aliases` (taken by :func:`pinned`
+    in another thread) instead of replicas while the block runs.
+    """
+    previous = set(written())
+    written().update(aliases)
+    try:
+        yield
+    finally:
+        written().clear()
+        written().update(previous)
+
+
+def run_pinned(aliases, func, *args, **kwargs):
+    """Calls `func` in the current thread with pins `aliases`."""
+    with pinned_as(aliases):
+        return func(*args, **kwargs)
+
+
+class ReplicaPolicy(object):
+    """
+    Policy that sends prefetch queries to read replicas of a database.
+
+    :param replicas: aliases of replica databases, they are used in turn.
+    :param primary: alias of the database replicas copy, queries for
+                    objects of other databases are not routed.
+    :param models: models (classes or ``'app_label.ModelName'``) which
+                   objects are fetched from replicas, ``None`` - all models.
+    :param lookups: lookups which queries are made on replicas - a query
+                    is routed if each relation it fetches is one of them or
+                    is reached through one of them (``'content_object'``
+                    covers ``'content_object__comments'``), ``None`` - all
+                    lookups.
+    :param sticky: whether the primary database is used after the thread
+                   has written to it.
+    """
+
+    def __init__(self, replicas, primary=DEFAULT_DB_ALIAS, models=None,
+                 lookups=None, sticky=True):
+        if not replicas:
+            raise ValueError('At least one replica must be given.')
+        self.replicas = list(replicas)
+        self.primary = primary
+        if models is None:
+            self.models = None
+        else:
+            self.models = frozenset(
+                (m if isinstance(m, basestring) else model_label(m)).lower()
+                for m in models)
+        self.lookups = None if lookups is None else tuple(lookups)
+        self.sticky = sticky
+        self._counter = count()
+        self._lock = Lock()
+
+    def covers(self, path):
+        """Whether relation at lookup `path` is fetched from replicas."""
+        if self.lookups is None:
+            return True
+        return any(path == lookup or path.startswith(lookup + LOOKUP_SEP)
+                   for lookup in self.lookups)
+
+    def next_replica(self):
+        with self._lock:
+            return self.replicas[next(self._counter) % len(self.replicas)]
+
+    def db_for_prefetch(self, model, paths, db):
+        """
+        Alias of the database for query that fetches objects of `model`
+        for relations at lookup `paths`, `db` - database which would be
+        used without routing.
+        """
+        if db != self.primary:
+            return db
+        if self.sticky and is_pinned(db):
+            return db
+        if (self.models is not None and
+            model_label(model).lower() not in self.models):
+            return db
+        if not all(self.covers(path) for path in paths):
+            return db
+        return self.next_replica()
+
+
+def on_write(sender, using=DEFAULT_DB_ALIAS, **kwargs):
+    pin(using)
+
+
+def on_m2m_changed(sender, action, using=DEFAULT_DB_ALIAS, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        pin(using)
+
+
+signals.post_save.connect(on_write,
+                          dispatch_uid='deep_prefetch_routing_post_save')
+signals.post_delete.connect(on_write,
+                            dispatch_uid='deep_prefetch_routing_post_delete')
+signals.m2m_changed.connect(on_m2m_changed,
+                            dispatch_uid='deep_prefetch_routing_m2m_changed')
+request_started.connect(reset,
+                        dispatch_uid='deep_prefetch_routing_request_started')
+request_finished.connect(reset,
+                         dispatch_uid='deep_prefetch_routing_request_finished')
@@ -0,0 +1,17 @@
+# coding=utf-8
+"""
+Signals sent by :func:`deep_prefetch.base.deep_prefetch_related_objects`,
+``event`` argument is one of events of :mod:`deep_prefetch.metrics`.
+"""
+from django.dispatch import Signal
+
+
+#Sent before prefetching, `event` is `RunEvent` without results.
+prefetch_started = Signal(providing_args=['event'])
+
+#Sent after prefetching, `event` is `RunEvent`.
+prefetch_finished = Signal(providing_args=['event'])
+
+#Sent after objects fetched by one query (possibly chunked) are set up to
+#their parents, `event` is `LookupEvent`.
+lookup_fetched = Signal(providing_args=['event'])
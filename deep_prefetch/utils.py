@@ -1,39 +1,176 @@
 # coding=utf-8
 from django.db.models import Manager
-from django.db.models.query import QuerySet
-from deep_prefetch.base import deep_prefetch_related_objects
+from django.db.models.query import QuerySet, ValuesQuerySet
+from deep_prefetch.base import (deep_prefetch_related_objects, DeepPrefetch,
+                                chunks)
+from deep_prefetch import routing
+from deep_prefetch.access import install
+from deep_prefetch.explain import explain_prefetch as _explain_prefetch
+from deep_prefetch.lazy import attach_batch
+from deep_prefetch.nplusone import track_iterator
+from deep_prefetch.parallel import get_default_pool, run_detached
+
+
+install()
 
 
 def _prefetch_related_objects(self):
     # This method can only be called once the result cache has been filled.
     deep_prefetch_related_objects(self._result_cache,
-                                  self._prefetch_related_lookups)
+                                  self._prefetch_related_lookups,
+                                  model=self.model, source=self,
+                                  **getattr(self, '_prefetch_options', {}))
     self._prefetch_done = True
 
+
+def prefetch_options(self, **options):
+    """
+    Returns a new QuerySet instance that will pass `options` as keyword
+    arguments to :func:`deep_prefetch_related_objects`, e.g.
+    ``.prefetch_options(chunk_size=500)``.
+
+    When called more than once, options are updated.
+    """
+    clone = self._clone()
+    clone._prefetch_options = dict(clone._prefetch_options, **options)
+    return clone
+
+
+def lazy_prefetch(self, enabled=True):
+    """
+    Returns a new QuerySet instance which objects prefetch relations
+    on first access: relation that is accessed on one of objects is
+    prefetched for all objects of QuerySet (for all objects of the chunk
+    if iterated by :meth:`iterator` with `chunk_size`), with options
+    set by :meth:`prefetch_options` (see :mod:`deep_prefetch.lazy`).
+    """
+    return self._clone(_lazy_prefetch=enabled)
+
+
+def aevaluate(self, executor=None):
+    """
+    Evaluates QuerySet (including prefetching) without blocking.
+
+    QuerySet is evaluated in a thread of `executor`
+    (see :func:`deep_prefetch.base.adeep_prefetch_related_objects`).
+
+    :returns: future which result is list of objects.
+    """
+    executor = executor or get_default_pool()
+    return executor.submit(run_detached, routing.run_pinned,
+                           routing.pinned(), list, self)
+
+
+def explain_prefetch(self, analyze=False):
+    """
+    Returns plan of prefetching of lookups for this QuerySet
+    (see :mod:`deep_prefetch.explain`), with `analyze` - QuerySet is
+    evaluated and plan contains actual queries.
+    """
+    return _explain_prefetch(self, analyze)
+
+
+def iterator(self, chunk_size=None):
+    """
+    Iterates over results without filling result cache.
+
+    If `chunk_size` is given, objects are taken from database by chunks
+    of `chunk_size` objects and prefetching is done for each chunk before
+    its objects are yielded, so memory used by prefetched relations is
+    bounded by chunk size. Rows of the QuerySet itself are read by one
+    query, as in :meth:`django.db.models.query.QuerySet.iterator` - with
+    client-side cursors (psycopg2, MySQLdb by default) the driver holds all
+    of them in memory anyway.
+    Otherwise no prefetching is done, like in
+    :meth:`django.db.models.query.QuerySet.iterator`.
+    """
+    iterator = super(DeepPrefetchQuerySetMixin, self).iterator()
+    if not isinstance(self, ValuesQuerySet):
+        iterator = track_iterator(iterator)
+    lazy = self._lazy_prefetch and not isinstance(self, ValuesQuerySet)
+    if chunk_size is None:
+        if lazy:
+            return iter(attach_batch(list(iterator),
+                                     self._prefetch_options).objects)
+        return iterator
+    if not self._prefetch_related_lookups and not lazy:
+        return iterator
+    return _prefetched_chunks(iterator, chunk_size,
+                              self._prefetch_related_lookups,
+                              dict(self._prefetch_options, model=self.model),
+                              lazy)
+
+
+def _prefetched_chunks(iterator, chunk_size, lookups, options, lazy=False):
+    for chunk in chunks(iterator, chunk_size):
+        if lookups:
+            deep_prefetch_related_objects(chunk, lookups, **options)
+        if lazy:
+            attach_batch(chunk, options)
+        for obj in chunk:
+            yield obj
+
+
+def values(self, *fields):
+    """
+    Like :meth:`django.db.models.query.QuerySet.values`, but lookups of
+    ``prefetch_related`` are prefetched for dictionaries
+    (see :func:`deep_prefetch.base.deep_prefetch_related_objects`).
+    """
+    return self._clone(klass=DeepPrefetchValuesQuerySet, setup=True,
+                       _fields=fields)
+
+
+def _clone(self, klass=None, setup=False, **kwargs):
+    kwargs.setdefault('_prefetch_options', dict(self._prefetch_options))
+    kwargs.setdefault('_lazy_prefetch', self._lazy_prefetch)
+    return super(DeepPrefetchQuerySetMixin, self)._clone(klass, setup,
+                                                         **kwargs)
+
+
 class DeepPrefetchQuerySetMixin(object):
-    pass
+    _prefetch_options = {}
+    _lazy_prefetch = False
 
 DeepPrefetchQuerySetMixin._prefetch_related_objects = _prefetch_related_objects
-
-class DeepPrefetchQuerySet(QuerySet):
+DeepPrefetchQuerySetMixin.prefetch_options = prefetch_options
+DeepPrefetchQuerySetMixin.lazy_prefetch = lazy_prefetch
+DeepPrefetchQuerySetMixin.aevaluate = aevaluate
+DeepPrefetchQuerySetMixin.explain_prefetch = explain_prefetch
+DeepPrefetchQuerySetMixin.iterator = iterator
+DeepPrefetchQuerySetMixin.values = values
+DeepPrefetchQuerySetMixin._clone = _clone
+
+class DeepPrefetchQuerySet(DeepPrefetchQuerySetMixin, QuerySet):
     pass
 
-DeepPrefetchQuerySet._prefetch_related_objects = _prefetch_related_objects
+class DeepPrefetchValuesQuerySet(DeepPrefetchQuerySetMixin, ValuesQuerySet):
+    pass
 
 
 def get_query_set(self):
     return DeepPrefetchQuerySet(self.model, using=self.db)
 
 
+def manager_prefetch_options(self, **options):
+    return self.get_query_set().prefetch_options(**options)
+
+
+def manager_lazy_prefetch(self, enabled=True):
+    return self.get_query_set().lazy_prefetch(enabled)
+
+
 class DeepPrefetchManagerMixin(object):
     pass
 
 
 DeepPrefetchManagerMixin.get_query_set = get_query_set
+DeepPrefetchManagerMixin.prefetch_options = manager_prefetch_options
+DeepPrefetchManagerMixin.lazy_prefetch = manager_lazy_prefetch
 
 class DeepPrefetchManager(Manager):
     pass
 
 DeepPrefetchManager.get_query_set = get_query_set
-
-
+DeepPrefetchManager.prefetch_options = manager_prefetch_options
+DeepPrefetchManager.lazy_prefetch = manager_lazy_prefetch
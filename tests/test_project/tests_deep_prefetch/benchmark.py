@@ -0,0 +1,314 @@
+# coding=utf-8
+"""
+Benchmark of :func:`deep_prefetch.base.deep_prefetch_related_objects`
+against Django's ``prefetch_related_objects``.
+
+Each scenario is a graph of test models reached from ``Like`` objects::
+
+    Like -content_object-> Photo, BlogPost, User, Comment
+         -comments-> Comment -user_set-> User -photos-> Photo
+
+`depth` is the number of relations in the prefetched lookup, `fanout` -
+number of related objects of each object per relation, `content_types` -
+number of models referred by likes, `overlap` - share of objects that are
+related to more than one parent (``0`` - tree, close to ``1`` - all
+parents share the same objects).
+
+Django follows relation of objects behind GFK as if all of them were of
+the model of the first one, so native prefetching is measured only if
+likes refer to one model or the lookup ends at the GFK.
+"""
+from collections import OrderedDict
+from datetime import datetime
+import gc
+import json
+import os
+import platform
+import resource
+from itertools import cycle, islice, product
+from time import time
+
+import django
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models.query import prefetch_related_objects
+
+import deep_prefetch
+from deep_prefetch.base import deep_prefetch_related_objects
+
+from .models import Like, Comment, Photo, User, BlogPost
+
+
+LOOKUPS = ['content_object', 'content_object__comments',
+           'content_object__comments__user_set',
+           'content_object__comments__user_set__photos']
+
+#Models referred by likes, only the first two have ``comments`` relation.
+TARGETS = [Photo, BlogPost, User, Comment]
+
+IMPLEMENTATIONS = OrderedDict([
+    ('deep', deep_prefetch_related_objects),
+    ('native', prefetch_related_objects),
+])
+
+
+class Scenario(object):
+    """Parameters of generated graph."""
+
+    def __init__(self, roots=100, fanout=3, depth=2, content_types=2,
+                 overlap=0.0):
+        if not 1 <= depth <= len(LOOKUPS):
+            raise ValueError('depth must be from 1 to %d.' % len(LOOKUPS))
+        if not 1 <= content_types <= len(TARGETS):
+            raise ValueError('content_types must be from 1 to %d.'
+                             % len(TARGETS))
+        if not 0 <= overlap < 1:
+            raise ValueError('overlap must be in [0, 1).')
+        self.roots = roots
+        self.fanout = fanout
+        self.depth = depth
+        self.content_types = content_types
+        self.overlap = overlap
+
+    @property
+    def lookup(self):
+        return LOOKUPS[self.depth - 1]
+
+    @property
+    def strict(self):
+        """Whether lookup can be prefetched by Django."""
+        return self.depth == 1 or self.content_types == 1
+
+    def as_dict(self):
+        return OrderedDict([('roots', self.roots), ('fanout', self.fanout),
+                            ('depth', self.depth),
+                            ('content_types', self.content_types),
+                            ('overlap', self.overlap),
+                            ('lookup', self.lookup)])
+
+
+def pool_size(parents, fanout, overlap):
+    """Number of distinct objects related to `parents`."""
+    return max(fanout, int(round(parents * fanout * (1 - overlap))))
+
+
+def take(pool, start, count):
+    """`count` objects of `pool` starting from `start`, wrapping around."""
+    return list(islice(cycle(pool), start % len(pool),
+                       start % len(pool) + count))
+
+
+def clear():
+    """Deletes all rows of test models."""
+    tables = set()
+    for model in (Like, Comment, Photo, User, BlogPost):
+        tables.add(model._meta.db_table)
+        tables.update(f.m2m_db_table() for f in model._meta.many_to_many)
+    cursor = connection.cursor()
+    for sql in connection.ops.sql_flush(no_style(), tables, []):
+        cursor.execute(sql)
+    transaction.commit_unless_managed()
+
+
+def generate(scenario):
+    """Fills database with graph of `scenario`."""
+    clear()
+    fanout, overlap = scenario.fanout, scenario.overlap
+    author = User.objects.create(username='author')
+    targets = []
+    count = pool_size(scenario.roots, 1, overlap)
+    for i, model in enumerate(TARGETS[:scenario.content_types]):
+        number = len(range(i, count, scenario.content_types))
+        if model is Comment:
+            ct = ContentType.objects.get_for_model(User)
+            objects = [Comment(content_type=ct, object_id=author.pk)
+                       for _ in xrange(number)]
+        elif model is User:
+            objects = [User(username='user') for _ in xrange(number)]
+        elif model is BlogPost:
+            objects = [BlogPost(name='post', author=author)
+                       for _ in xrange(number)]
+        else:
+            objects = [Photo(name='photo') for _ in xrange(number)]
+        model.objects.bulk_create(objects)
+        targets.extend(
+            (model, pk) for pk in model.objects.values_list('pk', flat=True))
+    Like.objects.bulk_create(
+        Like(content_type=ContentType.objects.get_for_model(model),
+             object_id=pk)
+        for model, pk in islice(cycle(targets), scenario.roots))
+
+    if scenario.depth < 2:
+        return
+    parents = [(m, pk) for m, pk in targets if m in (Photo, BlogPost)]
+    count = pool_size(len(parents), fanout, overlap)
+    comments = []
+    for model, pk in islice(cycle(parents), count):
+        comments.append(Comment(
+            content_type=ContentType.objects.get_for_model(model),
+            object_id=pk))
+    Comment.objects.bulk_create(comments)
+    comments = list(Comment.objects.filter(content_type__in=[
+        ContentType.objects.get_for_model(m) for m in (Photo, BlogPost)])
+        .values_list('pk', flat=True))
+
+    if scenario.depth < 3:
+        return
+    count = pool_size(len(comments), fanout, overlap)
+    User.objects.bulk_create(User(username='commenter')
+                             for _ in xrange(count))
+    users = list(User.objects.filter(username='commenter')
+                 .values_list('pk', flat=True))
+    through = User.comments.through
+    through.objects.bulk_create(
+        through(comment_id=comment, user_id=user)
+        for i, comment in enumerate(comments)
+        for user in take(users, i * fanout, fanout))
+
+    if scenario.depth < 4:
+        return
+    count = pool_size(len(users), fanout, overlap)
+    Photo.objects.bulk_create(Photo(name='tagged') for _ in xrange(count))
+    photos = list(Photo.objects.filter(name='tagged')
+                  .values_list('pk', flat=True))
+    through = User.photos.through
+    through.objects.bulk_create(
+        through(user_id=user, photo_id=photo)
+        for i, user in enumerate(users)
+        for photo in take(photos, i * fanout, fanout))
+
+
+def count_objects(objects, lookup):
+    """Number of distinct instances reached from `objects` by `lookup`."""
+    seen = dict((id(o), o) for o in objects)
+    level = objects
+    for attr in lookup.split('__'):
+        related = []
+        for obj in level:
+            value = getattr(obj, attr, None)
+            if hasattr(value, 'all'):
+                related.extend(value.all())
+            elif value is not None:
+                related.append(value)
+        level = [o for o in related if id(o) not in seen]
+        seen.update((id(o), o) for o in level)
+    return len(seen)
+
+
+def measure_once(prefetch, lookup):
+    """Returns ``(seconds, number of queries, objects)`` of one prefetch."""
+    roots = list(Like.objects.all())
+    queries = len(connection.queries)
+    start = time()
+    prefetch(roots, [lookup])
+    elapsed = time() - start
+    return elapsed, len(connection.queries) - queries, roots
+
+
+def peak_memory(prefetch, lookup):
+    """
+    Growth of peak resident memory (bytes) of process caused by
+    prefetching, measured in a forked process if possible.
+    It is coarse - allocator reuses memory freed before.
+    """
+    def measure():
+        gc.collect()
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        objects = measure_once(prefetch, lookup)[2]
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        del objects
+        # kilobytes on Linux, bytes on OS X
+        unit = 1 if platform.system() == 'Darwin' else 1024
+        return (after - before) * unit
+
+    if not hasattr(os, 'fork'):
+        return measure()
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:  # pragma: no cover
+        try:
+            os.close(read_fd)
+            os.write(write_fd, str(measure()))
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as result:
+        value = result.read()
+    os.waitpid(pid, 0)
+    return int(value) if value else None
+
+
+def run_scenario(scenario, repeat=5, implementations=None, memory=True):
+    """Measures `scenario`, returns list of results per implementation."""
+    generate(scenario)
+    results = []
+    for name in implementations or IMPLEMENTATIONS:
+        result = OrderedDict([('scenario', scenario.as_dict()),
+                              ('implementation', name)])
+        results.append(result)
+        if name == 'native' and not scenario.strict:
+            result['skipped'] = 'lookup is not supported by Django'
+            continue
+        prefetch = IMPLEMENTATIONS[name]
+        times = []
+        for _ in xrange(repeat):
+            elapsed, queries, objects = measure_once(prefetch,
+                                                     scenario.lookup)
+            times.append(elapsed)
+        times.sort()
+        number = count_objects(objects, scenario.lookup)
+        result.update([
+            ('queries', queries),
+            ('objects', number),
+            ('time_min', times[0]),
+            ('time_median', times[len(times) // 2]),
+            ('time_per_object', times[len(times) // 2] / number),
+        ])
+        if memory:
+            peak = peak_memory(prefetch, scenario.lookup)
+            result['peak_memory'] = peak
+            result['memory_per_object'] = (
+                float(peak) / number if peak is not None else None)
+    return results
+
+
+def run_benchmark(scenarios, repeat=5, implementations=None, memory=True):
+    """
+    Runs `scenarios`, returns dictionary that can be dumped to JSON.
+
+    Times are in seconds, memory - in bytes, ``objects`` is the number of
+    distinct instances reached by the lookup (Django makes separate
+    instance of the same row for each parent).
+    """
+    debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True  # queries are counted
+    try:
+        results = []
+        for scenario in scenarios:
+            results.extend(run_scenario(scenario, repeat, implementations,
+                                        memory))
+    finally:
+        connection.use_debug_cursor = debug_cursor
+    return OrderedDict([
+        ('meta', OrderedDict([
+            ('deep_prefetch', deep_prefetch.__version__),
+            ('django', django.get_version()),
+            ('python', platform.python_version()),
+            ('database', connection.vendor),
+            ('date', datetime.utcnow().isoformat()),
+            ('repeat', repeat),
+        ])),
+        ('results', results),
+    ])
+
+
+def scenarios(roots, fanouts, depths, content_types, overlaps):
+    """Scenarios for all combinations of parameters."""
+    return [Scenario(roots, *params)
+            for params in product(fanouts, depths, content_types, overlaps)]
+
+
+def dump(report, stream):
+    json.dump(report, stream, indent=2)
+    stream.write('\n')
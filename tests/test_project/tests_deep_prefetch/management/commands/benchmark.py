@@ -0,0 +1,71 @@
+# coding=utf-8
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from tests_deep_prefetch import benchmark
+
+
+def int_list(value):
+    return [int(v) for v in value.split(',')]
+
+
+def float_list(value):
+    return [float(v) for v in value.split(',')]
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks deep prefetching against Django prefetch_related '
+            'on generated graphs of test models, writes results as JSON. '
+            'Lists of values are comma-separated, all combinations of '
+            'them are measured.')
+    option_list = BaseCommand.option_list + (
+        make_option('--roots', type='int', default=100,
+                    help='Number of root objects.'),
+        make_option('--fanout', default='3',
+                    help='Related objects per object and relation.'),
+        make_option('--depth', default='1,2,3,4',
+                    help='Number of relations in the lookup.'),
+        make_option('--content-types', default='1,2',
+                    help='Number of models referred by GFK of roots.'),
+        make_option('--overlap', default='0,0.5',
+                    help='Share of objects related to several parents.'),
+        make_option('--repeat', type='int', default=5,
+                    help='Number of measurements of time.'),
+        make_option('--implementation', action='append',
+                    dest='implementations',
+                    help='deep or native, by default - both.'),
+        make_option('--no-memory', action='store_false', dest='memory',
+                    default=True, help="Don't measure peak memory."),
+        make_option('--output', help='File to write results to, '
+                                     'by default - standard output.'),
+    )
+
+    def handle(self, **options):
+        try:
+            scenarios = benchmark.scenarios(
+                options['roots'], int_list(options['fanout']),
+                int_list(options['depth']),
+                int_list(options['content_types']),
+                float_list(options['overlap']))
+        except ValueError as e:
+            raise CommandError(e)
+        for name in options['implementations'] or []:
+            if name not in benchmark.IMPLEMENTATIONS:
+                raise CommandError('Unknown implementation: %s' % name)
+        # graphs are generated in test database, like in tests
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0)
+        try:
+            report = benchmark.run_benchmark(
+                scenarios, options['repeat'], options['implementations'],
+                options['memory'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        if options['output']:
+            with open(options['output'], 'w') as stream:
+                benchmark.dump(report, stream)
+        else:
+            benchmark.dump(report, sys.stdout)
@@ -22,9 +22,15 @@ class Comment(models.Model):
     object_id = models.PositiveSmallIntegerField()
     content_object = generic.GenericForeignKey()
 
+class Tag(models.Model):
+    content_type = models.ForeignKey(ContentType, related_name='tags')
+    object_pk = models.TextField()
+    content_object = generic.GenericForeignKey(fk_field='object_pk')
+
 class Photo(models.Model):
     name = models.CharField(max_length=50)
     people_on_photo = models.ManyToManyField('User', related_name='photo_appeared_on')
+    author = models.ForeignKey('User', null=True, related_name='own_photos')
     comments = generic.GenericRelation(Comment)
 
 class User(models.Model):
@@ -47,3 +53,7 @@ class FKModel(models.Model):
     fk = models.ForeignKey('SimpleModel', related_name='fks')
     deep = DeepPrefetchManager()
 
+
+class Category(models.Model):
+    name = models.CharField(max_length=50)
+    parent = models.ForeignKey('self', null=True, related_name='children')
@@ -5,17 +5,36 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 import autofixture
+from django.contrib.contenttypes.models import ContentType
 from django.db import connection
 from os.path import join, dirname, abspath, pardir
+from threading import Thread
+import pickle
 import pytest
 from time import time
 import traceback
 
-from .models import Like, Comment, Photo, User, SimpleModel, FKModel
+from .models import (Like, Comment, Photo, User, BlogPost, Category, Tag,
+                     SimpleModel,
+                     FKModel)
+from .benchmark import Scenario, run_benchmark
+from tests_from_django.models import Bookmark, TaggedItem
+from deep_prefetch.base import (deep_prefetch_related_objects,
+                                adeep_prefetch_related_objects, get_step,
+                                normalize_lookup, find, PrefetchedQuerySet,
+                                SourceQuery)
+from deep_prefetch.cache import PrefetchCache
+from deep_prefetch.metrics import (LookupEvent, MemoryCollector,
+                                   register_collector, unregister_collector)
+from deep_prefetch.signals import lookup_fetched, prefetch_finished
+from deep_prefetch.nplusone import detector, NPlusOne
+from deep_prefetch.parallel import get_query_pool, MAX_QUERY_POOLS
+from deep_prefetch import routing
+from deep_prefetch.utils import DeepPrefetch, DeepPrefetchQuerySet
 
 import django
 import deep_prefetch
-from utils import verbose_cursor
+from utils import verbose_cursor, shared_connections
 
 BASE_PATHS = [
     # join(dirname(abspath(__file__)), pardir, pardir),
@@ -63,5 +82,1070 @@ def test_single_seen():
     simple_model = autofixture.create_one(SimpleModel)
     autofixture.create(FKModel, 3, field_values={'fk': simple_model})
 
-    queryset = FKModel.deep.prefetch_related('fk', 'fk__fks__fk')
-    list(queryset)
\ No newline at end of file
+    with verbose_cursor() as queries:
+        objects = list(FKModel.deep.prefetch_related('fk', 'fk__fks__fk'))
+        assert len(queries) == 3
+    assert set(map(id, objects[0].fk.fks.all())) == set(map(id, objects))
+
+@pytest.mark.django_db
+def test_identity_map():
+    """Row reached by different paths is one instance, FK needs no query."""
+    user = autofixture.create_one(User)
+    photo = Photo.objects.create(name='photo', author=user)
+    photo.people_on_photo.add(user)
+    photos = list(Photo.objects.all())
+
+    with verbose_cursor() as queries:
+        deep_prefetch_related_objects(
+            photos, ['people_on_photo', 'people_on_photo__own_photos__author'])
+        person = photos[0].people_on_photo.all()[0]
+        assert person.own_photos.all()[0] is photos[0]
+        assert photos[0].author is person
+        assert len(queries) == 2
+
+@pytest.mark.django_db
+def test_compiled_plans():
+    photo = autofixture.create_one(Photo)
+    Like.objects.create(content_object=photo)
+    list(Like.deep.prefetch_related('content_object__comments'))
+
+    like = Like.objects.get()
+    step = get_step(like, 'content_object')
+    assert step is get_step(like, 'content_object')
+    assert get_step(like, 'pk') is None
+    lookup = normalize_lookup('content_object__comments')
+    assert lookup is normalize_lookup('content_object__comments')
+    assert lookup.clip() is lookup.clip()
+    assert (lookup.attr, lookup.clip().attr) == ('content_object', 'comments')
+
+@pytest.mark.django_db
+def test_chunk_size():
+    photos = autofixture.create(Photo, 5)
+    user = autofixture.create_one(User)
+    for photo in photos:
+        Like.objects.create(content_object=photo)
+        photo.people_on_photo.add(user)
+
+    with verbose_cursor() as queries:
+        objects = list(Like.deep.all()
+                       .prefetch_options(chunk_size=2)
+                       .prefetch_related('content_object__people_on_photo'))
+        # 1 for likes, 3 for photos and 3 for people on photos.
+        assert len(queries) == 1 + 3 + 3
+        assert ([o.content_object for o in objects] ==
+                sorted(photos, key=lambda p: p.pk))
+        for o in objects:
+            assert list(o.content_object.people_on_photo.all()) == [user]
+        assert len(queries) == 1 + 3 + 3
+
+
+@pytest.mark.django_db
+def test_chunk_size_per_lookup():
+    simple_models = autofixture.create(SimpleModel, 3)
+    for simple_model in simple_models:
+        autofixture.create(FKModel, 2, field_values={'fk': simple_model})
+
+    with verbose_cursor() as queries:
+        list(FKModel.deep.prefetch_related(DeepPrefetch('fk__fks',
+                                                        chunk_size=2)))
+        # 2 queries for 3 distinct FK values, 2 for 3 reverse relations.
+        assert len(queries) == 1 + 2 + 2
+
+
+@pytest.mark.django_db
+def test_iterator_chunks():
+    photos = autofixture.create(Photo, 5)
+    for photo in photos:
+        Like.objects.create(content_object=photo)
+        Comment.objects.create(content_object=photo)
+
+    with verbose_cursor() as queries:
+        iterator = Like.deep.prefetch_related(
+            'content_object__comments').iterator(chunk_size=2)
+        like = next(iterator)
+        assert len(queries) == 1 + 2
+        assert list(like.content_object.comments.all())
+        objects = [like] + list(iterator)
+        assert len(queries) == 1 + 2 * 3
+    assert [list(o.content_object.comments.all()) for o in objects] == [
+        list(Comment.objects.filter(object_id=o.object_id)) for o in objects]
+
+@pytest.mark.django_db
+def test_only_defer():
+    photo = Photo.objects.create(name='photo')
+    post = autofixture.create_one(BlogPost, generate_fk=True)
+    Like.objects.create(content_object=photo)
+    Like.objects.create(content_object=post)
+    Comment.objects.create(content_object=photo)
+
+    def sql(queries, table):
+        return find(lambda q: table in q.split(' FROM ')[1],
+                    [q['sql'] for q in queries])
+
+    with verbose_cursor() as queries:
+        likes = list(Like.deep.prefetch_related(
+            DeepPrefetch('content_object', only={Photo: ['name']})))
+        assert len(queries) == 3
+        assert 'author_id' not in sql(queries, 'photo')
+        assert 'author_id' in sql(queries, 'blogpost')
+        assert [l.content_object.name for l in likes] == [photo.name,
+                                                          post.name]
+        assert len(queries) == 3
+
+    with verbose_cursor() as queries:
+        likes = list(Like.deep.prefetch_related(
+            DeepPrefetch('content_object', only={Photo: ['name']}),
+            DeepPrefetch('content_object__comments', defer=['object_id'])))
+        # photos are needed unrestricted for the second lookup anyway
+        assert len(queries) == 4
+        assert 'object_id' in sql(queries, 'comment')  # to match comments
+        assert list(likes[0].content_object.comments.all()) == list(
+            photo.comments.all())
+        assert len(queries) == 4 + 1
+
+    simple_model = autofixture.create_one(SimpleModel)
+    autofixture.create(FKModel, 2, field_values={'fk': simple_model})
+    with verbose_cursor() as queries:
+        objects = list(FKModel.deep.prefetch_related(
+            DeepPrefetch('fk__fks', only=['id'])))
+        assert '"name"' not in queries[-1]['sql']
+        assert len(objects[0].fk.fks.all()) == 2
+
+@pytest.mark.django_db
+def test_values_mode():
+    photo = Photo.objects.create(name='photo')
+    post = autofixture.create_one(BlogPost, generate_fk=True)
+    user = autofixture.create_one(User)
+    photo.people_on_photo.add(user)
+    Like.objects.create(content_object=photo)
+    Like.objects.create(content_object=post)
+    comment = Comment.objects.create(content_object=photo)
+
+    with verbose_cursor() as queries:
+        likes = list(Like.deep.prefetch_related(
+            DeepPrefetch('content_object', values={Photo: ['name'],
+                                                   BlogPost: ['id']}),
+            DeepPrefetch('content_object__people_on_photo',
+                         values=['username'], tuples=True),
+            DeepPrefetch('content_object__comments', values=['id'],
+                         to_attr='comment_ids')))
+        assert len(queries) == 1 + 2 * 2 + 2
+        assert [l.content_object_values for l in likes] == [
+            [{'name': 'photo'}], [{'id': post.id}]]
+        photo, post = [l.content_object for l in likes]
+        assert photo.people_on_photo_values == [(user.username,)]
+        assert photo.comment_ids == [{'id': comment.id}]
+        assert post.comment_ids == []
+        assert len(queries) == 1 + 2 * 2 + 2
+
+    with verbose_cursor() as queries:
+        rows = list(Like.deep.values('id', 'content_type', 'object_id')
+                    .prefetch_related(
+                        DeepPrefetch('content_object', values=['name'],
+                                     tuples=True),
+                        DeepPrefetch('content_object__comments',
+                                     values=['id'])))
+        # rows and instances of the same objects are fetched separately
+        assert len(queries) == 1 + 2 * 2 + 1
+        assert [r['content_object_values'] for r in rows] == [
+            [('photo',)], [(post.name,)]]
+        assert [r['content_object'] for r in rows] == [photo, post]
+        assert rows[0]['content_object'].comments_values == [
+            {'id': comment.id}]
+
+@pytest.mark.django_db
+def test_to_attr():
+    user = autofixture.create_one(User)
+    photo = Photo.objects.create(name='photo', author=user)
+    photo.people_on_photo.add(user)
+    Photo.objects.create(name='empty')
+
+    with verbose_cursor() as queries:
+        photos = list(Photo.objects.order_by('pk'))
+        deep_prefetch_related_objects(photos, [
+            DeepPrefetch('people_on_photo', to_attr='people'),
+            DeepPrefetch('people_on_photo__own_photos', to_attr='owned'),
+            DeepPrefetch('author', to_attr='author_obj')])
+        assert [p.people for p in photos] == [[user], []]
+        assert [p.author_obj for p in photos] == [user, None]
+        assert photos[0].people[0].owned == [photo]
+        assert len(queries) == 1 + 3
+    assert 'people_on_photo' in photos[0]._prefetched_objects_cache
+    assert not hasattr(photos[0].people[0], '_prefetched_objects_cache')
+
+    rows = list(Photo.objects.order_by('pk').values('pk'))
+    deep_prefetch_related_objects(
+        rows, [DeepPrefetch('people_on_photo', to_attr='people')], model=Photo)
+    assert [r['people'] for r in rows] == [[user], []]
+
+@pytest.mark.django_db
+def test_limit():
+    users = [User.objects.create(username='user%d' % i) for i in range(3)]
+    photos = [Photo.objects.create(name='photo%d' % i, author=users[0])
+              for i in range(3)]
+    post = BlogPost.objects.create(name='post', author=users[0])
+    for obj, number in [(photos[0], 4), (photos[1], 1), (post, 3)]:
+        for i in range(number):
+            Comment.objects.create(content_object=obj)
+    photos[0].people_on_photo.add(*users)
+    photos[1].people_on_photo.add(users[0])
+    for obj in photos[:2] + [post]:
+        Like.objects.create(content_object=obj)
+    latest = [list(Comment.objects.filter(
+                  content_type=ContentType.objects.get_for_model(obj),
+                  object_id=obj.pk).order_by('-pk')[:2])
+              for obj in photos[:2] + [post]]
+
+    with verbose_cursor() as queries:
+        likes = list(Like.deep.prefetch_related(
+            DeepPrefetch('content_object__comments', limit=2,
+                         order_by=['-id']),
+            DeepPrefetch('content_object__people_on_photo', limit=2,
+                         order_by=['-username'])))
+        assert len(queries) == len([Like, Photo, BlogPost, Comment, User])
+        assert all('ROW_NUMBER() OVER (PARTITION BY' in q['sql']
+                   for q in queries[3:])
+        objects = [like.content_object for like in likes]
+        assert [list(o.comments.all()) for o in objects] == latest
+        assert map(len, latest) == [2, 1, 2]
+        assert [list(p.people_on_photo.all()) for p in objects[:2]] == [
+            users[:0:-1], users[:1]]
+        users = list(User.objects.filter(pk=users[0].pk))
+        deep_prefetch_related_objects(
+            users, [DeepPrefetch('own_photos', limit=1, order_by=['name'])])
+        assert list(users[0].own_photos.all()) == photos[:1]
+        assert len(queries) == len([Like, Photo, BlogPost, Comment, User,
+                                    User, Photo])
+    # limited and full relation are not taken one for another
+    deep_prefetch_related_objects(users, [
+        'own_photos',
+        DeepPrefetch('own_photos', limit=1, order_by=['-name'],
+                     to_attr='last_photo')])
+    assert list(users[0].own_photos.all()) == photos
+    assert users[0].last_photo == photos[-1:]
+    for order_by in (['author__username'], ['?']):
+        with pytest.raises(ValueError):
+            deep_prefetch_related_objects(users, [DeepPrefetch(
+                'own_photos', limit=1, order_by=order_by, to_attr='x')])
+
+
+@pytest.mark.django_db
+def test_aggregates():
+    users = [User.objects.create(username='user%d' % i) for i in range(2)]
+    photos = [Photo.objects.create(name='photo%d' % i, author=users[0])
+              for i in range(2)]
+    post = BlogPost.objects.create(name='post', author=users[0])
+    for obj, number in [(photos[0], 3), (post, 2)]:
+        for i in range(number):
+            Comment.objects.create(content_object=obj)
+    photos[0].people_on_photo.add(*users)
+    for obj in photos + [post]:
+        Like.objects.create(content_object=obj)
+
+    with verbose_cursor() as queries:
+        likes = list(Like.deep.prefetch_related(
+            DeepPrefetch('content_object__comments', aggregate='count'),
+            DeepPrefetch('content_object__comments', aggregate='exists',
+                         to_attr='commented'),
+            DeepPrefetch('content_object__people_on_photo',
+                         aggregate='count')))
+        # comments of photos and posts are counted by one query
+        assert len(queries) == len([Like, Photo, BlogPost, Comment, Comment,
+                                    User])
+        assert all('GROUP BY' in q['sql'] for q in queries[3:])
+        objects = [like.content_object for like in likes]
+        assert [o.comments_count for o in objects] == [3, 0, 2]
+        assert [o.commented for o in objects] == [True, False, True]
+        assert [o.people_on_photo_count for o in objects[:2]] == [2, 0]
+        assert not any(hasattr(o, '_prefetched_objects_cache')
+                       for o in objects)
+        deep_prefetch_related_objects(
+            users, [DeepPrefetch('own_photos', aggregate='count')])
+        assert [u.own_photos_count for u in users] == [2, 0]
+        assert len(queries) == 7
+    with pytest.raises(ValueError):
+        DeepPrefetch('comments', aggregate='sum')
+
+
+@pytest.mark.django_db
+def test_subquery(monkeypatch):
+    users = [User.objects.create(username='user%d' % i) for i in range(2)]
+    photos = [Photo.objects.create(name='photo%d' % i, author=users[i])
+              for i in range(2)]
+    post = BlogPost.objects.create(name='post', author=users[0])
+    comment = Comment.objects.create(content_object=photos[0])
+    photos[0].people_on_photo.add(*users)
+    for obj in photos + [post]:
+        Like.objects.create(content_object=obj)
+    lookups = ['content_object__comments', 'content_object__author']
+
+    with verbose_cursor() as queries:
+        likes = list(Like.deep.filter(pk__gt=0).prefetch_related(*lookups)
+                     .prefetch_options(subquery_threshold=3))
+        # content objects are selected by subqueries of likes (authors are
+        # joined to them), their relations - by keys
+        assert ['SELECT U0."object_id"' in q['sql'] for q in queries] == [
+            False, True, True, False]
+        assert [like.content_object for like in likes] == photos + [post]
+        assert list(likes[0].content_object.comments.all()) == [comment]
+        assert [like.content_object.author for like in likes] == [
+            users[0], users[1], users[0]]
+        del queries[:]
+        likes = list(Like.deep.prefetch_related(*lookups)
+                     .prefetch_options(subquery_threshold=4))
+        assert not any('IN (SELECT' in q['sql'] for q in queries)
+        del queries[:]
+        qs = DeepPrefetchQuerySet(User).prefetch_related(
+            'own_photos', 'photo_appeared_on', 'comments')
+        users = list(qs.prefetch_options(subquery_threshold=0))
+        assert len(queries) == 4
+        assert all('IN (SELECT U0."id" FROM "tests_deep_prefetch_user" U0)'
+                   in q['sql'] for q in queries[1:])
+        assert [list(u.own_photos.all()) for u in users] == [[p]
+                                                             for p in photos]
+        assert [list(u.photo_appeared_on.all()) for u in users] == [
+            photos[:1], photos[:1]]
+        photos = list(DeepPrefetchQuerySet(Photo).prefetch_related('comments')
+                      .prefetch_options(subquery_threshold=0))
+        assert 'IN (SELECT U0."id"' in queries[-1]['sql']
+        assert list(photos[0].comments.all()) == [comment]
+        assert len(queries) == 6
+
+    # the QuerySet is not cloned for subqueries unless they are used
+    def fail(self, queryset):
+        raise AssertionError('Source is cloned.')
+    monkeypatch.setattr(SourceQuery, '__init__', fail)
+    list(Like.deep.prefetch_related(*lookups))
+    list(Like.deep.prefetch_related(*lookups)
+         .prefetch_options(subquery_threshold=4))
+
+
+@pytest.mark.django_db
+def test_recursive():
+    user = User.objects.create(username='user')
+    posts = [BlogPost.objects.create(name='post%d' % i, author=user)
+             for i in range(5)]
+    for post, next_post in zip(posts, posts[1:]):
+        post.related_posts.add(next_post) # symmetrical - each link is a cycle
+    posts[0].related_posts.add(posts[2])
+
+    with verbose_cursor() as queries:
+        roots = list(BlogPost.objects.filter(pk=posts[0].pk))
+        deep_prefetch_related_objects(roots, ['related_posts*3'])
+        # each level queries only posts which were not reached before
+        assert len(queries) == 4
+        assert str(posts[3].pk) in queries[-1]['sql']
+        assert str(posts[0].pk) not in queries[-1]['sql']
+        root = roots[0]
+        first, second = root.related_posts.all()
+        assert [first, second] == posts[1:3]
+        # one instance per row on all levels
+        assert first.related_posts.all()[0] is root
+        assert second.related_posts.all()[0] is root
+        assert second.related_posts.all()[1] is first
+        third = second.related_posts.all()[2]
+        assert third == posts[3]
+        assert list(third.related_posts.all()) == [posts[2], posts[4]]
+        assert third.related_posts.all()[0] is second
+        assert len(queries) == 4
+        # depth limit
+        assert 'related_posts' not in getattr(
+            third.related_posts.all()[1], '_prefetched_objects_cache', {})
+
+    # recursion continued by another lookup is traversed on its own
+    BlogPost.objects.filter(pk__in=[posts[0].pk, posts[1].pk, posts[3].pk])\
+        .update(author=User.objects.create(username='other'))
+
+    def walk(posts, depth):
+        for post in posts:
+            if depth:
+                walk(post.related_posts.all(), depth - 1)
+
+    for lookups in (['author__posts__related_posts*3'],
+                    ['related_posts*3', 'author__posts__related_posts*3']):
+        roots = list(BlogPost.objects.filter(pk=posts[4].pk))
+        deep_prefetch_related_objects(roots, lookups)
+        with verbose_cursor() as queries:
+            walk(roots, 3)
+            walk(roots[0].author.posts.all(), 3)
+            assert len(queries) == 0
+
+    with pytest.raises(ValueError):
+        deep_prefetch_related_objects(roots, ['related_posts*0'])
+    with pytest.raises(ValueError):
+        deep_prefetch_related_objects(roots, ['related_posts*2__author'])
+    plan = DeepPrefetchQuerySet(BlogPost).filter(pk=posts[0].pk)\
+        .prefetch_related('related_posts*2').explain_prefetch()
+    assert len(plan.find('related_posts__related_posts')) == 1
+
+
+@pytest.mark.django_db
+def test_tree():
+    root = Category.objects.create(name='root')
+    children = [Category.objects.create(name='child%d' % i, parent=root)
+                for i in range(2)]
+    grandchild = Category.objects.create(name='grandchild',
+                                         parent=children[1])
+    leaf = Category.objects.create(name='leaf', parent=grandchild)
+    Category.objects.create(name='too deep', parent=leaf)
+
+    with verbose_cursor() as queries:
+        roots = list(Category.objects.filter(pk=root.pk))
+        deep_prefetch_related_objects(
+            roots, [DeepPrefetch('children*3', tree=True)])
+        assert len(queries) == 2 and 'WITH RECURSIVE' in queries[1]['sql']
+        first, second = roots[0].children.all()
+        assert [first, second] == children
+        assert list(first.children.all()) == []
+        third, = second.children.all()
+        assert third == grandchild
+        assert list(third.children.all()) == [leaf]
+        assert len(queries) == 2
+        # depth limit
+        assert 'children' not in getattr(
+            third.children.all()[0], '_prefetched_objects_cache', {})
+
+        del queries[:]
+        leaves = list(Category.objects.filter(pk=leaf.pk))
+        deep_prefetch_related_objects(
+            leaves, [DeepPrefetch('parent*5', tree=True)])
+        assert len(queries) == 2
+        assert leaves[0].parent == grandchild
+        assert leaves[0].parent.parent.parent == root
+        assert leaves[0].parent.parent.parent.parent is None
+        assert len(queries) == 2
+
+        # cycles are cut, one instance per row
+        first = Category.objects.create(name='first')
+        second = Category.objects.create(name='second', parent=first)
+        Category.objects.filter(pk=first.pk).update(parent=second)
+        del queries[:]
+        cycle = list(Category.objects.filter(pk=first.pk))
+        deep_prefetch_related_objects(
+            cycle, [DeepPrefetch('children*4', tree=True)])
+        assert len(queries) == 2
+        assert cycle[0].children.all()[0].children.all()[0] is cycle[0]
+
+    with pytest.raises(ValueError):
+        DeepPrefetch('children', tree=True)
+    with pytest.raises(ValueError):
+        deep_prefetch_related_objects(
+            [BlogPost.objects.create(name='post', author=User.objects.create(username='user'))],
+            [DeepPrefetch('read_by*2', tree=True)])
+
+
+@pytest.mark.django_db
+def test_subquery_text_keys():
+    photos = [Photo.objects.create(name='photo%d' % i) for i in range(2)]
+    photo_ct = ContentType.objects.get_for_model(Photo)
+    Tag.objects.bulk_create([
+        Tag(content_type=photo_ct, object_pk=unicode(photos[i % 2].pk))
+        for i in range(500)])
+
+    with verbose_cursor() as queries:
+        tags = list(DeepPrefetchQuerySet(Tag).prefetch_related(
+            'content_object').prefetch_options(subquery_threshold=500))
+        # text object ids are not compared with integer keys in SQL
+        assert len(queries) == 2
+        assert 'IN (SELECT' not in queries[1]['sql']
+        assert [tag.content_object for tag in tags[:2]] == photos
+
+
+@pytest.mark.django_db
+def test_prefetched_queryset():
+    user, other = autofixture.create(User, 2)
+    photo = autofixture.create_one(Photo)
+    photo.people_on_photo.add(user, other)
+    photos = list(Photo.objects.all())
+    deep_prefetch_related_objects(photos, ['people_on_photo'])
+
+    people = photos[0].people_on_photo.all()
+    with verbose_cursor() as queries:
+        assert type(people) is PrefetchedQuerySet
+        assert (len(people), people.count(), people.exists()) == (2, 2, True)
+        assert set(people) == set([user, other]) and people[0] in people
+        assert len(queries) == 0
+        # query is built on demand
+        assert list(people.filter(pk=user.pk)) == [user]
+        assert people.model is User and len(people) == 2
+        assert len(queries) == 1
+    assert photos[0].people_on_photo.all() is people
+
+@pytest.mark.django_db
+def test_compact():
+    users = [User.objects.create(username='user%d' % i) for i in range(2)]
+    photos = [Photo.objects.create(name='photo%d' % i) for i in range(3)]
+    for photo in photos[:2]:
+        photo.people_on_photo.add(*users)
+        Comment.objects.create(content_object=photo)
+    photos = list(Photo.objects.order_by('pk'))
+
+    with verbose_cursor() as queries:
+        deep_prefetch_related_objects(
+            photos, ['people_on_photo__photo_appeared_on', 'comments'],
+            compact=True)
+        assert len(queries) == 3
+    relations = photos[0]._prefetched_objects_cache
+    assert not any(isinstance(dict.__getitem__(relations, name),
+                              PrefetchedQuerySet) for name in relations)
+    # objects of the same rows are shared, relations are made on access
+    people = photos[0].people_on_photo.all()
+    assert type(people) is PrefetchedQuerySet
+    assert list(people) == list(photos[1].people_on_photo.all()) == users
+    assert people[0] is photos[1].people_on_photo.all()[0]
+    assert set(people[0].photo_appeared_on.all()) == set(photos[:2])
+    assert list(photos[2].people_on_photo.all()) == []
+    assert len(photos[1].comments.all()) == 1
+    assert len(queries) == 3
+    copy = pickle.loads(pickle.dumps(photos[1]))
+    assert list(copy.comments.all()) == list(photos[1].comments.all())
+
+@pytest.mark.django_db
+def test_lazy_prefetch():
+    photos = autofixture.create(Photo, 3)
+    post = autofixture.create_one(BlogPost, generate_fk=True)
+    user = autofixture.create_one(User)
+    for photo in photos:
+        Like.objects.create(content_object=photo)
+        Comment.objects.create(content_object=photo)
+        photo.people_on_photo.add(user)
+    Like.objects.create(content_object=post)
+
+    with verbose_cursor() as queries:
+        likes = list(Like.deep.all().lazy_prefetch())
+        assert len(queries) == 1
+        for like in likes:
+            if like.content_object in photos:
+                list(like.content_object.comments.all())
+                list(like.content_object.people_on_photo.all())
+        # photos, posts, comments, people
+        assert len(queries) == 1 + 2 + 1 + 1
+
+    with verbose_cursor() as queries:
+        likes = list(Like.deep.all().lazy_prefetch().iterator(chunk_size=2))
+        assert len(queries) == 1
+        [like.content_object for like in likes]
+        # photos of the first chunk, photo and post of the second one
+        assert len(queries) == 1 + 1 + 2
+
+@pytest.fixture
+def n_plus_one_reports(request):
+    reports = []
+    detector.enabled, detector.callback = True, reports.append
+    def restore():
+        detector.enabled, detector.callback = None, None
+    request.addfinalizer(restore)
+    return reports
+
+@pytest.mark.django_db
+def test_n_plus_one(n_plus_one_reports):
+    photos = autofixture.create(Photo, 3)
+    for photo in photos:
+        Like.objects.create(content_object=photo)
+        Comment.objects.create(content_object=photo)
+
+    for like in Like.deep.all():
+        like.content_object
+    assert n_plus_one_reports == [
+        NPlusOne(Like, Like, 'content_object', 2)]
+
+    del n_plus_one_reports[:]
+    likes = list(Like.deep.prefetch_related('content_object'))
+    [l.content_object.author for l in likes]  # no author - no query
+    list(likes[0].content_object.comments.all())
+    list(likes[0].content_object.comments.all())  # the same object again
+    assert n_plus_one_reports == []
+    [list(l.content_object.comments.all()) for l in likes]
+    assert n_plus_one_reports == [
+        NPlusOne(Like, Photo, 'content_object__comments', 2)]
+
+    del n_plus_one_reports[:]
+    list(Like.deep.all().lazy_prefetch())[0].content_object
+    deep_prefetch_related_objects(likes, ['content_object__comments'])
+    [list(l.content_object.comments.all()) for l in likes]
+    assert n_plus_one_reports == []
+
+@pytest.mark.django_db
+def test_n_plus_one_pickling(n_plus_one_reports):
+    photos = autofixture.create(Photo, 2)
+    for photo in photos:
+        Like.objects.create(content_object=photo)
+
+    likes = list(Like.deep.all())
+    likes[0].content_object
+    for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+        copies = pickle.loads(pickle.dumps(likes, protocol))
+        # tracking of the original roots is not carried along
+        [like.content_object for like in copies]
+        assert n_plus_one_reports == []
+    likes[1].content_object
+    assert n_plus_one_reports == [NPlusOne(Like, Like, 'content_object', 2)]
+
+@pytest.mark.django_db
+def test_coalescing():
+    photo_author, post_author = autofixture.create(User, 2)
+    photo = Photo.objects.create(name='photo', author=photo_author)
+    post = BlogPost.objects.create(name='post', author=post_author)
+    photo_comment = Comment.objects.create(content_object=photo)
+    post_comment = Comment.objects.create(content_object=post)
+    Like.objects.create(content_object=photo)
+    Like.objects.create(content_object=post)
+
+    with verbose_cursor() as queries:
+        objects = list(Like.deep.prefetch_related(
+            DeepPrefetch('content_object__author', join=False),
+            'content_object__comments'))
+        # Users and comments of photos and blog posts are fetched
+        # by one query each.
+        assert len(queries) == len([Like, Photo, BlogPost, User, Comment])
+        assert [(o.content_object.author, list(o.content_object.comments.all()))
+                for o in objects] == [(photo_author, [photo_comment]),
+                                      (post_author, [post_comment])]
+        assert len(queries) == 5
+
+
+@pytest.mark.django_db
+def test_joins():
+    users = [User.objects.create(username='user%d' % i) for i in range(3)]
+    photo = Photo.objects.create(name='photo', author=users[0])
+    post = BlogPost.objects.create(name='post', author=users[1])
+    Photo.objects.create(name='other photo', author=users[1])
+    photo.people_on_photo.add(users[2])
+    post.read_by.add(users[2])
+    Like.objects.create(content_object=photo)
+    Like.objects.create(content_object=post)
+    people_photo = Photo.objects.create(name='people photo', author=users[0])
+    people_photo.people_on_photo.add(users[0], users[1])
+
+    with verbose_cursor() as queries:
+        likes = list(Like.deep.prefetch_related(
+            'content_object__author__own_photos__author',
+            'content_object__read_by'))
+        # authors are joined to photos and blog posts, authors of photos -
+        # to photos
+        assert len(queries) == len([Like, Photo, BlogPost, 'own_photos',
+                                    'read_by'])
+        photo, post = [like.content_object for like in likes]
+        assert post.author.own_photos.all()[0].author is post.author
+        assert post.author.own_photos.all()[0].name == 'other photo'
+        assert photo.author.own_photos.all()[1].author is photo.author
+        assert list(post.read_by.all()) == [users[2]]
+        assert len(queries) == 5
+        photos = list(Photo.objects.filter(pk=people_photo.pk))
+        deep_prefetch_related_objects(photos,
+                                      ['people_on_photo__own_photos__author'])
+        # shared rows stay one instance
+        people = list(photos[0].people_on_photo.all())
+        own_photos = list(people[0].own_photos.all())
+        assert photos[0] in own_photos
+        assert own_photos[own_photos.index(photos[0])] is photos[0]
+        assert all(p.author is people[0] for p in own_photos)
+        assert len(queries) == 5 + len([Photo, 'people_on_photo', 'own_photos'])
+
+
+@pytest.mark.django_db
+def test_same_depth_merged():
+    author, reader = autofixture.create(User, 2)
+    post = BlogPost.objects.create(name='post', author=author)
+    post.read_by.add(reader)
+    author_photo, reader_photo = autofixture.create(Photo, 2)
+    author.photos.add(author_photo)
+    reader.photos.add(reader_photo)
+
+    with verbose_cursor() as queries:
+        posts = list(BlogPost.objects.all())
+        deep_prefetch_related_objects(posts, ['read_by__photos',
+                                              'author__photos'])
+        # Photos of readers and authors are fetched by one query.
+        assert len(queries) == len([BlogPost, 'read_by', 'author', Photo])
+        assert list(posts[0].author.photos.all()) == [author_photo]
+        assert list(posts[0].read_by.all()[0].photos.all()) == [reader_photo]
+        assert len(queries) == 4
+
+
+@pytest.mark.django_db
+def test_empty_relation_before_attribute():
+    bookmark = Bookmark.objects.create(url='http://example.com/')
+    TaggedItem.objects.create(tag='tag', content_object=bookmark)
+
+    # nothing is fetched for `created_by`, lookups of higher order that
+    # traverse attributes still must be processed
+    items = list(TaggedItem.objects.all())
+    for item in items:
+        item.me = item
+    deep_prefetch_related_objects(items, ['created_by',
+                                          'me__content_object'])
+    with verbose_cursor() as queries:
+        assert items[0].content_object == bookmark
+        assert items[0].created_by is None
+        assert len(queries) == 0
+
+    with pytest.raises(ValueError):
+        deep_prefetch_related_objects(list(TaggedItem.objects.all()),
+                                      ['created_by', 'tag'])
+
+
+@pytest.mark.django_db
+def test_parallel():
+    user = autofixture.create_one(User)
+    photo = Photo.objects.create(name='photo')
+    photo.people_on_photo.add(user)
+    post = BlogPost.objects.create(name='post', author=user)
+    photo_comment = Comment.objects.create(content_object=photo)
+    post_comment = Comment.objects.create(content_object=post)
+    Like.objects.create(content_object=photo)
+    Like.objects.create(content_object=post)
+
+    with shared_connections(), verbose_cursor() as queries:
+        objects = list(Like.deep.all()
+                       .prefetch_options(parallel=2)
+                       .prefetch_related('content_object__people_on_photo',
+                                         'content_object__comments'))
+        assert len(queries) == len([Like, Photo, BlogPost, User, Comment])
+        assert [o.content_object for o in objects] == [photo, post]
+        assert list(objects[0].content_object.people_on_photo.all()) == [user]
+        assert ([list(o.content_object.comments.all()) for o in objects] ==
+                [[photo_comment], [post_comment]])
+        assert len(queries) == 5
+        assert len(set(q['thread'] for q in queries)) > 1
+        # workers (and their connections) are reused by the next prefetch
+        threads = set(q['thread'] for q in queries[1:])
+        objects = list(Like.objects.all())
+        del queries[:]
+        deep_prefetch_related_objects(objects, ['content_object__comments'],
+                                      parallel=2)
+        workers = set(q['thread'] for q in queries) - set(['MainThread'])
+        assert workers and workers <= threads
+
+    # only pools of a few recently used sizes are kept
+    pool = get_query_pool(2)
+    for size in range(3, 3 + MAX_QUERY_POOLS):
+        get_query_pool(size)
+    assert pool.closed and get_query_pool(2) is not pool
+    # calls made with closed pool are run by the calling thread
+    assert pool.map(len, [('ab',), ('c',)]) == [2, 1]
+
+
+@pytest.mark.django_db
+def test_replica_routing():
+    user = User.objects.create(username='user')
+    photo = Photo.objects.create(name='primary')
+    photo.people_on_photo.add(user)
+    comment = Comment.objects.create(content_object=photo)
+    Like.objects.create(content_object=photo)
+    # 'other' database plays replica with its own copy of the photo
+    Photo(pk=photo.pk, name='replica').save(using='other')
+    Comment(pk=comment.pk + 100, content_type_id=comment.content_type_id,
+            object_id=photo.pk).save(using='other')
+    lookups = ['content_object__comments', 'content_object__people_on_photo']
+
+    def prefetch(policy):
+        likes = list(Like.deep.all())
+        deep_prefetch_related_objects(likes, lookups, routing=policy)
+        obj = likes[0].content_object
+        return (obj.name, [c.pk for c in obj.comments.all()],
+                list(obj.people_on_photo.all()), obj._state.db)
+
+    try:
+        routing.reset()
+        policy = routing.ReplicaPolicy(['other'], models=[Photo])
+        assert prefetch(policy) == ('replica', [comment.pk], [user],
+                                    'default')
+        policy = routing.ReplicaPolicy(
+            ['other'], lookups=['content_object__comments'])
+        assert prefetch(policy) == ('primary', [comment.pk + 100], [user],
+                                    'default')
+        policy = routing.ReplicaPolicy(['other'])
+        assert prefetch(policy) == ('replica', [comment.pk + 100], [],
+                                    'default')
+        # read-your-writes
+        photo.save()
+        assert prefetch(policy) == ('primary', [comment.pk], [user],
+                                    'default')
+        routing.reset()
+        assert prefetch(policy)[0] == 'replica'
+    finally:
+        Comment.objects.using('other').all().delete()
+        Photo.objects.using('other').all().delete()
+        routing.reset()
+
+
+@pytest.mark.django_db
+def test_nonblocking_replica_routing():
+    photo = Photo.objects.create(name='replica')
+    Like.objects.create(content_object=photo)
+    Photo(pk=photo.pk, name='replica').save(using='other')
+    policy = routing.ReplicaPolicy(['other'])
+    try:
+        with shared_connections():
+            routing.reset()
+            photo.name = 'primary'
+            photo.save()
+            likes = list(Like.deep.all())
+            deep_prefetch_related_objects(likes, ['content_object'],
+                                          routing=policy)
+            assert likes[0].content_object.name == 'primary'
+            # pins of the calling thread are used by the worker thread
+            likes = list(Like.objects.all())
+            adeep_prefetch_related_objects(
+                likes, ['content_object'], routing=policy).result(timeout=10)
+            assert likes[0].content_object.name == 'primary'
+            likes = Like.deep.prefetch_related('content_object')\
+                .prefetch_options(routing=policy).aevaluate()\
+                .result(timeout=10)
+            assert likes[0].content_object.name == 'primary'
+            routing.reset()
+            likes = list(Like.objects.all())
+            adeep_prefetch_related_objects(
+                likes, ['content_object'], routing=policy).result(timeout=10)
+            assert likes[0].content_object.name == 'replica'
+    finally:
+        Photo.objects.using('other').all().delete()
+        routing.reset()
+
+
+@pytest.mark.django_db
+def test_identity_per_database():
+    user = User.objects.create(username='default')
+    photo = Photo.objects.create(name='default')
+    photo.people_on_photo.add(user)
+    ct = ContentType.objects.get_for_model(Photo)
+    Like.objects.create(content_object=photo)
+    try:
+        # rows of 'other' database have the same keys, but other names
+        other_ct, _ = ContentType.objects.using('other').get_or_create(
+            app_label=ct.app_label, model=ct.model,
+            defaults={'name': ct.name})
+        User(pk=user.pk, username='other').save(using='other')
+        other_photo = Photo(pk=photo.pk, name='other')
+        other_photo.save(using='other')
+        other_photo.people_on_photo.add(user.pk)
+        Like(content_type_id=other_ct.pk,
+             object_id=photo.pk).save(using='other')
+        for compact in (False, True):
+            likes = (list(Like.objects.all()) +
+                     list(Like.objects.using('other')))
+            deep_prefetch_related_objects(
+                likes, ['content_object__people_on_photo'], compact=compact)
+            assert [(l.content_object.name, l.content_object._state.db,
+                     [u.username for u in
+                      l.content_object.people_on_photo.all()])
+                    for l in likes] == [('default', 'default', ['default']),
+                                        ('other', 'other', ['other'])]
+    finally:
+        for model in (Like, Photo, User):
+            model.objects.using('other').all().delete()
+
+
+@pytest.mark.django_db
+def test_nonblocking():
+    photo = autofixture.create_one(Photo)
+    user = autofixture.create_one(User)
+    photo.people_on_photo.add(user)
+    Like.objects.create(content_object=photo)
+
+    with shared_connections(), verbose_cursor() as queries:
+        future = Like.deep.prefetch_related(
+            'content_object__people_on_photo').aevaluate()
+        objects = future.result(timeout=10)
+        assert [o.content_object for o in objects] == [photo]
+        assert list(objects[0].content_object.people_on_photo.all()) == [user]
+
+        likes = list(Like.objects.all())
+        future = adeep_prefetch_related_objects(
+            likes, ['content_object__people_on_photo'])
+        assert future.result(timeout=10) is None
+        assert list(likes[0].content_object.people_on_photo.all()) == [user]
+
+        assert len(queries) == 3 + 3
+        assert 'MainThread' not in set(q['thread'] for q in queries
+                                       if 'photo' in q['sql'])
+
+
+@pytest.mark.django_db
+def test_metrics():
+    photo = autofixture.create_one(Photo)
+    post = BlogPost.objects.create(name='post',
+                                   author=autofixture.create_one(User))
+    for obj in (photo, post, photo):
+        Like.objects.create(content_object=obj)
+    Comment.objects.create(content_object=photo)
+    collector = MemoryCollector()
+    events, runs = [], []
+    def on_lookup(sender, event, **kwargs):
+        events.append(event)
+    def on_finished(sender, event, **kwargs):
+        runs.append(event)
+    register_collector(collector)
+    lookup_fetched.connect(on_lookup)
+    prefetch_finished.connect(on_finished)
+    try:
+        likes = list(Like.objects.order_by('pk'))
+        deep_prefetch_related_objects(likes, ['content_object__comments',
+                                              'content_object'])
+    finally:
+        unregister_collector(collector)
+        lookup_fetched.disconnect(on_lookup)
+        prefetch_finished.disconnect(on_finished)
+
+    # parents of generic relation are split by target model
+    assert sorted((e[:5] for e in events), key=repr) == [
+        (['content_object'], BlogPost, 1, 1, 1),
+        (['content_object'], Photo, 2, 1, 1),
+        (['content_object__comments'], Comment, 2, 2, 1)]
+    assert all(e.sql_time >= 0 and e.stitch_time >= 0 for e in events)
+    assert [(r.model, r.objects, r.fetches, r.rows) for r in runs] == [
+        (Like, 3, 3, 3)]
+    assert collector.counters['deep_prefetch.runs'] == 1
+    assert collector.counters['deep_prefetch.lookup.content_object.rows'] == 2
+    assert len(collector.timers[
+        'deep_prefetch.lookup.content_object__comments.sql']) == 1
+
+    events[:] = []
+    lookup_fetched.connect(on_lookup)
+    try:
+        deep_prefetch_related_objects(likes, ['content_object'])
+    finally:
+        lookup_fetched.disconnect(on_lookup)
+    assert events == [LookupEvent(['content_object'], None, 0, 0, 0, 0.0, 0.0,
+                                  3, 0, [])]
+
+
+@pytest.mark.django_db
+def test_explain():
+    photos = autofixture.create(Photo, 2)
+    post = BlogPost.objects.create(name='post',
+                                   author=autofixture.create_one(User))
+    for obj in photos + [post]:
+        Like.objects.create(content_object=obj)
+        Comment.objects.create(content_object=obj)
+    qs = Like.deep.prefetch_related('content_object__comments')
+
+    with verbose_cursor() as queries:
+        plan = qs.explain_prefetch()
+        assert all('COUNT(' in q['sql'] for q in queries)
+    assert plan.objects == 3
+    photo_node, = plan.find('content_object', Photo)
+    assert (photo_node.kind, photo_node.parents) == ('GenericForeignKey', 2)
+    comments_node, = photo_node.children
+    assert (comments_node.lookup, comments_node.kind, comments_node.target,
+            comments_node.rows) == ('content_object__comments',
+                                    'GenericRelatedObjectManager', Comment, 2)
+    assert 'content_object [GenericForeignKey] -> tests_deep_prefetch.Photo' \
+        in str(plan)
+
+    plan = qs.explain_prefetch(analyze=True)
+    assert len(plan.queries) == 3
+    event, = plan.find('content_object', Photo)[0].queries
+    assert (event.model, event.parents, event.rows) == (Photo, 2, 2)
+    assert 'photo' in event.sql[0]
+    # comments of photos and of the post are fetched by one query
+    comment_events = [n.queries for n in plan.find('content_object__comments')]
+    assert comment_events[0] == comment_events[1]
+    assert comment_events[0][0].rows == 3
+    assert plan.as_dict()['nodes'][0]['queries'] in ([0], [1])
+    # subqueries of the QuerySet are analyzed as they are run
+    plan = qs.prefetch_options(subquery_threshold=0).explain_prefetch(
+        analyze=True)
+    event, = plan.find('content_object', Photo)[0].queries
+    assert 'IN (SELECT' in event.sql[0]
+
+    # prefetches made by other threads meanwhile are not analyzed
+    likes = list(Like.objects.all())
+    threads = []
+
+    def prefetch_in_thread(sender, event, **kwargs):
+        if not threads:
+            threads.append(Thread(target=deep_prefetch_related_objects,
+                                  args=(likes, ['content_object__comments'])))
+            threads[0].start()
+            threads[0].join()
+
+    lookup_fetched.connect(prefetch_in_thread)
+    try:
+        with shared_connections():
+            plan = qs.explain_prefetch(analyze=True)
+    finally:
+        lookup_fetched.disconnect(prefetch_in_thread)
+    assert threads and len(plan.queries) == 3
+    with verbose_cursor() as queries:
+        [list(l.content_object.comments.all()) for l in likes]
+        assert len(queries) == 0
+
+
+@pytest.mark.django_db
+def test_benchmark():
+    report = run_benchmark([Scenario(roots=4, fanout=2, depth=4,
+                                     content_types=1),
+                            Scenario(roots=4, fanout=2, depth=2,
+                                     content_types=4)],
+                           repeat=1, memory=False)
+    deep, native, mixed_deep, mixed_native = report['results']
+    assert deep['queries'] == native['queries'] == 4
+    assert deep['objects'] == native['objects'] == 4 + 4 + 8 + 16 + 32
+    assert mixed_deep['queries'] == 4 + 1
+    assert mixed_native['skipped']
+    assert report['meta']['repeat'] == 1
+
+
+@pytest.mark.django_db
+def test_cache():
+    cache = PrefetchCache(prefix='test_cache')
+    cache.clear()
+    photo = autofixture.create_one(Photo)
+    empty_photo = autofixture.create_one(Photo)
+    user = autofixture.create_one(User)
+    photo.people_on_photo.add(user)
+    Comment.objects.create(content_object=photo)
+    lookups = ['people_on_photo', 'comments']
+
+    def fetch():
+        objects = list(Photo.objects.order_by('pk'))
+        deep_prefetch_related_objects(objects, lookups, cache=cache)
+        return [(list(o.people_on_photo.all()), list(o.comments.all()))
+                for o in objects]
+
+    with verbose_cursor() as queries:
+        first = fetch()
+        assert len(queries) == 3
+    with verbose_cursor() as queries:
+        assert fetch() == first
+        assert first[1] == ([], [])
+        assert len(queries) == 1
+
+    # changes invalidate all cached relations of the changed photo only
+    comment = Comment.objects.create(content_object=empty_photo)
+    with verbose_cursor() as queries:
+        assert fetch() == [first[0], ([], [comment])]
+        assert len(queries) == 3
+        assert all('IN (%s)' % empty_photo.pk in q['sql']
+                   for q in queries[1:])
+
+    empty_photo.people_on_photo.add(user)
+    with verbose_cursor() as queries:
+        assert fetch()[1] == ([user], [comment])
+        assert len(queries) == 3
+
+    # rows of other database with the same keys are cached separately
+    try:
+        other_photo = Photo(pk=photo.pk, name=photo.name)
+        other_photo.save(using='other')
+        assert fetch() == [first[0], ([user], [comment])]
+        photos = [Photo.objects.using('other').get(pk=photo.pk)]
+        deep_prefetch_related_objects(photos, ['people_on_photo'],
+                                      cache=cache)
+        assert list(photos[0].people_on_photo.all()) == []
+
+        User(pk=user.pk, username='other').save(using='other')
+        other_photo.people_on_photo.add(user.pk)
+        for _ in range(2):
+            photos = [Photo.objects.using('other').get(pk=photo.pk)]
+            deep_prefetch_related_objects(photos, ['people_on_photo'],
+                                          cache=cache)
+            assert [(u.username, u._state.db)
+                    for u in photos[0].people_on_photo.all()] == [
+                        ('other', 'other')]
+        assert fetch() == [first[0], ([user], [comment])]
+    finally:
+        for model in (Photo, User):
+            model.objects.using('other').all().delete()
@@ -483,8 +483,9 @@ class NullableTest(TestCase):
         self.assertEqual(co_serfs, co_serfs2)
 
     def test_prefetch_nullable(self):
-        # One for main employee, one for boss, one for serfs
-        with self.assertNumQueries(3):
+        # One for main employee, one for serfs - bosses are employees
+        # which are already loaded.
+        with self.assertNumQueries(2):
             qs = Employee.objects.prefetch_related('boss__serfs')
             co_serfs = [list(e.boss.serfs.all()) if e.boss is not None else []
                         for e in qs]
@@ -2,6 +2,7 @@
 from contextlib import contextmanager
 import logging
 import traceback
+from threading import current_thread
 from time import time
 
 from django.core.signals import request_started
@@ -10,7 +11,7 @@ from os.path import dirname, abspath, join, pardir, realpath
 from django.db.backends.util import CursorWrapper, logger
 import pytest
 from deep_prefetch.utils import _prefetch_related_objects
-from django.db import reset_queries
+from django.db import reset_queries, connections
 import django
 import deep_prefetch
 
@@ -47,7 +48,8 @@ def make_verbose_cursor():
                 d = {
                     'sql': sql,
                     'time': "%.3f" % duration,
-                    'stack': stack
+                    'stack': stack,
+                    'thread': current_thread().name
                 }
                 self.db.queries.append(d)
 
@@ -103,6 +105,28 @@ def verbose_cursor():
     BaseDatabaseWrapper.cursor = old_method
     request_started.connect(reset_queries)
 
+@contextmanager
+def shared_connections():
+    """
+    Makes all threads use connections of the current thread.
+
+    In-memory SQLite database is visible only to the connection that created
+    it, so worker threads have to reuse connections of the test.
+    """
+    old_connections = connections._connections
+    shared = type('SharedConnections', (object,), {})()
+    for alias in connections:
+        connection = connections[alias]
+        connection.allow_thread_sharing = True
+        setattr(shared, alias, connection)
+    connections._connections = shared
+    try:
+        yield
+    finally:
+        connections._connections = old_connections
+        for connection in connections.all():
+            connection.allow_thread_sharing = False
+
 def filter_stack(l, paths):
     return [e for e in l if any(realpath(path) in realpath(e[0]) for path in paths)]
 